@@ -9,7 +9,7 @@ import sys
 import tempfile
 import time
 
-from spread.client import async_call
+from spread.dag import Dag
 
 
 
@@ -37,81 +37,46 @@ NUM_CCDS = len([l for l in open(os.path.join(DATA_ROOT, DATASET + '.fits')).read
 
 
 
-def system(argv, **kwds):
-    return(async_call('system', argv, kwds, fast=True, host=BROKER_HOST))
-
-
 def run(verbose=False):
-    scratch_dir = tmpdir = tempfile.mkdtemp(dir=WORK_ROOT)
+    scratch_dir = tempfile.mkdtemp(dir=WORK_ROOT)
 
-    if(verbose):
-        print('Enqueueing PROC_MEF (time: %f)' % (time.time()))
+    # processMef -> NUM_CCDS x processSif -> finishMef, all in scratch_dir. Each
+    # processSif job starts as soon as processMef is done and finishMef as soon
+    # as the last processSif is.
+    dag = Dag(name=DATASET, host=BROKER_HOST, fast=True, cwd=scratch_dir,
+              getenv=True)
 
     ifile = os.path.join(DATA_ROOT, '%s.fits' % (DATASET))
     ofile = '%s_' % (DATASET) + '%(ccdId)s.fits'
-    defer = system(argv=[PROC_MEF, '-i', ifile, '-o', ofile],
-                   cwd=scratch_dir, getenv=True)
-    if(verbose):
-        print('Enqueued %f' % (time.time()))
+    dag.add('processMef', [PROC_MEF, '-i', ifile, '-o', ofile])
 
-    while(not defer.is_ready()):
-        defer.wait()
-    res = defer.result()
-    if(verbose):
-        print(res)
-    if(res['terminated'] or res['exit_code'] != 0):
-        print('BCW terminated with an error.')
-        return(res['exit_code'])
-
-    results = {}
-    defers = []
-    err = 0
+    sif_nodes = []
     for _id in range(NUM_CCDS):
-        if(verbose):
-            print('Enqueueing PROC_SIF (time: %f)' % (time.time()))
-
         ifile = '%s_%d.fits' % (DATASET, _id)
         ofile = '%s_calib_%d.fits' % (DATASET, _id)
-        defer = system(argv=[PROC_SIF, '-i', ifile, '-o', ofile],
-                       cwd=res['cwd'], getenv=True)
-        if(verbose):
-            print('Enqueued %f' % (time.time()))
-        defers.append(defer)
-
-    while(len(results.keys()) < NUM_CCDS):
-        for _id in range(NUM_CCDS):
-            if(not defers[_id].is_ready()):
-                defers[_id].wait()
-                continue
-
-            res = defers[_id].result()
-            results[_id] = res
-            if(res['terminated'] or res['exit_code'] != 0):
-                err = res['exit_code']
-    if(verbose):
-        print(results)
-    if(err):
-        print('BCW terminated with an error.')
-        return(err)
-
-    if(verbose):
-        print('Enqueueing FINISH_MEF (time: %f)' % (time.time()))
+        sif_nodes.append('processSif_%d' % (_id))
+        dag.add(sif_nodes[-1], [PROC_SIF, '-i', ifile, '-o', ofile],
+                parents=['processMef', ])
 
     ifile = '%s_calib_' % (DATASET) + '%(ccdId)s.fits'
     ofile = '%s_calib.fits' % (DATASET)
-    defer = system(argv=[FINISH_MEF, '-i', ifile, '-o', ofile, '-n', NUM_CCDS],
-                   cwd=res['cwd'], getenv=True)
-    if(verbose):
-        print('Enqueued %f' % (time.time()))
+    dag.add('finishMef',
+            [FINISH_MEF, '-i', ifile, '-o', ofile, '-n', NUM_CCDS],
+            parents=sif_nodes)
 
-    while(not defer.is_ready()):
-        defer.wait()
-    res = defer.result()
     if(verbose):
-        print(res)
-    if(res['terminated'] or res['exit_code'] != 0):
+        print('Running %d jobs (time: %f)' % (len(dag.nodes), time.time()))
+    ok = dag.run()
+    if(verbose):
+        for node in dag.nodes.values():
+            print('%s: %s %s' % (node.name, node.state, node.result))
+
+    if(not ok):
         print('BCW terminated with an error.')
-        return(res['exit_code'])
+        failed = dag.failed()
+        if(failed):
+            return(failed[0].result['exit_code'] or 1)
+        return(1)
 
     print('BCW terminated normally. Results in %s' % (scratch_dir))
     return(0)
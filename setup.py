@@ -23,7 +23,7 @@ setup(name = NAME,
       version = VERSION,
 
       scripts = SCRIPTS,
-      packages = [NAME, ],
+      packages = [NAME, NAME + '.bench'],
       package_dir = {NAME: 'src'},
 )
 
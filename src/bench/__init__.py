@@ -0,0 +1,8 @@
+"""
+Benchmarks of Spread itself: dispatch latency, throughput and per job overhead
+of synthetic workloads (see workloads.py and runner.py). Run them with
+    shell> python -m spread.bench [options]
+which prints one JSON record per run, to be kept for regression tracking.
+"""
+from runner import run, stats
+from workloads import WORKLOADS
@@ -0,0 +1,108 @@
+"""
+shell> python -m spread.bench [options]
+
+Run the benchmarks and write one JSON record per (workload, number of workers)
+run, one per line, to stdout or appended to --output. A short summary of each
+run goes to stderr.
+"""
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import tempfile
+
+from spread import serialization
+from runner import run
+from workloads import WORKLOADS
+
+
+
+
+parser = optparse.OptionParser('python -m spread.bench [options]')
+parser.add_option('-b', '--broker',
+                  dest='broker',
+                  type='str',
+                  default=None,
+                  help='broker host name or local:// URL (the local router ' + \
+                       'is started for local:// URLs). Default: a private ' + \
+                       'local router.')
+parser.add_option('-w', '--workload',
+                  dest='workloads',
+                  action='append',
+                  choices=WORKLOADS.keys(),
+                  default=[],
+                  help='workload to run (%s). Can be repeated. ' \
+                       % (', '.join(WORKLOADS.keys())) + 'Default: all.')
+parser.add_option('-W', '--workers',
+                  dest='workers',
+                  action='append',
+                  type='int',
+                  default=[],
+                  help='number of worker processes. Can be repeated. ' + \
+                       'Default: 1 and the number of CPUs.')
+parser.add_option('-s', '--slots',
+                  dest='slots',
+                  type='int',
+                  default=1,
+                  help='execution slots per worker.')
+parser.add_option('-n', '--jobs',
+                  dest='jobs',
+                  type='int',
+                  default=200,
+                  help='number of jobs per run.')
+parser.add_option('-B', '--batch',
+                  dest='batch',
+                  type='int',
+                  default=None,
+                  help='submit the jobs in batches of this many calls.')
+parser.add_option('-S', '--serializer',
+                  dest='serializer',
+                  type='choice',
+                  choices=sorted(serialization.FORMATS.keys()),
+                  default=None,
+                  help='format of the requests (%s). Default: json.' \
+                       % (', '.join(sorted(serialization.FORMATS.keys()))))
+parser.add_option('-u', '--warmup',
+                  dest='warmup',
+                  type='int',
+                  default=10,
+                  help='number of jobs run, and not measured, before each run.')
+parser.add_option('-o', '--output',
+                  dest='output',
+                  type='str',
+                  default=None,
+                  help='append the JSON records to this file.')
+parser.add_option('-l', '--log',
+                  dest='log',
+                  type='str',
+                  default=os.devnull,
+                  help='file the worker output goes to.')
+(options, args) = parser.parse_args()
+
+broker = options.broker
+if(broker is None):
+    broker = 'local://' + os.path.join(tempfile.gettempdir(),
+                                       'spread-bench-%d.sock' % (os.getpid()))
+workers = options.workers or sorted(set([1, multiprocessing.cpu_count()]))
+
+out = sys.stdout
+if(options.output):
+    out = open(options.output, 'a')
+for record in run(broker, options.workloads, workers, options.jobs,
+                  options.slots, options.warmup, options.log, options.batch,
+                  options.serializer):
+    out.write(json.dumps(record, sort_keys=True) + '\n')
+    out.flush()
+    sys.stderr.write('%-6s %3d workers: %8.1f jobs/s, submit->start p50 ' \
+                     '%.1f ms p99 %.1f ms, end->reply p50 %.1f ms p99 ' \
+                     '%.1f ms, %d failed\n' \
+                     % (record['workload'], record['workers'],
+                        record['jobs_per_s'] or 0,
+                        record['submit_to_start']['p50'] * 1000,
+                        record['submit_to_start']['p99'] * 1000,
+                        record['end_to_reply']['p50'] * 1000,
+                        record['end_to_reply']['p99'] * 1000,
+                        record['failed']))
+if(out is not sys.stdout):
+    out.close()
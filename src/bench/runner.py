@@ -0,0 +1,225 @@
+"""
+Run the synthetic workloads against a broker and measure Spread itself.
+
+For each workload and each number of workers, run() starts that many worker.py
+processes, waits for all of them to consume from the request queue, runs a few
+warmup jobs and then submits a batch of jobs all at once. Each run yields a
+record (a dictionary which can be dumped as JSON) with:
+
+    jobs_per_s      jobs divided by the time from the first submission to the
+                    last reply.
+    submit_to_start from the submission of a job to its command being started.
+    end_to_reply    from the command exiting to its reply being received.
+    phases          the duration of each phase of the job timings (see
+                    worker.system and client._add_client_timings).
+    overhead        the time from submission to reply not spent in the
+                    command itself.
+
+Latencies are in seconds, summarized by percentiles (see stats()). Workers and
+client run on the same host: all times come from the same clock.
+"""
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+from spread import client
+from spread import local
+from workloads import WORKLOADS
+
+
+
+
+# Constants
+PERCENTILES = (50, 90, 99)
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'worker.py')
+# How long to wait for the workers to connect and for a batch to complete.
+STARTUP_TIMEOUT = 30
+BATCH_TIMEOUT = 3600
+
+
+
+
+class WorkerProcesses(object):
+    """
+    `count` worker.py processes with `slots` slots each, connected to `url`.
+    `broker` is the LocalBroker serving `url`, if we run it.
+    """
+    def __init__(self, url, count, slots=1, broker=None, log=os.devnull):
+        self.url = url
+        self.count = count
+        self.slots = slots
+        self.broker = broker
+        self.log = log
+        self.procs = []
+        return
+
+    def start(self, rpc):
+        """
+        Start the workers and wait for all of them to consume from the request
+        queue, using the RpcClient `rpc` to ask the broker.
+        """
+        with open(self.log, 'a') as f:
+            for i in range(self.count):
+                self.procs.append(subprocess.Popen([sys.executable,
+                                                    WORKER_SCRIPT,
+                                                    '-n', str(self.slots),
+                                                    self.url],
+                                                   stdout=f,
+                                                   stderr=subprocess.STDOUT,
+                                                   close_fds=True))
+        deadline = time.time() + STARTUP_TIMEOUT
+        while(self._consumers(rpc) < self.count):
+            if(time.time() >= deadline):
+                self.stop()
+                raise client.TimeoutError('Workers not up after %d s' \
+                    % (STARTUP_TIMEOUT))
+            if([p for p in self.procs if p.poll() is not None]):
+                self.stop()
+                raise RuntimeError('Worker exited at startup, see %s' \
+                    % (self.log))
+            time.sleep(.1)
+        return
+
+    def stop(self):
+        for proc in self.procs:
+            if(proc.poll() is None):
+                proc.kill()
+            proc.wait()
+        self.procs = []
+        return
+
+    def _consumers(self, rpc):
+        if(self.broker is not None):
+            return(self.broker.queue_stats(client.QUEUE_NAME)[1])
+        frame = rpc.channel.queue_declare(queue=client.QUEUE_NAME,
+                                          passive=True)
+        return(frame.method.consumer_count)
+
+
+
+
+def stats(values):
+    """
+    Return the count, mean, min, max and PERCENTILES (nearest rank) of
+    `values`, as a dictionary.
+    """
+    values = sorted(values)
+    if(not values):
+        return({'count': 0})
+    summary = {'count': len(values),
+               'mean': sum(values) / len(values),
+               'min': values[0],
+               'max': values[-1]}
+    for p in PERCENTILES:
+        rank = max(int(math.ceil(p / 100. * len(values))), 1)
+        summary['p%d' % (p)] = values[rank - 1]
+    return(summary)
+
+def run_batch(rpc, workload, jobs, batch=None, timeout=BATCH_TIMEOUT):
+    """
+    Submit `jobs` calls of the `workload` function (see workloads.py) at once,
+    packed in batch requests of `batch` calls if not None (see
+    client.Batcher), and wait for them. Return the list of their futures.
+    """
+    submit = rpc.submit
+    if(batch):
+        batcher = rpc.batch(size=batch)
+        submit = batcher.submit
+    futures = []
+    for index in range(jobs):
+        (argv, kwds) = workload(index)
+        kwds['retries'] = 0
+        futures.append(submit('system', argv, kwds))
+    client.wait_all(futures, timeout=timeout)
+    return(futures)
+
+def measure(futures):
+    """
+    Return the measurements (see the module documentation) of the completed
+    `futures` of a batch. Calls which were cancelled or never ran, and thus
+    have no timings, only count as failed.
+    """
+    submit_to_start = []
+    end_to_reply = []
+    overhead = []
+    phases = {}
+    first_submit = min([f.submit_time for f in futures])
+    last_reply = first_submit
+    failed = 0
+    for future in futures:
+        try:
+            res = future.result()
+        except client.CancelledError:
+            res = None
+        if(not isinstance(res, dict) or res.get('exit_code') != 0):
+            failed += 1
+        if(not isinstance(res, dict) or not res.get('timings') or
+           res.get('start_time') is None or res.get('exec_time') is None):
+            continue
+        received = res['timings'][-1][2]
+        last_reply = max(last_reply, received)
+        end = res['start_time'] + res['exec_time']
+        submit_to_start.append(res['start_time'] - future.submit_time)
+        end_to_reply.append(received - end)
+        overhead.append(received - future.submit_time - res['exec_time'])
+        for (phase, start, stop) in res['timings']:
+            phases.setdefault(phase, []).append(stop - start)
+
+    elapsed = last_reply - first_submit
+    return({'jobs': len(futures),
+            'failed': failed,
+            'elapsed': elapsed,
+            'jobs_per_s': elapsed and len(futures) / elapsed or None,
+            'submit_to_start': stats(submit_to_start),
+            'end_to_reply': stats(end_to_reply),
+            'overhead': stats(overhead),
+            'phases': dict([(phase, stats(durations))
+                            for (phase, durations) in phases.items()])})
+
+def run(url, workloads=None, worker_counts=(1, ), jobs=100, slots=1,
+    warmup=10, log=os.devnull, batch=None, serializer=None):
+    """
+    Run each of the `workloads` (names, all of them by default) with each
+    number of workers in `worker_counts` against the broker `url`, starting
+    the local router if `url` is a local:// URL. Jobs are submitted in batches
+    of `batch` calls if not None, in the format `serializer` (see
+    client.RpcClient). Yield one record per run.
+    """
+    broker = None
+    if(local.is_local(url)):
+        broker = local.LocalBroker(url)
+        thread = threading.Thread(target=broker.serve_forever)
+        thread.daemon = True
+        thread.start()
+    try:
+        rpc = client.RpcClient(host=url, serializer=serializer)
+        for name in workloads or WORKLOADS.keys():
+            workload = WORKLOADS[name]
+            for count in worker_counts:
+                workers = WorkerProcesses(url, count, slots, broker, log)
+                workers.start(rpc)
+                try:
+                    if(warmup):
+                        run_batch(rpc, workload, warmup, batch)
+                    record = measure(run_batch(rpc, workload, jobs, batch))
+                finally:
+                    workers.stop()
+                record.update({'workload': name,
+                               'workers': count,
+                               'slots': slots,
+                               'batch': batch,
+                               'serializer': rpc.content_type,
+                               'broker': url,
+                               'hostname': platform.node(),
+                               'python': platform.python_version(),
+                               'time': time.time()})
+                yield record
+    finally:
+        if(broker is not None):
+            broker.stop()
+    return
@@ -0,0 +1,55 @@
+"""
+Synthetic workloads. Each one is a function of the job index returning the
+(argv, kwds) of a worker.system() call, and only relies on /bin/sh and the
+usual command line tools so that it runs on any worker.
+
+    noop    /bin/true: pure Spread overhead.
+    cpu     a busy shell loop of CPU_LOOPS iterations.
+    io      write and read back IO_MB MB in a temporary working directory.
+    argv    /bin/true with ARGV_COUNT arguments of ARGV_SIZE bytes each.
+    result  print RESULT_KB KB, captured and sent back in the result.
+"""
+import collections
+import tempfile
+
+
+
+
+# Constants
+CPU_LOOPS = 20000
+IO_MB = 16
+ARGV_COUNT = 1000
+ARGV_SIZE = 100
+RESULT_KB = 64
+
+
+
+
+def noop(index):
+    return(['/bin/true', ], {})
+
+def cpu(index):
+    loop = 'i=0; while [ $i -lt %d ]; do i=$((i+1)); done' % (CPU_LOOPS)
+    return(['/bin/sh', '-c', loop], {})
+
+def io(index):
+    script = 'dd if=/dev/zero of=bench.dat bs=1048576 count=%d 2>/dev/null ' \
+        '&& cat bench.dat > /dev/null' % (IO_MB)
+    return(['/bin/sh', '-c', script], {'root_dir': tempfile.gettempdir()})
+
+def argv(index):
+    return(['/bin/true', ] + ['%0*d' % (ARGV_SIZE, i)
+                              for i in range(ARGV_COUNT)], {})
+
+def result(index):
+    script = 'head -c %d /dev/zero | tr "\\000" x' % (RESULT_KB * 1024)
+    return(['/bin/sh', '-c', script], {'capture': RESULT_KB})
+
+
+
+
+WORKLOADS = collections.OrderedDict([('noop', noop),
+                                     ('cpu', cpu),
+                                     ('io', io),
+                                     ('argv', argv),
+                                     ('result', result)])
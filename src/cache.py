@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+Content-addressed cache of system() results.
+
+A job is identified by the hash of its argv, of the selected environment
+variables, of the content of its executable and of the content of its declared
+input files. If a job with the same key has already run successfully, its
+declared output files are restored from the cache and its result dictionary is
+returned instead of running it again (see worker.system).
+
+Entries live in <root>/<key>/ (result.json plus a copy of the outputs) and can
+be shared by all the workers of a shared filesystem. When the cache grows over
+`max_bytes`, the least recently used entries are evicted. Keys are hex digests,
+optionally prefixed by a user-chosen tag (<tag>.<digest>) so that all the
+entries of a given step can be invalidated at once:
+    shell> ./cache.py <root> invalidate processSif.
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+
+
+
+# Constants
+RESULT_FILE = 'result.json'
+OUTPUT_DIR = 'outputs'
+TMP_DIR = '.tmp'
+# After an eviction the cache is at most this fraction of max_bytes.
+EVICT_TO = .9
+TAG_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+# Entries of the result dictionary which only describe the run which stored
+# it: they are not stored (see ResultCache.put()).
+RUN_KEYS = ('hostname', 'pid', 'start_time', 'cwd')
+
+log = logging.getLogger('spread.cache')
+
+
+
+
+class ResultCache(object):
+    """
+    Result cache rooted at `root`, holding at most `max_bytes` bytes of output
+    files (no limit if None).
+    """
+    def __init__(self, root, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        if(not os.path.isdir(os.path.join(self.root, TMP_DIR))):
+            os.makedirs(os.path.join(self.root, TMP_DIR))
+
+        # {path: ((mtime, size, inode), digest)}: files are only hashed again
+        # if their stat signature changed.
+        self._digests = {}
+        # Running estimate of the cache size, computed lazily.
+        self._size = None
+        self._lock = threading.Lock()
+        return
+
+    def key(self, argv, environment, env_keys, inputs, cwd, tag=None):
+        """
+        Return the cache key of the command `argv` executed in `cwd` with the
+        given `environment`, of which only the variables in `env_keys` are
+        considered, and reading the files in `inputs` (paths relative to `cwd`
+        or absolute). Missing input files are part of the key as such.
+        """
+        executable = _which(argv[0], environment.get('PATH', ''), cwd)
+        description = {'argv': argv,
+                       'env': [(k, environment.get(k)) for k in
+                               sorted(env_keys or [])],
+                       'executable': self._digest(executable),
+                       'inputs': [(path,
+                                   self._digest(os.path.join(cwd, path)))
+                                  for path in inputs or []]}
+        digest = hashlib.sha1(json.dumps(description,
+                                         sort_keys=True)).hexdigest()
+        if(tag):
+            if(not TAG_RE.match(tag)):
+                raise ValueError('Invalid cache tag %s' % (tag))
+            return('%s.%s' % (tag, digest))
+        return(digest)
+
+    def get(self, key, cwd, outputs):
+        """
+        If `key` is in the cache, copy its output files to `cwd` and return
+        its result dictionary. Return None otherwise.
+        """
+        entry = os.path.join(self.root, key)
+        result_path = os.path.join(entry, RESULT_FILE)
+        try:
+            result = json.load(open(result_path))
+            for path in outputs or []:
+                dst = os.path.join(cwd, path)
+                if(not os.path.isdir(os.path.dirname(dst))):
+                    os.makedirs(os.path.dirname(dst))
+                shutil.copy2(os.path.join(entry, OUTPUT_DIR, _safe(path)), dst)
+            # Mark the entry as recently used.
+            os.utime(result_path, None)
+        except (IOError, OSError, ValueError):
+            return(None)
+        return(result)
+
+    def put(self, key, result, cwd, outputs):
+        """
+        Store `result`, without its RUN_KEYS entries, and a copy of the
+        `outputs` files (relative to `cwd`) under `key`. Entries are written
+        atomically and replace any existing entry of the same key (e.g. one
+        missing files): concurrent puts of the same key are harmless.
+        """
+        tmp = tempfile.mkdtemp(dir=os.path.join(self.root, TMP_DIR))
+        size = 0
+        try:
+            os.mkdir(os.path.join(tmp, OUTPUT_DIR))
+            for path in outputs or []:
+                dst = os.path.join(tmp, OUTPUT_DIR, _safe(path))
+                shutil.copy2(os.path.join(cwd, path), dst)
+                size += os.path.getsize(dst)
+            with open(os.path.join(tmp, RESULT_FILE), 'w') as f:
+                json.dump(dict([(k, v) for (k, v) in result.items()
+                                if k not in RUN_KEYS]), f)
+            self._replace(tmp, os.path.join(self.root, key))
+        except (IOError, OSError), e:
+            # Missing outputs or another put of the same key in the way.
+            log.warning('Could not cache %s: %s' % (key, e))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        if(self.max_bytes is not None):
+            with self._lock:
+                if(self._size is None):
+                    self._size = sum([s for (_, s, _) in self._entries()])
+                else:
+                    self._size += size
+                if(self._size > self.max_bytes):
+                    self._evict()
+        return
+
+    def invalidate(self, prefix=''):
+        """
+        Remove all the entries whose key starts with `prefix` (all of them if
+        `prefix` is empty). Return the number of entries removed.
+        """
+        removed = 0
+        for name in os.listdir(self.root):
+            if(name != TMP_DIR and name.startswith(prefix)):
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                removed += 1
+        with self._lock:
+            self._size = None
+        return(removed)
+
+    def _replace(self, tmp, entry):
+        """
+        Move the new entry `tmp` to `entry`. Directories cannot be renamed
+        over non empty ones: move the existing entry aside first.
+        """
+        try:
+            os.rename(tmp, entry)
+            return
+        except OSError, e:
+            if(e.errno not in (errno.EEXIST, errno.ENOTEMPTY)):
+                raise
+        log.debug('Replacing cache entry %s' % (entry))
+        old = tempfile.mkdtemp(dir=os.path.join(self.root, TMP_DIR))
+        try:
+            os.rename(entry, os.path.join(old, 'entry'))
+            os.rename(tmp, entry)
+        finally:
+            shutil.rmtree(old, ignore_errors=True)
+        return
+
+    def _entries(self):
+        """
+        Return the list of (last use time, size, path) of all the entries.
+        """
+        entries = []
+        for name in os.listdir(self.root):
+            if(name == TMP_DIR):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                used = os.path.getmtime(os.path.join(path, RESULT_FILE))
+                size = sum([os.path.getsize(os.path.join(path, OUTPUT_DIR, f))
+                            for f in os.listdir(os.path.join(path,
+                                                             OUTPUT_DIR))])
+            except OSError:
+                continue
+            entries.append((used, size, path))
+        return(entries)
+
+    def _evict(self):
+        # Rescan: other workers might share the same cache.
+        entries = sorted(self._entries())
+        self._size = sum([s for (_, s, _) in entries])
+        for (_, size, path) in entries:
+            if(self._size <= self.max_bytes * EVICT_TO):
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            self._size -= size
+        return
+
+    def _digest(self, path):
+        """
+        Return the SHA1 hex digest of the content of the file `path` or None if
+        it does not exist, hashing it only if its stat signature changed.
+        """
+        if(path is None):
+            return(None)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return(None)
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        with self._lock:
+            cached = self._digests.get(path)
+        if(cached is not None and cached[0] == signature):
+            return(cached[1])
+
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while(True):
+                block = f.read(1 << 20)
+                if(not block):
+                    break
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._digests[path] = (signature, digest)
+        return(digest)
+
+
+
+
+def _which(executable, path, cwd):
+    """
+    Return the path of `executable`, looked up in the `path` search path if it
+    has no directory component, or None if it cannot be found.
+    """
+    if(os.sep in executable):
+        return(os.path.join(cwd, executable))
+    for directory in path.split(os.pathsep):
+        candidate = os.path.join(cwd, directory, executable)
+        if(os.path.isfile(candidate) and os.access(candidate, os.X_OK)):
+            return(candidate)
+    return(None)
+
+def _safe(path):
+    """
+    Name under which the output file `path` is stored inside an entry.
+    """
+    if(isinstance(path, unicode)):
+        path = path.encode('utf-8')
+    return(hashlib.sha1(path).hexdigest())
+
+
+
+if(__name__ == '__main__'):
+    if(len(sys.argv) not in (3, 4) or sys.argv[2] != 'invalidate'):
+        print('Usage: cache.py <cache dir> invalidate [key prefix]')
+        sys.exit(1)
+    prefix = ''
+    if(len(sys.argv) == 4):
+        prefix = sys.argv[3]
+    n = ResultCache(sys.argv[1]).invalidate(prefix)
+    print('Removed %d entries.' % (n))
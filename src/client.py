@@ -1,20 +1,43 @@
 #!/usr/bin/env python
+import collections
+import itertools
 import json
+import os
 import sys
+import time
 import uuid
 
 import pika
 
+import local
+import serialization
+import staging
+
 
 
 # Constants
 QUEUE_NAME = 'rpc_queue'
+# Requests carry a priority between 0 (the default) and MAX_PRIORITY.
+MAX_PRIORITY = 10
+QUEUE_ARGUMENTS = {'x-max-priority': MAX_PRIORITY}
+# See worker.py.
+STATUS_EXCHANGE = 'spread_status'
+CONTROL_EXCHANGE = 'spread_control'
+# How often a Speculator looks for stragglers (seconds).
+SPECULATE_INTERVAL = .5
+# A Batcher publishes its calls once it has BATCH_SIZE of them or once the
+# first one has waited BATCH_WINDOW seconds.
+BATCH_SIZE = 100
+BATCH_WINDOW = .05
 
 
 class Singleton(type):
     """
     Singleton metaclass from http://stackoverflow.com/questions/31875/ \
         is-there-a-simple-elegant-way-to-define-singletons-in-python/33201#33201
+
+    Later calls return the existing instance, after passing their arguments to
+    its _reuse() method if it has one, e.g. to reject incompatible ones.
     """
     def __init__(cls, name, bases, dict):
         super(Singleton, cls).__init__(name, bases, dict)
@@ -23,31 +46,229 @@ class Singleton(type):
     def __call__(cls,*args,**kw):
         if cls.instance is None:
             cls.instance = super(Singleton, cls).__call__(*args, **kw)
+        elif hasattr(cls.instance, '_reuse'):
+            cls.instance._reuse(*args, **kw)
         return cls.instance
 
 
 
 
+class TimeoutError(Exception):
+    """
+    Raised when the results of remote calls are not in within the requested
+    timeout.
+    """
+    pass
+
+class CancelledError(Exception):
+    """
+    Raised when asking for the result of a cancelled call.
+    """
+    pass
+
+class RemoteError(Exception):
+    """
+    Returned by RpcFuture.exception() for calls which the workers failed to
+    run, with the 'error' of their result as message.
+    """
+    pass
+
+
+
+
+class RpcFuture(object):
+    """
+    Handle on the result of a single remote call. Futures are created by
+    RpcClient.submit() and are resolved by the client when the reply carrying
+    their correlation_id arrives on the callback queue.
+    """
+    def __init__(self, client, correlation_id):
+        self.client = client
+        self.correlation_id = correlation_id
+        self.submit_time = time.time()
+        # Where the staged output files of the call go (see staging.py).
+        self.stage_dir = None
+        self.response = None
+        self._done = False
+        self._cancelled = False
+        # Whether a worker is known to have started the call (see running()).
+        self._started = False
+        self._callbacks = []
+        # Output chunks streamed by the worker and not yet consumed.
+        self._output = collections.deque()
+        # Last heartbeat of the call and when we got it, once the client
+        # watches them (see RpcClient.watch_status()).
+        self.status = None
+        self.status_time = None
+        # What to publish to run the call again: (routing_key, headers,
+        # priority, request) and the correlation_ids of all its attempts (see
+        # RpcClient.speculate()).
+        self._message = None
+        self._attempts = [correlation_id, ]
+        return
+
+    def done(self):
+        return(self._done)
+
+    def is_ready(self):
+        return(self._done)
+
+    def wait(self):
+        """
+        Process whatever data events are pending on the client connection. Does
+        not block until the result is in: use result() for that.
+        """
+        if(not self._done):
+            self.client.process_events()
+        return
+
+    def running(self):
+        """
+        Return True if a worker is running the call. We only know that once it
+        sent a heartbeat (see RpcClient.watch_status()) or streamed output:
+        until then, and once the call is done, return False.
+        """
+        return(self._started and not self._done)
+
+    def cancelled(self):
+        return(self._cancelled)
+
+    def cancel(self):
+        """
+        Cancel the call: workers drop it if it is still queued and terminate
+        it if it is running (see worker.Worker.on_control()). Its result is
+        never reported: result() raises CancelledError. Return False if the
+        call was already done, True otherwise.
+        """
+        if(self._done):
+            return(self._cancelled)
+        self.client._forget(self)
+        if(self._attempts):
+            self.client.cancel(self._attempts)
+        self._cancelled = True
+        self._set_result(None)
+        return(True)
+
+    def run_time(self, now=None):
+        """
+        Return how long the call has been running for, according to its last
+        heartbeat, or None if we do not know that it is running.
+        """
+        if(self._done or self.status is None):
+            return(None)
+        if(now is None):
+            now = time.time()
+        return(self.status['elapsed'] + now - self.status_time)
+
+    def result(self, timeout=None):
+        """
+        Block until the reply for this call has arrived and return it. If
+        `timeout` is not None and the reply is not in after `timeout` seconds,
+        raise TimeoutError. Raise CancelledError if the call was cancelled.
+        """
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+        while(not self._done):
+            if(deadline is not None and time.time() >= deadline):
+                raise TimeoutError('No reply after %s s' % (timeout))
+            self.client.process_events()
+        if(self._cancelled):
+            raise CancelledError('Call %s cancelled' % (self.correlation_id))
+        return(self.response)
+
+    def exception(self, timeout=None):
+        """
+        Wait for the result (see result()) and return a RemoteError if the
+        workers could not run the call, i.e. if the result has an 'error', None
+        otherwise. Commands which ran and failed are not errors: their failure
+        is described by the exit_code and terminated values of the result.
+        """
+        response = self.result(timeout)
+        if(isinstance(response, dict) and response.get('error')):
+            return(RemoteError(response['error']))
+        return(None)
+
+    def output(self, timeout=None):
+        """
+        Iterate over the (name, data) chunks of output of a call submitted with
+        stream=True, name being either 'stdout' or 'stderr', as the command
+        writes them. The iteration ends when the call is done. If `timeout` is
+        not None and the call is not done after `timeout` seconds, raise
+        TimeoutError.
+        """
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+        while(True):
+            while(self._output):
+                yield self._output.popleft()
+            if(self._done):
+                break
+            if(deadline is not None and time.time() >= deadline):
+                raise TimeoutError('No reply after %s s' % (timeout))
+            self.client.process_events()
+        return
+
+    def add_done_callback(self, fn):
+        """
+        Invoke fn(future) once the reply has arrived (immediately if it already
+        has).
+        """
+        if(self._done):
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+        return
+
+    def _set_result(self, response):
+        self.response = response
+        self._done = True
+        callbacks = self._callbacks
+        self._callbacks = []
+        for fn in callbacks:
+            fn(self)
+        return
+
+
+
+
 class RpcClient(object):
     __metaclass__ = Singleton
     """
     Generic proxy for distributed PRC servers.
+
+    A single client multiplexes any number of outstanding calls over one
+    connection: every call gets its own correlation_id and RpcFuture and
+    replies on the callback queue are routed to the matching future.
     """
-    def __init__(self, host='localhost', fast=False):
+    def __init__(self, host='localhost', fast=False, serializer=None,
+        compress=None):
         """
         Connect to the broker, declare an exclusive queue to hold results of the
-        RPC calls and start consuming messages on that queue.
+        RPC calls and start consuming messages on that queue. `host` is either
+        the host name of the RabbitMQ broker or a local:// URL (see local.py).
+
+        Requests are sent in the format `serializer` ('json', the default,
+        'marshal' or a content type, see serialization.py) and compressed when
+        larger than `compress` bytes, if not None. Workers which predate these
+        formats only read uncompressed JSON. Results come back in the format of
+        the requests, compressed when large whatever `compress` is.
+
+        RpcClient is a singleton: later calls return the first client and
+        raise ValueError if they ask for another `serializer` or `compress`.
 
         fast=True implies turning off forcing the blocking connection to stop
         and look to see if there are any frames from RabbitMQ in the read buffer
         which means that the client is not expecting RPC commands from the
         broker (which is generally true for us).
         """
-        # Connect
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-                host=host))
+        # Connect, either to RabbitMQ or to the local router (see local.py).
+        self.connection = local.connect(host)
 
         self.channel = self.connection.channel()
+        self.content_type = serialization.content_type(serializer)
+        self.compress = compress
         self._fast = fast
         if(self._fast):
             self.channel.force_data_events(False)
@@ -59,67 +280,858 @@ class RpcClient(object):
         self.channel.basic_consume(self.on_response, no_ack=True,
                                    queue=self.callback_queue)
 
-        self.response = None
-        self._rpccall_id = None
+        # Outstanding calls: {correlation_id: RpcFuture}
+        self._pending = {}
+        # Staged input files the workers may fetch: {digest: path} and their
+        # description cache: {path: ((mtime, size, inode), digest, size)}
+        self._staged = {}
+        self._described = {}
+        # Staged output files being received: {(correlation_id, name): file}
+        self._incoming = {}
+        # Request queues we declared.
+        self._queues = set()
+        self._status_queue = None
+        self._control_declared = False
+        # Batchers with calls not published yet (see batch()).
+        self._batchers = set()
+        return
+
+    def _reuse(self, host='localhost', fast=False, serializer=None,
+        compress=None):
+        """
+        Called when the singleton is asked for again (see Singleton): make sure
+        that the request format does not silently differ from the one asked
+        for. None means whatever the client already uses.
+        """
+        if(serializer is not None and
+           serialization.content_type(serializer) != self.content_type):
+            raise ValueError('RpcClient already sends %s requests, not %s' \
+                % (self.content_type, serializer))
+        if(compress is not None and compress != self.compress):
+            raise ValueError('RpcClient already compresses requests larger ' + \
+                             'than %s bytes, not %s' % (self.compress, compress))
         return
 
     def on_response(self, ch, method, props, body):
-        if self._rpccall_id == props.correlation_id:
-            self.response = json.loads(body)
+        received = time.time()
+        if(props.headers and 'spread_fetch' in props.headers):
+            self._send_file(props)
+            return
+        if(props.headers and 'spread_file' in props.headers):
+            self._receive_file(props, body)
+            return
+        if(props.headers and 'spread_output' in props.headers):
+            future = self._pending.get(props.correlation_id)
+            if(future is not None):
+                future._started = True
+                future._output.append((props.headers['spread_output'], body))
+            return
+
+        if(props.headers and 'spread_batch' in props.headers):
+            # [[index, response], ...] of the calls of a batch (see batch()).
+            for (index, response) in serialization.decode(
+                    body, props.content_type, props.content_encoding):
+                self._resolve('%s.%d' % (props.correlation_id, index),
+                              response, props, received)
+            return
+        if(props.correlation_id in self._pending):
+            self._resolve(props.correlation_id,
+                          serialization.decode(body, props.content_type,
+                                               props.content_encoding),
+                          props, received)
         return
 
-    def is_ready(self):
-        return(self.response is not None)
+    def on_status(self, ch, method, props, body):
+        """
+        Remember the heartbeat of our running calls (see watch_status()).
+        """
+        status = json.loads(body)
+        future = self._pending.get(status.get('correlation_id'))
+        if(future is not None):
+            future._started = True
+            future.status = status
+            future.status_time = time.time()
+        return
 
-    def result(self):
-        return(self.response)
+    def pending(self):
+        """
+        Return the number of calls still waiting for a reply.
+        """
+        return(len(self._pending))
 
-    def wait(self):
-        if(self.response is None):
-            self.connection.process_data_events()
+    def process_events(self):
+        """
+        Process pending data events on the connection, dispatching any reply
+        received to its future. Calls still waiting in a Batcher are
+        published first: whoever processes events waits for results.
+        """
+        for batcher in list(self._batchers):
+            batcher.flush()
+        self.connection.process_data_events()
         return
 
-    def call(self, fn, argv, kwds):
-        _ = async_call(fn, argv, kwds, client=self)
-        while self.response is None:
-            self.connection.process_data_events()
-        return(self.response)
+    def submit(self, fn, argv=None, kwds=None, stage_dir=None, pool=None,
+        priority=None):
+        """
+        Publish the request fn(argv, **kwds) and return the RpcFuture which
+        will hold its result.
+
+        The request goes to the workers serving `pool` (see queue_name()), if
+        given, and overtakes the requests already queued there with a lower
+        `priority` (an integer between 0, the default, and MAX_PRIORITY).
+
+        If the workers do not share a filesystem with us, kwds can list the
+        local files to be sent to the worker in 'stage_in' (either paths,
+        which the job sees under their base name, or [path, name] pairs) and
+        the files to be sent back in 'stage_out' (paths relative to the job
+        working directory). These are written under `stage_dir` (the current
+        directory by default) before the future is resolved. Files are only
+        transferred while we process events, e.g. while waiting for results.
+
+        If kwds has 'stream' set to True, the worker captures the output of the
+        command and sends it as it is written: see RpcFuture.output().
+
+        Failed system() calls are retried kwds['retries'] times (see
+        worker.system) with an exponential backoff, preferably on another host.
+        The result of the last attempt has their number in 'attempts'.
+        """
+        if(argv is None):
+            argv = []
+        if(kwds is None):
+            kwds = {}
+        (kwds, headers) = self._stage(kwds)
+        if(kwds.get('retries') is not None):
+            # Recorded with the request in the dead letters (see worker.Worker).
+            headers['spread_max_attempts'] = str(int(kwds['retries']) + 1)
+
+        correlation_id = str(uuid.uuid4())
+        future = RpcFuture(self, correlation_id)
+        future.stage_dir = os.path.abspath(stage_dir or os.getcwd())
+        future._message = (self._queue(pool), headers, priority,
+                           [fn, argv, kwds])
+        self._pending[correlation_id] = future
+        self._publish_request(correlation_id, *future._message)
+        return(future)
+
+    def submit_array(self, fn, argv, kwds, ids, chunksize=None,
+        stage_dir=None, pool=None, priority=None):
+        """
+        Publish a single array request expanding into one fn(argv_i, **kwds_i)
+        call per element of `ids` (or of range(ids) if `ids` is an integer) and
+        return the list of their RpcFutures, in the same order as `ids`. See
+        system_array() for the details and submit() for file staging, pools
+        and priorities.
+        """
+        if(isinstance(ids, (int, long))):
+            count = ids
+            ids = None
+        else:
+            ids = list(ids)
+            count = len(ids)
+        if(kwds is None):
+            kwds = {}
+        (kwds, headers) = self._stage(kwds)
+        if(kwds.get('retries') is not None):
+            # Recorded with the request in the dead letters (see worker.Worker).
+            headers['spread_max_attempts'] = str(int(kwds['retries']) + 1)
+        headers['spread_array'] = '1'
+        stage_dir = os.path.abspath(stage_dir or os.getcwd())
 
+        # Element i replies with correlation_id <correlation_id>.<i>
+        correlation_id = str(uuid.uuid4())
+        futures = []
+        for index in xrange(count):
+            future = RpcFuture(self, '%s.%d' % (correlation_id, index))
+            future.stage_dir = stage_dir
+            self._pending[future.correlation_id] = future
+            futures.append(future)
+        if(not count):
+            return(futures)
 
+        # Elements are run again one by one, as single element arrays.
+        routing_key = self._queue(pool)
+        for (index, future) in enumerate(futures):
+            element = {'start': index, 'stop': index + 1, 'ids': None,
+                       'chunk': 1}
+            if(ids is not None):
+                element['ids'] = ids[index:index + 1]
+            future._message = (routing_key, headers, priority,
+                               [fn, argv, kwds, element])
 
+        array = {'start': 0, 'stop': count, 'ids': ids, 'chunk': chunksize}
+        self._publish_request(correlation_id, routing_key, headers, priority,
+                              [fn, argv, kwds, array])
+        return(futures)
+
+    def batch(self, size=BATCH_SIZE, window=BATCH_WINDOW, slots=None,
+        stage_dir=None, pool=None, priority=None):
+        """
+        Return a Batcher packing the calls submitted through it into batch
+        requests of at most `size` calls, run in at most `slots` execution
+        slots of a single worker. See Batcher and submit().
+        """
+        return(Batcher(self, size, window, slots, stage_dir, pool, priority))
+
+    def call(self, fn, argv=None, kwds=None, timeout=None):
+        """
+        Submit fn(argv, **kwds), wait for its result and return it. If
+        `timeout` is not None and the result is not in after `timeout`
+        seconds, cancel the call and raise TimeoutError.
+        """
+        future = self.submit(fn, argv, kwds)
+        try:
+            return(future.result(timeout))
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def speculate(self, future, avoid=None):
+        """
+        Publish a duplicate attempt of the call of `future` and return its
+        correlation_id. Whichever attempt replies first resolves the future
+        and the others are cancelled. Workers on the host `avoid`, if given
+        (e.g. where the call is straggling), pass the duplicate on to other
+        workers for a while (see worker.MAX_BOUNCES).
+        """
+        (routing_key, headers, priority, request) = future._message
+        headers = dict(headers)
+        if(avoid):
+            headers['spread_failed_on'] = avoid
+        correlation_id = str(uuid.uuid4())
+        attempt_id = correlation_id
+        if(len(request) == 4):
+            # Array element: it replies as <correlation_id>.<index>
+            attempt_id = '%s.%d' % (correlation_id, request[3]['start'])
+        future._attempts.append(attempt_id)
+        self._pending[attempt_id] = future
+        self._publish_request(correlation_id, routing_key, headers, priority,
+                              request)
+        return(attempt_id)
+
+    def cancel(self, correlation_ids):
+        """
+        Ask all the workers to drop or terminate the calls with the given
+        `correlation_ids` (see worker.Worker.on_control()). Use
+        RpcFuture.cancel() to also stop waiting for them.
+        """
+        if(not self._control_declared):
+            self.channel.exchange_declare(exchange=CONTROL_EXCHANGE,
+                                          exchange_type='fanout')
+            self._control_declared = True
+        self.channel.basic_publish(exchange=CONTROL_EXCHANGE,
+                                   routing_key='',
+                                   body=json.dumps({'cancel':
+                                                    list(correlation_ids)}))
+        return
+
+    def watch_status(self):
+        """
+        Start receiving the heartbeats of the running calls (see
+        worker.system()), which then show up in the `status` of their
+        futures. There is no way back: the heartbeats of all the calls of all
+        the clients are broadcast and we receive them as long as we live.
+        """
+        if(self._status_queue is not None):
+            return
+        self.channel.exchange_declare(exchange=STATUS_EXCHANGE,
+                                      exchange_type='fanout')
+        result = self.channel.queue_declare(exclusive=True)
+        self._status_queue = result.method.queue
+        self.channel.queue_bind(queue=self._status_queue,
+                                exchange=STATUS_EXCHANGE)
+        self.channel.basic_consume(self.on_status, no_ack=True,
+                                   queue=self._status_queue)
+        return
+
+    def _resolve(self, correlation_id, response, props, received):
+        """
+        Resolve the future of the attempt `correlation_id` with `response`,
+        received at time `received` in the message with properties `props`.
+        """
+        future = self._pending.pop(correlation_id, None)
+        if(future is None):
+            return
+        if(isinstance(response, dict) and 'timings' in response):
+            _add_client_timings(response['timings'], future.submit_time,
+                                props, received)
+        losers = [c for c in future._attempts if c != correlation_id]
+        if(losers):
+            # First come, first served: cancel the other attempts.
+            self._forget(future)
+            self.cancel(losers)
+            if(isinstance(response, dict)):
+                response['speculative'] = \
+                    correlation_id != future.correlation_id
+        future._set_result(response)
+        return
+
+    def _publish_request(self, correlation_id, routing_key, headers, priority,
+        request):
+        (body, content_type, content_encoding) = serialization.encode(
+            request, self.content_type, self.compress)
+        headers = dict(headers, **{serialization.ACCEPT_HEADER:
+                                   serialization.ZLIB})
+        self.channel.basic_publish(exchange='',
+                                   routing_key=routing_key,
+                                   properties=pika.BasicProperties(
+                                         reply_to = self.callback_queue,
+                                         correlation_id = correlation_id,
+                                         headers = headers,
+                                         priority = priority,
+                                         content_type = content_type,
+                                         content_encoding = content_encoding),
+                                   body=body)
+        return
+
+    def _queue(self, pool):
+        """
+        Return the name of the request queue of `pool`, declaring it the first
+        time so that requests are queued even before any worker serves it.
+        """
+        name = queue_name(pool)
+        if(name not in self._queues):
+            self.channel.queue_declare(queue=name, arguments=QUEUE_ARGUMENTS)
+            self._queues.add(name)
+        return(name)
+
+    def _stage(self, kwds):
+        """
+        Replace the 'stage_in' paths in `kwds` with the [name, digest, size]
+        of the files and remember where to find them. Return the new kwds and
+        the request headers.
+        """
+        if(not kwds.get('stage_in')):
+            return(kwds, {})
+        kwds = dict(kwds)
+        stage_in = []
+        for spec in kwds['stage_in']:
+            if(isinstance(spec, basestring)):
+                spec = (spec, os.path.basename(spec))
+            (path, name) = spec
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            signature = (st.st_mtime, st.st_size, st.st_ino)
+            described = self._described.get(path)
+            if(described is None or described[0] != signature):
+                described = (signature, ) + staging.describe(path)
+                self._described[path] = described
+            (_, digest, size) = described
+            self._staged[digest] = path
+            stage_in.append([name, digest, size])
+        kwds['stage_in'] = stage_in
+        headers = {'spread_stage': ','.join([d for (_, d, _) in stage_in])}
+        return(kwds, headers)
+
+    def _send_file(self, props):
+        """
+        Answer the fetch request of a worker by sending it the chunks of the
+        staged file props.correlation_id.
+        """
+        digest = props.correlation_id
+        path = self._staged.get(digest)
+        try:
+            if(path is None):
+                raise IOError('unknown file')
+            for (offset, data, last) in staging.read_chunks(path):
+                self._publish_chunk(props, data,
+                                    staging.chunk_headers(offset, last))
+        except (IOError, OSError), e:
+            self._publish_chunk(props, '', {'spread_error': str(e)})
+        return
+
+    def _publish_chunk(self, props, data, headers):
+        self.channel.basic_publish(exchange='',
+                                   routing_key=props.reply_to,
+                                   properties=pika.BasicProperties(
+                                         correlation_id = props.correlation_id,
+                                         headers = headers),
+                                   body=data)
+        return
+
+    def _receive_file(self, props, body):
+        """
+        Write a chunk of a staged output file under the stage_dir of its call.
+        The file appears there once complete.
+        """
+        future = self._pending.get(props.correlation_id)
+        if(future is None):
+            return
+        name = props.headers['spread_file']
+        path = os.path.join(future.stage_dir, name)
+        key = (props.correlation_id, name)
+        if(key not in self._incoming):
+            if(not os.path.isdir(os.path.dirname(path))):
+                os.makedirs(os.path.dirname(path))
+            # Attempts of the same call (see speculate()) may overlap.
+            self._incoming[key] = open('%s.%s.part' % (path,
+                                                       props.correlation_id),
+                                       'wb')
+        self._incoming[key].write(body)
+        if(props.headers['spread_last'] == '1'):
+            f = self._incoming.pop(key)
+            f.close()
+            os.rename(f.name, path)
+        return
+
+    def _forget(self, future):
+        """
+        Stop waiting for the replies of the attempts of `future` and remove
+        their partial staged output files.
+        """
+        for correlation_id in future._attempts:
+            self._pending.pop(correlation_id, None)
+            for key in [k for k in self._incoming if k[0] == correlation_id]:
+                f = self._incoming.pop(key)
+                f.close()
+                os.remove(f.name)
+        return
+
+
+
+
+def queue_name(pool=None):
+    """
+    Return the name of the request queue of the worker pool `pool` (see the
+    --pool option of worker.py). None is the default pool.
+    """
+    if(pool is None):
+        return(QUEUE_NAME)
+    return('%s.%s' % (QUEUE_NAME, pool))
+
+def system_array(argv_template, ids, chunksize=None, client=None,
+    host='localhost', fast=False, stage_dir=None, pool=None, priority=None,
+    **kwds):
+    """
+    Run one system() call for each element of `ids` (any list of JSON values,
+    or an integer n for range(n)) by publishing a single message, which the
+    workers split among themselves `chunksize` elements at a time (their number
+    of execution slots by default).
+
+    In `argv_template` and in the input, output and error keyword arguments,
+    %(index)d is replaced by the position of the element in `ids` and %(id)s
+    by the element itself; literal % have to be written as %%. Any other
+    keyword argument is passed to system() unchanged.
+
+    Return the list of RpcFutures of the individual calls, in the same order as
+    `ids`: results come back one by one as soon as each element is done.
+    """
+    if(client is None):
+        client = RpcClient(host=host, fast=fast)
+    return(client.submit_array('system', argv_template, kwds, ids, chunksize,
+                               stage_dir, pool, priority))
+
+def _add_client_timings(timings, submitted, props, received):
+    """
+    Complete the [phase, start, end] `timings` of a worker response with the
+    client side view: 'dispatch' (from submission to the worker picking the
+    request up: broker and queue time), 'reply' (from the end of the last
+    worker phase to the reply being published) and 'return' (from the reply
+    being published to it being received).
+    """
+    sent = received
+    if(props.headers and 'spread_sent' in props.headers):
+        sent = float(props.headers['spread_sent'])
+    if(timings):
+        first_start = timings[0][1]
+        last_end = timings[-1][2]
+    else:
+        first_start = last_end = sent
+    timings.insert(0, ['dispatch', submitted, first_start])
+    timings.append(['reply', last_end, sent])
+    timings.append(['return', sent, received])
+    return
 
 def async_call(fn, argv=None, kwds=None, client=None, host='localhost',
-    fast=False):
+    fast=False, pool=None, priority=None):
     """
     Invoke fn(*argv, **kwds) on the remote worker node, where kwds={'cwd': cwd}
     for now.
 
-    For the meaning of the fast flag, see the RpcClient documentation.
+    For the meaning of the fast flag, see the RpcClient documentation and for
+    `pool` and `priority` see RpcClient.submit().
 
-    Return an RpcClient instance. Remember that RpcClient implements the
-    Singleton pattern hence all instances are aliases to each other.
+    Return the RpcFuture for the call. Remember that RpcClient implements the
+    Singleton pattern hence all calls share the same connection: any number of
+    them can be outstanding at the same time.
     """
-    if(argv is None):
-        argv = []
-    if(kwds is None):
-        kwds = {}
-
     if(client is None):
         client = RpcClient(host=host, fast=fast)
+    return(client.submit(fn, argv, kwds, pool=pool, priority=priority))
+
+def as_completed(futures, timeout=None, speculate=None):
+    """
+    Yield the given RpcFutures as their replies come in, in completion order.
+    Futures which are already done are yielded first.
+
+    Rather than polling each future in turn, this drains the callback queue of
+    the client(s) the futures belong to and yields whatever got resolved, so
+    that the cost of each pass does not depend on the number of futures.
+
+    If `speculate` is True (or a Speculator), straggling calls are run again
+    on other workers, see Speculator.
+
+    If `timeout` is not None and not all futures are done `timeout` seconds
+    after the call, raise TimeoutError.
+    """
+    deadline = None
+    if(timeout is not None):
+        deadline = time.time() + timeout
+    if(speculate is True):
+        speculate = Speculator()
+
+    finished = collections.deque()
+    pending = set()
+    for future in set(futures):
+        if(future.done()):
+            finished.append(future)
+        else:
+            pending.add(future)
+            future.add_done_callback(finished.append)
+    clients = set([future.client for future in pending])
+    if(speculate):
+        speculate.start(futures)
+
+    while(finished or pending):
+        while(finished):
+            future = finished.popleft()
+            pending.discard(future)
+            yield future
+        if(not pending):
+            break
+
+        if(deadline is not None and time.time() >= deadline):
+            raise TimeoutError('%d calls still pending after %s s' \
+                % (len(pending), timeout))
+        if(speculate):
+            speculate.check(pending)
+        for client in clients:
+            client.process_events()
+    return
+
+def wait_all(futures, timeout=None, speculate=None):
+    """
+    Wait for all the given RpcFutures to be done and return the list of their
+    results, in the same order as `futures`. Raise CancelledError if any of
+    them was cancelled.
+
+    If `speculate` is True (or a Speculator), straggling calls are run again
+    on other workers, see Speculator.
+
+    If `timeout` is not None and not all futures are done `timeout` seconds
+    after the call, raise TimeoutError.
+    """
+    futures = list(futures)
+    for _ in as_completed(futures, timeout=timeout, speculate=speculate):
+        pass
+    return([future.result() for future in futures])
+
+
+
+
+class Speculator(object):
+    """
+    Straggler mitigation for a batch of calls (see as_completed()).
+
+    Once `quantile` of the calls of the batch are done, any call which has been
+    running for more than `factor` times the median exec_time of the completed
+    ones (and for at least `min_time` seconds) gets a duplicate attempt,
+    preferably on another host (see RpcClient.speculate()). The first attempt
+    to reply resolves the future, with 'speculative' set in the result if it
+    was the duplicate, and the other one is cancelled. Each call is duplicated
+    at most once and at most `max_duplicates` calls are.
+
+    Running times come from the heartbeats of the calls: calls submitted with
+    update_interval=0 are never duplicated.
+    """
+    def __init__(self, quantile=.75, factor=2., min_time=1.,
+        max_duplicates=None):
+        self.quantile = quantile
+        self.factor = factor
+        self.min_time = min_time
+        self.max_duplicates = max_duplicates
+        self.duplicated = 0
+
+        self._futures = []
+        self._next_check = 0
+        return
 
-    client.response = None
-    client._rpccall_id = str(uuid.uuid4())
-    client.channel.basic_publish(exchange='',
-                               routing_key=QUEUE_NAME,
-                               properties=pika.BasicProperties(
-                                     reply_to = client.callback_queue,
-                                     correlation_id = client._rpccall_id),
-                               body=json.dumps([fn, argv, kwds]))
-    return(client)
+    def start(self, futures):
+        """
+        Start tracking the batch `futures`.
+        """
+        self._futures = list(futures)
+        for client in set([future.client for future in self._futures]):
+            client.watch_status()
+        return
+
+    def check(self, pending):
+        """
+        Duplicate the stragglers among the `pending` futures of the batch.
+        Cheap enough to be called on every pass of the event loop: the actual
+        check only runs every SPECULATE_INTERVAL seconds.
+        """
+        now = time.time()
+        if(now < self._next_check):
+            return
+        self._next_check = now + SPECULATE_INTERVAL
+        size = len(self._futures)
+        if(size - len(pending) < max(self.quantile * size, 1)):
+            return
+
+        exec_times = sorted([future.response['exec_time']
+                             for future in self._futures
+                             if future.done() and
+                             isinstance(future.response, dict) and
+                             future.response.get('exec_time') is not None])
+        if(not exec_times):
+            return
+        threshold = max(self.factor * exec_times[len(exec_times) // 2],
+                        self.min_time)
+        for future in pending:
+            if(self.max_duplicates is not None and
+               self.duplicated >= self.max_duplicates):
+                break
+            run_time = future.run_time(now)
+            if(len(future._attempts) > 1 or run_time is None or
+               run_time < threshold):
+                continue
+            future.client.speculate(future, future.status.get('hostname'))
+            self.duplicated += 1
+        return
 
 
 
 
+class Batcher(object):
+    """
+    Pack many small calls into few messages: calls submitted through a Batcher
+    are published together, as one batch request, once there are `size` of
+    them or once the first one has waited `window` seconds (checked when
+    calls are submitted and whenever the client processes events, e.g. while
+    waiting for results, see RpcClient.process_events()). flush() publishes
+    them right away.
+
+    A single worker runs the calls of a batch, in at most `slots` of its
+    execution slots at the same time (all of them if None, one after the
+    other if 1), and replies once for the whole batch: results come back
+    together, once the slowest call of the batch is done. Each call still has its
+    own RpcFuture, correlation_id (<batch correlation_id>.<index>), retries
+    (a failed call is retried on its own), cancellation and speculation.
+    See RpcClient.submit() for `stage_dir`, `pool` and `priority`.
+    """
+    def __init__(self, client, size=BATCH_SIZE, window=BATCH_WINDOW,
+        slots=None, stage_dir=None, pool=None, priority=None):
+        self.client = client
+        self.size = max(int(size), 1)
+        self.window = window
+        self.slots = slots
+        self.stage_dir = os.path.abspath(stage_dir or os.getcwd())
+        self.pool = pool
+        self.priority = priority
+        # [(RpcFuture, request, headers), ...] not published yet.
+        self._calls = []
+        return
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+        return(False)
+
+    def submit(self, fn, argv=None, kwds=None):
+        """
+        Add the call fn(argv, **kwds) to the current batch and return its
+        RpcFuture.
+        """
+        if(argv is None):
+            argv = []
+        if(kwds is None):
+            kwds = {}
+        (kwds, headers) = self.client._stage(kwds)
+        if(kwds.get('retries') is not None):
+            headers['spread_max_attempts'] = str(int(kwds['retries']) + 1)
+        # The correlation_id is only known once the batch is published.
+        future = RpcFuture(self.client, None)
+        future.stage_dir = self.stage_dir
+        future._attempts = []
+        self._calls.append((future, [fn, argv, kwds], headers))
+        self.client._batchers.add(self)
+        if(len(self._calls) >= self.size or
+           time.time() - self._calls[0][0].submit_time >= self.window):
+            self.flush()
+        return(future)
+
+    def flush(self):
+        """
+        Publish the calls submitted since the last batch, if any.
+        """
+        calls = [c for c in self._calls if not c[0].cancelled()]
+        self._calls = []
+        self.client._batchers.discard(self)
+        if(not calls):
+            return
+
+        routing_key = self.client._queue(self.pool)
+        correlation_id = str(uuid.uuid4())
+        digests = []
+        for (index, (future, request, headers)) in enumerate(calls):
+            future.correlation_id = '%s.%d' % (correlation_id, index)
+            future._attempts = [future.correlation_id, ]
+            # Calls are run again one by one (see RpcClient.speculate()).
+            future._message = (routing_key, headers, self.priority, request)
+            self.client._pending[future.correlation_id] = future
+            for digest in headers.get('spread_stage', '').split(','):
+                if(digest and digest not in digests):
+                    digests.append(digest)
+        headers = {'spread_batch': str(self.slots or 0)}
+        max_attempts = [int(h['spread_max_attempts']) for (_, _, h) in calls
+                        if 'spread_max_attempts' in h]
+        if(max_attempts):
+            headers['spread_max_attempts'] = str(max(max_attempts))
+        if(digests):
+            headers['spread_stage'] = ','.join(digests)
+        self.client._publish_request(correlation_id, routing_key, headers,
+                                     self.priority,
+                                     [request for (_, request, _) in calls])
+        return
+
+
+
+
+class SpreadExecutor(object):
+    """
+    concurrent.futures-style executor running command lines on the Spread
+    workers via worker.system(). submit() returns RpcFutures whose result is
+    the system() result dictionary.
+
+    It has the interface of concurrent.futures.Executor but is not one: its
+    RpcFutures are only resolved while the client processes events, which the
+    concurrent.futures wait() and as_completed() functions never do. Wait for
+    them with as_completed() and wait_all() from this module instead.
+
+    At most `max_in_flight` calls are outstanding at any given time: submit()
+    blocks (processing replies) until a slot frees up. All the calls go to
+    `pool` with the given `priority` (see RpcClient.submit()). Any extra
+    keyword argument is used as default keyword argument for system() (e.g.
+    cwd, getenv, timeout).
+    """
+    def __init__(self, max_in_flight=1000, host='localhost', fast=False,
+        client=None, pool=None, priority=None, **kwds):
+        if(client is None):
+            client = RpcClient(host=host, fast=fast)
+        self.client = client
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.pool = pool
+        self.priority = priority
+        self.kwds = kwds
+
+        self._in_flight = set()
+        self._shutdown = False
+        return
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=True)
+        return(False)
+
+    def submit(self, fn, *args, **kwds):
+        """
+        Schedule the execution of the command line [fn] + args on the workers
+        and return its RpcFuture. `kwds` are passed to system(), overriding the
+        executor defaults.
+        """
+        if(self._shutdown):
+            raise RuntimeError('cannot schedule new calls after shutdown')
+
+        self._throttle(self.max_in_flight - 1)
+
+        system_kwds = dict(self.kwds)
+        system_kwds.update(kwds)
+        future = self.client.submit('system', [fn, ] + list(args), system_kwds,
+                                    pool=self.pool, priority=self.priority)
+        self._in_flight.add(future)
+        future.add_done_callback(self._in_flight.discard)
+        return(future)
+
+    def map(self, fn, *iterables, **kwds):
+        """
+        Return an iterator over the results of executing the command lines
+        [fn] + args for each args tuple taken from `iterables`, in order.
+
+        The arguments are consumed lazily, `chunksize` calls at a time, keeping
+        at most `max_in_flight` calls outstanding, so that arbitrarily long
+        iterables can be mapped. `timeout` (in seconds, from the map() call)
+        applies to the whole iteration and TimeoutError is raised if it
+        expires. Any other keyword argument is passed to system().
+        """
+        timeout = kwds.pop('timeout', None)
+        chunksize = max(int(kwds.pop('chunksize', 1)), 1)
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+
+        argv_iter = itertools.izip(*iterables)
+        window = collections.deque()
+        window_size = max(self.max_in_flight, chunksize)
+
+        def fill():
+            while(len(window) + chunksize <= window_size):
+                chunk = list(itertools.islice(argv_iter, chunksize))
+                for args in chunk:
+                    window.append(self.submit(fn, *args, **kwds))
+                if(len(chunk) < chunksize):
+                    break
+            return
+
+        def results():
+            fill()
+            while(window):
+                remaining = None
+                if(deadline is not None):
+                    remaining = max(deadline - time.time(), 0)
+                yield window.popleft().result(remaining)
+                fill()
+            return
+
+        # Like concurrent.futures, start submitting before the first next().
+        fill()
+        return(results())
+
+    def shutdown(self, wait=True, cancel_futures=False, timeout=None):
+        """
+        Refuse any further submission and, if `wait` is True, wait for all the
+        outstanding calls to complete. If `cancel_futures` is True, cancel them
+        instead. If `timeout` is not None and they are not done after `timeout`
+        seconds, raise TimeoutError.
+        """
+        self._shutdown = True
+        if(cancel_futures):
+            for future in list(self._in_flight):
+                future.cancel()
+        if(wait):
+            self._throttle(0, timeout)
+        return
+
+    def _throttle(self, limit, timeout=None):
+        """
+        Process replies until at most `limit` calls are outstanding. If
+        `timeout` is not None and there are still more after `timeout` seconds,
+        raise TimeoutError.
+        """
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+        while(len(self._in_flight) > limit):
+            if(deadline is not None and time.time() >= deadline):
+                raise TimeoutError('%d calls still pending after %s s' \
+                    % (len(self._in_flight), timeout))
+            self.client.process_events()
+        return
+
+
 
 
 if(__name__ == '__main__'):
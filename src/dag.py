@@ -0,0 +1,406 @@
+"""
+DAG workflows on top of Spread.
+
+A Dag is a set of nodes, each one a worker.system() call, with declared
+dependencies. A node is submitted as soon as all of its parents have completed
+successfully, so independent branches (and independent DAGs sharing the same
+RpcClient) proceed concurrently instead of stage by stage:
+
+    dag = Dag(cwd='/scratch/run1')
+    dag.add('mef', ['processMef.py', '-i', 'raw.fits', '-o', 'sif_%(ccdId)s'])
+    for i in range(60):
+        dag.add('sif%d' % i, ['processSif.py', ...], parents=['mef', ])
+    dag.add('finish', ['finishMef.py', ...],
+            parents=['sif%d' % i for i in range(60)])
+    dag.run()
+
+Nodes whose command fails (non 0 exit code or terminated) are marked FAILED and
+none of their descendants is run; the rest of the DAG proceeds as usual (this
+is what Condor DAGMan does) unless the DAG was created with
+abort_on_failure=True. Dag.abort() cancels the running nodes (see
+RpcFuture.cancel()) and skips the rest.
+
+A subset of the Condor DAGMan file syntax is understood by from_dagman():
+JOB (with a Condor submit description file), PARENT ... CHILD ..., SCRIPT
+PRE/POST, RETRY and VARS.
+"""
+import collections
+import os
+import shlex
+import time
+
+from client import RpcClient, TimeoutError
+
+
+
+
+# Constants
+# Node states.
+WAITING = 'waiting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+CANCELLED = 'cancelled'
+
+
+
+
+class Node(object):
+    """
+    A single worker.system(argv, **kwds) call in a Dag.
+    """
+    def __init__(self, name, argv, pool=None, priority=None, **kwds):
+        self.name = name
+        self.argv = argv
+        self.pool = pool
+        self.priority = priority
+        self.kwds = kwds
+        self.parents = set()
+        self.children = set()
+        self.state = WAITING
+        self.future = None
+        self.result = None
+        return
+
+    def __repr__(self):
+        return('<Node %s (%s)>' % (self.name, self.state))
+
+    def is_ready(self):
+        """
+        Return True if the node is waiting and all of its parents are done.
+        """
+        return(self.state == WAITING and
+               all([parent.state == DONE for parent in self.parents]))
+
+
+
+
+class Dag(object):
+    """
+    A workflow of worker.system() calls with dependencies.
+
+    `max_jobs`, if not None, is the maximum number of nodes of this DAG which
+    are submitted at any given time. `pool` and `priority` are the default
+    worker pool and priority of the nodes (see RpcClient.submit()). If
+    `abort_on_failure` is True, the first node to fail aborts the whole DAG
+    (see abort()). Any extra keyword argument is used as default keyword
+    argument for the system() calls of the nodes (e.g. cwd, getenv).
+    """
+    def __init__(self, name=None, client=None, host='localhost', fast=False,
+        max_jobs=None, pool=None, priority=None, abort_on_failure=False,
+        **kwds):
+        if(client is None):
+            client = RpcClient(host=host, fast=fast)
+        self.name = name
+        self.client = client
+        self.max_jobs = max_jobs
+        self.pool = pool
+        self.priority = priority
+        self.abort_on_failure = abort_on_failure
+        self.kwds = kwds
+
+        self.nodes = collections.OrderedDict()
+        self._ready = collections.deque()
+        self._running = 0
+        self._started = False
+        return
+
+    def __repr__(self):
+        return('<Dag %s (%d nodes)>' % (self.name, len(self.nodes)))
+
+    def add(self, name, argv, parents=None, **kwds):
+        """
+        Add the node `name` executing system(argv, **kwds) once all the nodes
+        named in `parents` are done. `kwds` can also override the DAG `pool`
+        and `priority`. Return the new Node.
+        """
+        if(self._started):
+            raise RuntimeError('Cannot add nodes to a running DAG')
+        if(name in self.nodes):
+            raise ValueError('Duplicate node name %s' % (name))
+
+        node_kwds = dict(self.kwds, pool=self.pool, priority=self.priority)
+        node_kwds.update(kwds)
+        node = Node(name, argv, **node_kwds)
+        self.nodes[name] = node
+        for parent in parents or []:
+            self.add_dependency(parent, name)
+        return(node)
+
+    def add_dependency(self, parent, child):
+        """
+        Make node `child` depend on node `parent` (both given by name).
+        """
+        try:
+            parent = self.nodes[parent]
+            child = self.nodes[child]
+        except KeyError, e:
+            raise ValueError('Unknown node %s' % (e.args[0]))
+        parent.children.add(child)
+        child.parents.add(parent)
+        return
+
+    def start(self):
+        """
+        Check that the DAG has no cycles and submit all the nodes which have
+        no parents. The rest of the nodes get submitted as replies come in: see
+        run() and run_dags().
+        """
+        if(self._started):
+            return
+        self._check_acyclic()
+        self._started = True
+        for node in self.nodes.values():
+            if(node.is_ready()):
+                self._ready.append(node)
+        self._submit_ready()
+        return
+
+    def finished(self):
+        """
+        Return True if no node is running or can still be run.
+        """
+        return(self._started and not self._ready and self._running == 0)
+
+    def ok(self):
+        """
+        Return True if all the nodes have been run successfully.
+        """
+        return(all([node.state == DONE for node in self.nodes.values()]))
+
+    def failed(self):
+        """
+        Return the list of failed nodes.
+        """
+        return([node for node in self.nodes.values() if node.state == FAILED])
+
+    def abort(self):
+        """
+        Cancel the running nodes, which end up CANCELLED, and skip all the
+        nodes which have not been submitted yet.
+        """
+        self._ready.clear()
+        for node in self.nodes.values():
+            if(node.state == WAITING):
+                node.state = SKIPPED
+        for node in self.nodes.values():
+            if(node.state == RUNNING):
+                node.future.cancel()
+        return
+
+    def run(self, timeout=None):
+        """
+        Run the DAG to completion. Return True if all of its nodes succeeded.
+        See run_dags() for the meaning of `timeout`.
+        """
+        run_dags([self, ], timeout=timeout)
+        return(self.ok())
+
+    def _check_acyclic(self):
+        # Kahn's algorithm: every node must eventually have all its parents
+        # visited.
+        indegree = dict([(node, len(node.parents))
+                         for node in self.nodes.values()])
+        roots = [node for (node, n) in indegree.items() if n == 0]
+        visited = 0
+        while(roots):
+            node = roots.pop()
+            visited += 1
+            for child in node.children:
+                indegree[child] -= 1
+                if(indegree[child] == 0):
+                    roots.append(child)
+        if(visited != len(self.nodes)):
+            raise ValueError('DAG %s has cycles' % (self.name))
+        return
+
+    def _submit_ready(self):
+        while(self._ready and
+              (self.max_jobs is None or self._running < self.max_jobs)):
+            node = self._ready.popleft()
+            node.state = RUNNING
+            self._running += 1
+            node.future = self.client.submit('system', node.argv, node.kwds,
+                                             pool=node.pool,
+                                             priority=node.priority)
+            node.future.add_done_callback(
+                lambda future, node=node: self._on_done(node, future))
+        return
+
+    def _on_done(self, node, future):
+        self._running -= 1
+        if(future.cancelled()):
+            node.state = CANCELLED
+            self._skip_descendants(node)
+            return
+        node.result = res = future.result()
+        if(res.get('terminated') or res.get('exit_code') != 0):
+            node.state = FAILED
+            self._skip_descendants(node)
+            if(self.abort_on_failure):
+                self.abort()
+        else:
+            node.state = DONE
+            for child in node.children:
+                if(child.is_ready()):
+                    self._ready.append(child)
+        self._submit_ready()
+        return
+
+    def _skip_descendants(self, node):
+        for child in node.children:
+            if(child.state == WAITING):
+                child.state = SKIPPED
+                self._skip_descendants(child)
+        return
+
+
+
+
+def run_dags(dags, timeout=None):
+    """
+    Run all the given DAGs concurrently to completion, sharing the replies of
+    their clients. If `timeout` is not None and the DAGs are not finished after
+    `timeout` seconds, raise TimeoutError (the nodes already submitted keep
+    running unless the DAGs are aborted, see Dag.abort()).
+    """
+    deadline = None
+    if(timeout is not None):
+        deadline = time.time() + timeout
+
+    for dag in dags:
+        dag.start()
+    clients = set([dag.client for dag in dags])
+    while(not all([dag.finished() for dag in dags])):
+        if(deadline is not None and time.time() >= deadline):
+            raise TimeoutError('DAGs still running after %s s' % (timeout))
+        for client in clients:
+            client.process_events()
+    return
+
+
+
+
+def from_dagman(path, name=None, **kwds):
+    """
+    Build a Dag from the Condor DAGMan file `path`. `name` defaults to the file
+    name, `kwds` are passed to the Dag constructor.
+
+    Supported statements (keywords are case insensitive):
+        JOB <name> <submit file> [DIR <directory>]
+        PARENT <name> ... CHILD <name> ...
+        SCRIPT PRE|POST <name> <executable>
+        RETRY <name> <retries>
+        VARS <name> <macro>="<value>" ...
+
+    Submit description files are read for executable, arguments, input,
+    output, error, initialdir, getenv and environment; $(macro) references are
+    expanded using the node VARS. PRE/POST scripts receive a minimal ClassAd
+    describing the node on STDIN, as worker.system() does. Relative paths are
+    relative to the directory of the DAGMan file.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    if(name is None):
+        name = os.path.basename(path)
+
+    jobs = collections.OrderedDict()
+    edges = []
+    for line in open(path):
+        line = line.strip()
+        if(not line or line.startswith('#')):
+            continue
+        tokens = shlex.split(line, posix=False)
+        keyword = tokens[0].upper()
+
+        if(keyword == 'JOB'):
+            job_dir = base_dir
+            if(len(tokens) >= 5 and tokens[3].upper() == 'DIR'):
+                job_dir = os.path.join(base_dir, tokens[4])
+            jobs[tokens[1]] = {'submit': os.path.join(job_dir, tokens[2]),
+                               'dir': job_dir,
+                               'vars': {},
+                               'kwds': {}}
+        elif(keyword == 'PARENT'):
+            i = [t.upper() for t in tokens].index('CHILD')
+            for parent in tokens[1:i]:
+                for child in tokens[i+1:]:
+                    edges.append((parent, child))
+        elif(keyword == 'SCRIPT'):
+            when = tokens[1].upper()
+            if(when not in ('PRE', 'POST')):
+                raise ValueError('Unsupported SCRIPT type %s' % (tokens[1]))
+            job = _dagman_job(jobs, tokens[2])
+            job['kwds'][when.lower() + '_proc'] = \
+                os.path.join(job['dir'], tokens[3])
+        elif(keyword == 'RETRY'):
+            _dagman_job(jobs, tokens[1])['kwds']['retries'] = int(tokens[2])
+        elif(keyword == 'VARS'):
+            job = _dagman_job(jobs, tokens[1])
+            for token in tokens[2:]:
+                (key, value) = token.split('=', 1)
+                job['vars'][key] = value.strip('"')
+        else:
+            raise ValueError('Unsupported DAGMan statement %s' % (tokens[0]))
+
+    dag = Dag(name=name, **kwds)
+    for (job_name, job) in jobs.items():
+        (argv, node_kwds) = _parse_submit(job['submit'], job['vars'],
+                                          job['dir'])
+        node_kwds.update(job['kwds'])
+        if('pre_proc' in node_kwds or 'post_proc' in node_kwds):
+            node_kwds['classad'] = 'DAGNodeName="%s"\nCmd="%s"\n' \
+                % (job_name, argv[0])
+        dag.add(job_name, argv, **node_kwds)
+    for (parent, child) in edges:
+        dag.add_dependency(parent, child)
+    return(dag)
+
+def _dagman_job(jobs, name):
+    try:
+        return(jobs[name])
+    except KeyError:
+        raise ValueError('Unknown DAGMan job %s' % (name))
+
+def _parse_submit(path, macros, job_dir):
+    """
+    Parse the Condor submit description file `path` and return the (argv,
+    kwds) of the equivalent worker.system() call.
+    """
+    desc = {}
+    for line in open(path):
+        line = line.strip()
+        if(not line or line.startswith('#') or '=' not in line):
+            # Comments, blank lines and the queue statement.
+            continue
+        (key, value) = line.split('=', 1)
+        value = value.strip()
+        for (macro, macro_value) in macros.items():
+            value = value.replace('$(%s)' % (macro), macro_value)
+        desc[key.strip().lower()] = value
+
+    if('executable' not in desc):
+        raise ValueError('No executable in submit file %s' % (path))
+    arguments = desc.get('arguments', '')
+    if(len(arguments) >= 2 and arguments[0] == arguments[-1] == '"'):
+        # New syntax: the whole argument list is double quoted.
+        arguments = arguments[1:-1]
+    argv = [os.path.join(job_dir, desc['executable']), ] + \
+        shlex.split(arguments)
+
+    kwds = {'cwd': os.path.normpath(os.path.join(job_dir,
+                                                 desc.get('initialdir', '')))}
+    for key in ('input', 'output', 'error'):
+        if(key in desc):
+            kwds[key] = desc[key]
+    if('getenv' in desc):
+        kwds['getenv'] = desc['getenv'].lower() in ('true', 'yes', '1')
+    if('environment' in desc):
+        env = desc['environment'].strip('"')
+        if(';' in env):
+            items = env.split(';')
+        else:
+            items = shlex.split(env)
+        kwds['environment'] = dict([item.split('=', 1)
+                                    for item in items if '=' in item])
+    return(argv, kwds)
@@ -0,0 +1,336 @@
+"""
+Warm Python job runner.
+
+Starting a Python script means paying for interpreter startup and for importing
+its modules (seconds for numpy/astropy heavy code) on every single job. A
+ForkServer is a process, forked by the worker before it starts its slot
+threads, which imports a set of modules once and then forks a child for each
+job. The child calls a registered entry point ("module:function", invoked with
+no arguments and sys.argv set to the job argv, just like setuptools console
+scripts) and exits with its return value as exit code.
+
+The jobs are children of the fork server, which reaps them with wait4() and
+reports their exit status and resource usage back to the worker. ForkedChild
+objects have the same interface as the (process, waiter) pair used by
+worker._exec(), so timeouts, SIGTERM/SIGKILL escalation and the result
+dictionary are the same as for regular processes.
+"""
+import collections
+import errno
+import fcntl
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+
+
+
+# Constants
+RUSAGE_FIELDS = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_minflt', 'ru_majflt',
+                 'ru_nvcsw', 'ru_nivcsw', 'ru_inblock', 'ru_oublock')
+Rusage = collections.namedtuple('Rusage', RUSAGE_FIELDS)
+
+
+
+
+class ForkedChild(object):
+    """
+    A job running in a child of the fork server. Acts both as the process
+    (pid, returncode, terminate(), kill()) and as its waiter (wait(), close(),
+    status, rusage).
+    """
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.proc = self
+        self.pid = None
+        self.returncode = None
+        self.status = 0
+        self.rusage = None
+        self.error = None
+        self._started = threading.Event()
+        self._rfd, self._wfd = os.pipe()
+        return
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+        return
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+        return
+
+    def _signal(self, signum):
+        if(self.returncode is None):
+            try:
+                os.kill(self.pid, signum)
+            except OSError:
+                pass
+        return
+
+    def _set_started(self, pid, error=None):
+        self.pid = pid
+        self.error = error
+        self._started.set()
+        return
+
+    def _set_exited(self, status, rusage):
+        self.status = status
+        self.rusage = rusage
+        if(os.WIFSIGNALED(status)):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        os.write(self._wfd, 'x')
+        return
+
+    def wait(self, timeout=None):
+        """
+        Wait for the job to exit for at most `timeout` seconds (forever if
+        None). Return True if it did, False otherwise.
+        """
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+        while(True):
+            remaining = None
+            if(deadline is not None):
+                remaining = max(deadline - time.time(), 0)
+            try:
+                ready, _, _ = select.select([self._rfd, ], [], [], remaining)
+            except select.error, e:
+                if(e.args[0] == errno.EINTR):
+                    continue
+                raise
+            if(ready):
+                return(True)
+            if(deadline is not None):
+                return(False)
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+        return
+
+
+
+
+class ForkServer(object):
+    """
+    Worker side handle on the fork server process. Fork it before starting any
+    thread. spawn() is thread safe.
+    """
+    def __init__(self, preload=()):
+        (sock, server_sock) = socket.socketpair()
+        self.pid = os.fork()
+        if(self.pid == 0):
+            sock.close()
+            code = 0
+            try:
+                _serve(server_sock, preload)
+            except:
+                traceback.print_exc()
+                code = 1
+            os._exit(code)
+        server_sock.close()
+
+        self.sock = sock
+        self._next_id = 0
+        self._children = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+        self._reader.start()
+        return
+
+    def spawn(self, entry_point, argv, stdin_str, stdout_filename,
+        stderr_filename, environment, cwd):
+        """
+        Run `entry_point` ("module:function") in a new child with sys.argv set
+        to `argv`. Return its ForkedChild once the child has been forked.
+        Raise OSError if the fork server could not start it.
+        """
+        with self._lock:
+            self._next_id += 1
+            child = ForkedChild(self._next_id)
+            self._children[child.request_id] = child
+            request = {'id': child.request_id,
+                       'entry_point': entry_point,
+                       'argv': argv,
+                       'stdin': stdin_str,
+                       'stdout': stdout_filename,
+                       'stderr': stderr_filename,
+                       'env': dict(environment),
+                       'cwd': cwd}
+            self.sock.sendall(json.dumps(request) + '\n')
+        child._started.wait()
+        if(child.error):
+            child.close()
+            raise OSError(child.error)
+        return(child)
+
+    def _read(self):
+        reader = self.sock.makefile('rb')
+        while(True):
+            line = reader.readline()
+            if(not line):
+                break
+            message = json.loads(line)
+            with self._lock:
+                child = self._children.get(message['id'])
+                if(message['event'] != 'started' or message.get('error')):
+                    self._children.pop(message['id'], None)
+            if(child is None):
+                continue
+            if(message['event'] == 'started'):
+                child._set_started(message.get('pid'), message.get('error'))
+            else:
+                child._set_exited(message['status'],
+                                  Rusage(*message['rusage']))
+
+        # The fork server is gone: consider all of its jobs as killed.
+        with self._lock:
+            children = self._children.values()
+            self._children = {}
+        for child in children:
+            child._set_started(child.pid, 'Fork server exited')
+            child._set_exited(signal.SIGKILL, None)
+        return
+
+
+
+
+def _serve(sock, preload):
+    """
+    Main loop of the fork server process: fork a child for each request read
+    from `sock` and report its pid, and later its exit status, back.
+    """
+    for module in preload:
+        importlib.import_module(module)
+
+    # SIGCHLD wakes up select() through the wakeup pipe.
+    (wakeup_r, wakeup_w) = os.pipe()
+    for fd in (wakeup_r, wakeup_w):
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    # {pid: request id}
+    children = {}
+    buf = ''
+    while(True):
+        try:
+            ready, _, _ = select.select([sock, wakeup_r], [], [])
+        except select.error, e:
+            if(e.args[0] == errno.EINTR):
+                continue
+            raise
+
+        if(wakeup_r in ready):
+            try:
+                os.read(wakeup_r, 4096)
+            except OSError:
+                pass
+            _reap(sock, children)
+
+        if(sock in ready):
+            data = sock.recv(1 << 16)
+            if(not data):
+                # The worker went away.
+                return
+            buf += data
+            while('\n' in buf):
+                (line, buf) = buf.split('\n', 1)
+                request = json.loads(line)
+                message = {'event': 'started', 'id': request['id']}
+                try:
+                    pid = os.fork()
+                except OSError, e:
+                    message['error'] = str(e)
+                else:
+                    if(pid == 0):
+                        sock.close()
+                        _run_child(request)
+                    children[pid] = request['id']
+                    message['pid'] = pid
+                sock.sendall(json.dumps(message) + '\n')
+    return
+
+def _reap(sock, children):
+    while(children):
+        try:
+            (pid, status, rusage) = os.wait4(-1, os.WNOHANG)
+        except OSError, e:
+            if(e.errno == errno.EINTR):
+                continue
+            return
+        if(pid == 0):
+            return
+        request_id = children.pop(pid, None)
+        if(request_id is None):
+            continue
+        message = {'event': 'exited',
+                   'id': request_id,
+                   'status': status,
+                   'rusage': [getattr(rusage, f) for f in RUSAGE_FIELDS]}
+        sock.sendall(json.dumps(message) + '\n')
+    return
+
+def _run_child(request):
+    """
+    Body of a job child: set up cwd, environment and redirections, call the
+    entry point and exit. Never returns.
+    """
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if(request['stdin']):
+            stdin = tempfile.TemporaryFile()
+            stdin.write(request['stdin'])
+            stdin.seek(0)
+            os.dup2(stdin.fileno(), 0)
+        for (key, fd) in (('stdout', 1), ('stderr', 2)):
+            if(request[key]):
+                try:
+                    out = os.open(request[key],
+                                  os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+                except OSError:
+                    continue
+                os.dup2(out, fd)
+                os.close(out)
+
+        (module, function) = request['entry_point'].split(':', 1)
+        sys.argv = [str(arg) for arg in request['argv']]
+        fn = getattr(importlib.import_module(module), function)
+        code = fn()
+    except SystemExit, e:
+        code = e.code
+    except:
+        traceback.print_exc()
+        code = 1
+
+    if(code is None):
+        code = 0
+    elif(not isinstance(code, (int, long))):
+        sys.stderr.write('%s\n' % (code))
+        code = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
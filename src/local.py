@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+"""
+Brokerless single-machine transport.
+
+Instead of RabbitMQ, clients and workers on the same machine can talk to a tiny
+message router listening on a Unix domain socket. Everywhere a broker host name
+is accepted, a URL of the form
+
+    local:///path/to/socket     (or just local:// for DEFAULT_PATH)
+
+selects this transport. The router only implements what Spread needs: named
+queues (exclusive ones are deleted together with their connection), the default
+exchange, direct and fanout exchanges, priority queues (x-max-priority), per
+message expiration with dead lettering (x-dead-letter-exchange and
+x-dead-letter-routing-key), per-connection prefetch, consumer cancellation,
+acknowledgements and redelivery of the unacknowledged messages of connections
+which go away.
+
+On the client side, BlockingConnection mimics the subset of the pika
+BlockingConnection/BlockingChannel API used by client.py and worker.py, so that
+connect() can return either one transparently.
+
+Start the router with
+    shell> ./local.py [local:///path/to/socket]
+or let start_workers.py start it for you.
+"""
+import collections
+import errno
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import tempfile
+import time
+import uuid
+
+import pika
+import pika.exceptions
+
+
+
+
+# Constants
+SCHEME = 'local://'
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'spread-%d.sock' % os.getuid())
+# Frames are: header length, body length, JSON header, raw body.
+FRAME_HEADER = struct.Struct('!II')
+# Maximum time process_data_events() blocks waiting for data (like pika).
+SOCKET_TIMEOUT = .25
+# Message properties carried through the router.
+PROPERTIES = ('content_type', 'content_encoding', 'headers', 'delivery_mode',
+              'priority', 'correlation_id', 'reply_to', 'expiration',
+              'message_id', 'timestamp', 'type', 'user_id', 'app_id')
+
+
+
+
+def is_local(host):
+    return(host.startswith(SCHEME))
+
+def socket_path(url):
+    """
+    Return the path of the Unix domain socket described by the local:// `url`.
+    """
+    path = url[len(SCHEME):]
+    if(not path):
+        return(DEFAULT_PATH)
+    return(path)
+
+def connect(host):
+    """
+    Connect to the message broker on `host`, which is either a host name where
+    RabbitMQ is running or a local:// URL. Return a blocking connection.
+    """
+    if(is_local(host)):
+        return(BlockingConnection(host))
+    return(pika.BlockingConnection(pika.ConnectionParameters(host=host)))
+
+def _encode_frame(header, body=''):
+    header = json.dumps(header)
+    return(FRAME_HEADER.pack(len(header), len(body)) + header + body)
+
+def _decode_frames(buf):
+    """
+    Remove the complete frames at the start of the bytearray `buf` and return
+    them as a list of (header, body). Incomplete frames are left in `buf` to be
+    completed by the next data received: reading a large message thus takes
+    time linear in its size, whatever the number of reads.
+    """
+    frames = []
+    offset = 0
+    while(len(buf) - offset >= FRAME_HEADER.size):
+        (header_len, body_len) = FRAME_HEADER.unpack_from(buf, offset)
+        end = offset + FRAME_HEADER.size + header_len + body_len
+        if(len(buf) < end):
+            break
+        start = offset + FRAME_HEADER.size
+        header = json.loads(str(buf[start:start + header_len]))
+        frames.append((header, str(buf[start + header_len:end])))
+        offset = end
+    del buf[:offset]
+    return(frames)
+
+def _props_to_dict(properties):
+    if(properties is None):
+        return({})
+    return(dict([(name, getattr(properties, name, None))
+                 for name in PROPERTIES
+                 if getattr(properties, name, None) is not None]))
+
+
+
+
+class BasicProperties(object):
+    """
+    Message properties as delivered to consumers (same attributes as
+    pika.BasicProperties).
+    """
+    def __init__(self, **kwds):
+        for name in PROPERTIES:
+            setattr(self, name, kwds.get(name))
+        return
+
+
+
+
+class Method(object):
+    """
+    Stand-in for the pika Basic.Deliver and Queue.DeclareOk method frames.
+    """
+    def __init__(self, **kwds):
+        self.__dict__.update(kwds)
+        return
+
+
+
+
+class _Frame(object):
+    def __init__(self, method):
+        self.method = method
+        return
+
+
+
+
+class BlockingConnection(object):
+    """
+    Connection to the local router, with a single channel (itself).
+    """
+    def __init__(self, url=SCHEME):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(socket_path(url))
+        self.is_open = True
+        self._buffer = bytearray()
+        self._consumers = {}
+        # Deliveries received while waiting for a synchronous reply (see
+        # queue_declare()), to be dispatched by process_data_events().
+        self._frames = collections.deque()
+        return
+
+    # Connection API.
+    def channel(self):
+        return(self)
+
+    def close(self):
+        if(self.is_open):
+            self.is_open = False
+            self.socket.close()
+        return
+
+    def process_data_events(self):
+        """
+        Wait at most SOCKET_TIMEOUT seconds for data from the router and
+        dispatch every complete message received to its consumer callback.
+        """
+        if(not self._frames):
+            self._frames.extend(self._read_frames(SOCKET_TIMEOUT))
+        while(self._frames):
+            (header, body) = self._frames.popleft()
+            callback = self._consumers.get(header['consumer_tag'])
+            if(callback is None):
+                continue
+            method = Method(consumer_tag=header['consumer_tag'],
+                            delivery_tag=header['delivery_tag'],
+                            redelivered=header['redelivered'],
+                            exchange=header['exchange'],
+                            routing_key=header['routing_key'])
+            callback(self, method, BasicProperties(**header['properties']),
+                     body)
+        return
+
+    def _read_frames(self, timeout):
+        """
+        Wait at most `timeout` seconds for data from the router and return the
+        list of the (header, body) frames completed by it.
+        """
+        try:
+            ready, _, _ = select.select([self.socket, ], [], [], timeout)
+        except select.error, e:
+            if(e.args[0] == errno.EINTR):
+                return([])
+            raise
+        if(not ready):
+            return([])
+
+        data = self.socket.recv(1 << 16)
+        if(not data):
+            self.close()
+            raise IOError('Connection to the local router closed')
+        self._buffer.extend(data)
+        return(_decode_frames(self._buffer))
+
+    # Channel API.
+    def force_data_events(self, enable):
+        return
+
+    def queue_declare(self, queue='', passive=False, durable=False,
+        exclusive=False, auto_delete=False, nowait=False, arguments=None):
+        """
+        Declare `queue`, without waiting for the router. A `passive` declare
+        only waits for the message_count and consumer_count of the queue
+        instead and raises ChannelClosed if it does not exist, like RabbitMQ.
+        """
+        if(not queue):
+            queue = 'amq.gen-%s' % (uuid.uuid4().hex)
+        self._send({'op': 'declare', 'queue': queue, 'exclusive': exclusive,
+                    'arguments': arguments or {}, 'passive': passive})
+        if(not passive):
+            return(_Frame(Method(queue=queue)))
+
+        reply = None
+        while(True):
+            for (header, body) in self._read_frames(None):
+                if(header.get('op') != 'declare_ok'):
+                    self._frames.append((header, body))
+                elif(header['queue'] == queue):
+                    reply = header
+            if(reply is not None):
+                break
+        if(not reply['exists']):
+            raise pika.exceptions.ChannelClosed(404, "NOT_FOUND - no queue " + \
+                                                "'%s'" % (queue))
+        return(_Frame(Method(queue=queue,
+                             message_count=reply['message_count'],
+                             consumer_count=reply['consumer_count'])))
+
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+        passive=False, durable=False, auto_delete=False, internal=False,
+        nowait=False, arguments=None, type=None):
+        self._send({'op': 'exchange', 'exchange': exchange,
+                    'type': type or exchange_type})
+        return
+
+    def queue_bind(self, queue, exchange, routing_key=None, nowait=False,
+        arguments=None):
+        self._send({'op': 'bind', 'queue': queue, 'exchange': exchange,
+                    'routing_key': routing_key or queue})
+        return
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self._send({'op': 'qos', 'prefetch_count': prefetch_count})
+        return
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False,
+        exclusive=False, consumer_tag=None):
+        if(consumer_tag is None):
+            consumer_tag = 'ctag-%s' % (uuid.uuid4().hex)
+        self._consumers[consumer_tag] = consumer_callback
+        self._send({'op': 'consume', 'queue': queue, 'no_ack': no_ack,
+                    'consumer_tag': consumer_tag})
+        return(consumer_tag)
+
+    def basic_cancel(self, consumer_tag='', nowait=False):
+        self._consumers.pop(consumer_tag, None)
+        self._send({'op': 'cancel', 'consumer_tag': consumer_tag})
+        return
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+        mandatory=False, immediate=False):
+        self._send({'op': 'publish', 'exchange': exchange,
+                    'routing_key': routing_key,
+                    'properties': _props_to_dict(properties)}, body)
+        return
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._send({'op': 'ack', 'delivery_tag': delivery_tag})
+        return
+
+    def start_consuming(self):
+        while(self.is_open):
+            self.process_data_events()
+        return
+
+    def _send(self, header, body=''):
+        self.socket.sendall(_encode_frame(header, body))
+        return
+
+
+
+
+class _Client(object):
+    """
+    Router side state of a client connection.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        # Bytes received and not yet decoded, and bytes to send.
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.prefetch = 0
+        self.next_tag = 1
+        # {delivery_tag: (queue name, message)}
+        self.unacked = {}
+        self.exclusive = set()
+        return
+
+    def can_receive(self):
+        return(not self.prefetch or len(self.unacked) < self.prefetch)
+
+
+
+
+class _Queue(object):
+    """
+    Messages are (properties, body, redelivered, expires) tuples, kept in one
+    FIFO per priority level (a single one unless the queue has x-max-priority).
+    `expires` is the time after which the message is dropped or dead lettered,
+    None if it has no expiration.
+    """
+    def __init__(self, name, arguments):
+        self.name = name
+        self.arguments = arguments
+        self.max_priority = int(arguments.get('x-max-priority') or 0)
+        self.levels = [collections.deque()
+                       for _ in range(self.max_priority + 1)]
+        self.size = 0
+        # Consumers are (client, consumer_tag, no_ack) tuples.
+        self.consumers = collections.deque()
+        return
+
+    def push(self, message, front=False):
+        priority = min(message[0].get('priority') or 0, self.max_priority)
+        if(front):
+            self.levels[priority].appendleft(message)
+        else:
+            self.levels[priority].append(message)
+        self.size += 1
+        return
+
+    def pop(self):
+        for level in reversed(self.levels):
+            if(level):
+                self.size -= 1
+                return(level.popleft())
+        raise IndexError('pop from an empty queue')
+
+    def pop_expired(self, now):
+        """
+        Remove and return the expired messages. Like RabbitMQ, only messages at
+        the head of the queue (of each priority level here) expire.
+        """
+        expired = []
+        for level in self.levels:
+            while(level and level[0][3] is not None and level[0][3] <= now):
+                expired.append(level.popleft())
+                self.size -= 1
+        return(expired)
+
+
+
+
+class LocalBroker(object):
+    """
+    The local message router. Call serve_forever() to run it.
+    """
+    def __init__(self, url=SCHEME):
+        self.path = socket_path(url)
+        self.queues = {}
+        # {name: (type, set of (routing key, queue name) bindings)}
+        self.exchanges = {}
+        self.clients = {}
+
+        if(os.path.exists(self.path)):
+            # Refuse to steal the socket of a running router.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                probe.close()
+                raise IOError('A router is already listening on %s' \
+                    % (self.path))
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self._stopped = False
+        return
+
+    def stop(self):
+        self._stopped = True
+        return
+
+    def queue_stats(self, name):
+        """
+        Return the (number of messages ready, number of consumer connections)
+        of the queue `name`, like a passive queue_declare on RabbitMQ. Can be
+        called from another thread than the one serving.
+        """
+        queue = self.queues.get(name)
+        if(queue is None):
+            return(0, 0)
+        return(queue.size, len(set([c for (c, _, _) in list(queue.consumers)])))
+
+    def serve_forever(self):
+        try:
+            while(not self._stopped):
+                self._serve_once(SOCKET_TIMEOUT)
+        finally:
+            for client in self.clients.values():
+                client.sock.close()
+            self.listener.close()
+            if(os.path.exists(self.path)):
+                os.unlink(self.path)
+        return
+
+    def _serve_once(self, timeout):
+        readers = [self.listener, ] + [c.sock for c in self.clients.values()]
+        writers = [c.sock for c in self.clients.values() if c.outbuf]
+        try:
+            readable, writable, _ = select.select(readers, writers, [],
+                                                  timeout)
+        except select.error, e:
+            if(e.args[0] == errno.EINTR):
+                return
+            raise
+
+        for sock in readable:
+            if(sock is self.listener):
+                self._accept()
+                continue
+            client = self.clients.get(sock.fileno())
+            if(client is None):
+                continue
+            try:
+                data = sock.recv(1 << 16)
+            except socket.error:
+                data = ''
+            if(not data):
+                self._disconnect(client)
+                continue
+            client.inbuf.extend(data)
+            for (header, body) in _decode_frames(client.inbuf):
+                getattr(self, '_on_' + header['op'])(client, header, body)
+
+        for sock in writable:
+            client = self.clients.get(sock.fileno())
+            if(client is None):
+                continue
+            try:
+                sent = sock.send(client.outbuf)
+            except socket.error:
+                self._disconnect(client)
+                continue
+            del client.outbuf[:sent]
+
+        self._expire()
+        self._dispatch()
+        return
+
+    def _accept(self):
+        try:
+            (sock, _) = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        self.clients[sock.fileno()] = _Client(sock)
+        return
+
+    def _disconnect(self, client):
+        del(self.clients[client.sock.fileno()])
+        client.sock.close()
+        for queue in self.queues.values():
+            queue.consumers = collections.deque(
+                [c for c in queue.consumers if c[0] is not client])
+        for name in client.exclusive:
+            self.queues.pop(name, None)
+        for (_, bindings) in self.exchanges.values():
+            for binding in list(bindings):
+                if(binding[1] in client.exclusive):
+                    bindings.discard(binding)
+        # Redeliver whatever the client did not acknowledge, in order.
+        for tag in sorted(client.unacked.keys(), reverse=True):
+            (name, (properties, body, _, expires)) = client.unacked[tag]
+            if(name in self.queues):
+                self.queues[name].push((properties, body, True, expires),
+                                       front=True)
+        return
+
+    def _on_declare(self, client, header, body):
+        name = header['queue']
+        if(header.get('passive')):
+            (message_count, consumer_count) = self.queue_stats(name)
+            client.outbuf += _encode_frame({'op': 'declare_ok',
+                                            'queue': name,
+                                            'exists': name in self.queues,
+                                            'message_count': message_count,
+                                            'consumer_count': consumer_count})
+            return
+        if(name not in self.queues):
+            self.queues[name] = _Queue(name, header['arguments'])
+            if(header['exclusive']):
+                client.exclusive.add(name)
+        return
+
+    def _on_exchange(self, client, header, body):
+        if(header['exchange'] not in self.exchanges):
+            self.exchanges[header['exchange']] = (header['type'], set())
+        return
+
+    def _on_bind(self, client, header, body):
+        exchange = self.exchanges.get(header['exchange'])
+        if(exchange is not None):
+            exchange[1].add((header['routing_key'], header['queue']))
+        return
+
+    def _on_qos(self, client, header, body):
+        client.prefetch = header['prefetch_count']
+        return
+
+    def _on_consume(self, client, header, body):
+        queue = self.queues.get(header['queue'])
+        if(queue is not None):
+            queue.consumers.append((client, header['consumer_tag'],
+                                    header['no_ack']))
+        return
+
+    def _on_cancel(self, client, header, body):
+        tag = header['consumer_tag']
+        for queue in self.queues.values():
+            queue.consumers = collections.deque(
+                [c for c in queue.consumers
+                 if c[0] is not client or c[1] != tag])
+        return
+
+    def _on_publish(self, client, header, body):
+        self._route(header['exchange'], header['routing_key'],
+                    header['properties'], body)
+        return
+
+    def _route(self, exchange, routing_key, properties, body):
+        names = [routing_key, ]
+        if(exchange):
+            (kind, bindings) = self.exchanges.get(exchange, (None, ()))
+            names = [name for (key, name) in bindings
+                     if kind == 'fanout' or key == routing_key]
+        expires = None
+        if(properties.get('expiration') is not None):
+            expires = time.time() + float(properties['expiration']) / 1000.
+        for name in names:
+            queue = self.queues.get(name)
+            if(queue is not None):
+                queue.push((properties, body, False, expires))
+        return
+
+    def _expire(self):
+        now = time.time()
+        for queue in self.queues.values():
+            for (properties, body, _, _) in queue.pop_expired(now):
+                if('x-dead-letter-exchange' not in queue.arguments):
+                    continue
+                properties = dict(properties)
+                properties.pop('expiration')
+                self._route(queue.arguments['x-dead-letter-exchange'],
+                            queue.arguments.get('x-dead-letter-routing-key',
+                                                queue.name),
+                            properties, body)
+        return
+
+    def _on_ack(self, client, header, body):
+        client.unacked.pop(header['delivery_tag'], None)
+        return
+
+    def _dispatch(self):
+        """
+        Hand out queued messages round robin to the consumers which can take
+        them (prefetch permitting).
+        """
+        for queue in self.queues.values():
+            while(queue.size and queue.consumers):
+                for i in range(len(queue.consumers)):
+                    (client, consumer_tag, no_ack) = queue.consumers[0]
+                    queue.consumers.rotate(-1)
+                    if(no_ack or client.can_receive()):
+                        break
+                else:
+                    # Every consumer is busy.
+                    break
+                self._deliver(queue, client, consumer_tag, no_ack)
+        return
+
+    def _deliver(self, queue, client, consumer_tag, no_ack):
+        message = queue.pop()
+        (properties, body, redelivered, _) = message
+        tag = client.next_tag
+        client.next_tag += 1
+        if(not no_ack):
+            client.unacked[tag] = (queue.name, message)
+        client.outbuf += _encode_frame({'consumer_tag': consumer_tag,
+                                        'delivery_tag': tag,
+                                        'redelivered': redelivered,
+                                        'exchange': '',
+                                        'routing_key': queue.name,
+                                        'properties': properties}, body)
+        return
+
+
+
+if(__name__ == '__main__'):
+    try:
+        url = sys.argv[1]
+    except:
+        url = SCHEME
+    if(not is_local(url)):
+        print('Usage: local.py [local:///path/to/socket]')
+        sys.exit(1)
+
+    broker = LocalBroker(url)
+    print " [x] Local router listening on %s" % (broker.path)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,158 @@
+"""
+Structured, non blocking logging for the workers. Each record is written as
+one JSON object per line:
+
+    {"time": 1400000000.123, "level": "INFO", "logger": "spread.worker",
+     "host": "node1", "pid": 1234, "thread": "MainThread", "msg": "...", ...}
+
+Extra fields are passed in the `fields` dictionary of the `extra` argument of
+the logging calls, e.g.
+
+    log.info('Job done', extra={'fields': {'exit_code': 0}})
+
+and failures with log.exception() get their traceback in 'exc'.
+
+Logging calls only put the record in a bounded in-memory queue (see
+QueueHandler): formatting and writing happen in a background thread, so that
+slow disks never delay the jobs. When the queue is full, records are dropped
+and their number logged as soon as there is room again. Log files are rotated
+when they reach a given size.
+"""
+import json
+import logging
+import logging.handlers
+import Queue
+import socket
+import sys
+import threading
+
+
+
+
+# Constants
+HOSTNAME = socket.gethostname()
+# Records waiting to be written, beyond which new ones are dropped.
+QUEUE_SIZE = 10000
+# Log files are rotated when they reach MAX_BYTES, keeping BACKUPS old files.
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+LOGGER = 'spread'
+
+
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a log record as a single line JSON object (see the module
+    documentation).
+    """
+    def format(self, record):
+        entry = {'time': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'host': HOSTNAME,
+                 'pid': record.process,
+                 'thread': record.threadName,
+                 'msg': record.getMessage()}
+        entry.update(getattr(record, 'fields', None) or {})
+        if(record.exc_info and not record.exc_text):
+            record.exc_text = self.formatException(record.exc_info)
+        if(record.exc_text):
+            entry['exc'] = record.exc_text
+        try:
+            return(json.dumps(entry, default=repr))
+        except UnicodeDecodeError:
+            # Non UTF-8 bytes, typically in a command line: latin-1 decodes
+            # anything.
+            return(json.dumps(entry, default=repr, encoding='latin-1'))
+
+
+
+
+class QueueHandler(logging.Handler):
+    """
+    Put the log records in a queue of at most `size` records, from which a
+    background thread passes them on to `target`, another handler. Records
+    are dropped, not waited for, when the queue is full.
+    """
+    def __init__(self, target, size=QUEUE_SIZE):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self._queue = Queue.Queue(size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    def emit(self, record):
+        try:
+            # Render the message and traceback now: the arguments might change
+            # before the record is written.
+            record.msg = record.getMessage()
+            record.args = None
+            if(record.exc_info):
+                record.exc_text = self.target.formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+        return
+
+    def close(self):
+        """
+        Write the records still in the queue and close the target handler.
+        """
+        if(self._thread.is_alive()):
+            self._queue.put(None)
+            self._thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+        return
+
+    def _run(self):
+        while(True):
+            record = self._queue.get()
+            if(record is None):
+                break
+            if(self.dropped):
+                dropped = self.dropped
+                self.dropped -= dropped
+                self.target.handle(logging.makeLogRecord(
+                    {'name': LOGGER, 'levelno': logging.WARNING,
+                     'levelname': 'WARNING',
+                     'msg': '%d log records dropped' % (dropped)}))
+            self.target.handle(record)
+        return
+
+
+
+
+def setup(path=None, level=logging.INFO, max_bytes=MAX_BYTES, backups=BACKUPS,
+    name=LOGGER):
+    """
+    Send the records of the `name` logger and its children of at least `level`
+    (a number or a name like 'DEBUG') as JSON lines to the file `path`, rotated
+    every `max_bytes` bytes, or to stdout if `path` is None. Return the
+    QueueHandler: close it to write the pending records.
+    """
+    if(path):
+        target = logging.handlers.RotatingFileHandler(path,
+                                                      maxBytes=max_bytes,
+                                                      backupCount=backups)
+    else:
+        target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    handler = QueueHandler(target)
+
+    if(isinstance(level, basestring)):
+        level = logging.getLevelName(level.upper())
+    logger = logging.getLogger(name)
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    # Keep our records out of the root logger and its handlers.
+    logger.propagate = False
+    return(handler)
@@ -0,0 +1,110 @@
+"""
+Minimal exporters for the phase timings attached to every system() result (see
+worker.system). Exporters are opt-in and have a single method export(timings),
+where timings is a list of [phase, start, end] entries.
+
+    statsd://host:port      one UDP timer metric per phase, fire and forget.
+    file:///path/to/x.prom  Prometheus text file (for node_exporter's textfile
+                            collector) with per-phase count and sum.
+"""
+import os
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+
+
+
+
+# Constants
+PREFIX = 'spread'
+STATSD_PORT = 8125
+# Minimum number of seconds between two rewrites of the Prometheus file.
+FILE_INTERVAL = 1.
+
+
+
+
+class StatsdExporter(object):
+    """
+    Send each phase duration as a statsd timer (in ms) named <prefix>.<phase>.
+    All the phases of a job go in a single UDP datagram.
+    """
+    def __init__(self, host='localhost', port=STATSD_PORT, prefix=PREFIX):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setblocking(False)
+        return
+
+    def export(self, timings):
+        lines = ['%s.%s:%.3f|ms' % (self.prefix, phase, (end - start) * 1000.)
+                 for (phase, start, end) in timings]
+        try:
+            self._sock.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            # Metrics are best effort: never slow down or break the job path.
+            pass
+        return
+
+
+
+
+class PrometheusFileExporter(object):
+    """
+    Accumulate per-phase counts and total durations and write them, at most
+    every FILE_INTERVAL seconds, to `path` in the Prometheus text format. The
+    file is replaced atomically.
+    """
+    def __init__(self, path, prefix=PREFIX, interval=FILE_INTERVAL):
+        self.path = os.path.abspath(path)
+        self.prefix = prefix
+        self.interval = interval
+        self._counts = {}
+        self._sums = {}
+        self._written = 0
+        self._lock = threading.Lock()
+        return
+
+    def export(self, timings):
+        with self._lock:
+            for (phase, start, end) in timings:
+                self._counts[phase] = self._counts.get(phase, 0) + 1
+                self._sums[phase] = self._sums.get(phase, 0.) + (end - start)
+            if(time.time() - self._written >= self.interval):
+                self._write()
+        return
+
+    def _write(self):
+        name = '%s_phase_seconds' % (self.prefix)
+        lines = ['# TYPE %s summary' % (name), ]
+        for phase in sorted(self._counts.keys()):
+            lines.append('%s_sum{phase="%s"} %f' \
+                % (name, phase, self._sums[phase]))
+            lines.append('%s_count{phase="%s"} %d' \
+                % (name, phase, self._counts[phase]))
+
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        try:
+            os.write(fd, '\n'.join(lines) + '\n')
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, self.path)
+        self._written = time.time()
+        return
+
+
+
+
+def exporter(url):
+    """
+    Return the exporter described by `url` (see the module documentation).
+    """
+    parsed = urlparse.urlparse(url)
+    if(parsed.scheme == 'statsd'):
+        return(StatsdExporter(host=parsed.hostname or 'localhost',
+                              port=parsed.port or STATSD_PORT))
+    elif(parsed.scheme == 'file'):
+        return(PrometheusFileExporter(parsed.netloc + parsed.path))
+    raise ValueError('Unsupported metrics URL %s' % (url))
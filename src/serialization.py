@@ -0,0 +1,108 @@
+"""
+Wire formats of the requests and of their results. The format of a message
+body is given by the standard AMQP content_type and content_encoding
+properties of the message:
+
+    content_type
+        application/json (or none)      JSON, the default, readable by any
+                                        client and by older workers.
+        application/x-python-marshal    Python's marshal: several times faster
+                                        than JSON to decode and encode, but
+                                        only readable by the same major Python
+                                        version and not safe against
+                                        malicious data (trust your broker).
+    content_encoding
+        zlib (or none)                  compressed with zlib.
+
+Clients choose the format of their requests (see client.RpcClient) and
+workers reply in the format of the request. Bodies are only compressed when
+larger than COMPRESS_MIN bytes and when that actually saves space. Workers
+only compress the results of clients which accept it (see accepts()).
+"""
+import json
+import marshal
+import zlib
+
+
+
+
+# Constants
+JSON = 'application/json'
+MARSHAL = 'application/x-python-marshal'
+ZLIB = 'zlib'
+# Short names, e.g. for command line options.
+FORMATS = {'json': JSON, 'marshal': MARSHAL}
+# Bodies smaller than this (bytes) are never compressed.
+COMPRESS_MIN = 4096
+# Fast compression level: messages are compressed once and sent once.
+ZLIB_LEVEL = 1
+# Request header listing the content encodings the client can decode.
+ACCEPT_HEADER = 'spread_accept'
+
+_SERIALIZERS = {JSON: (json.dumps, json.loads),
+                MARSHAL: (marshal.dumps, marshal.loads)}
+_ENCODINGS = {ZLIB: (lambda data: zlib.compress(data, ZLIB_LEVEL),
+                     zlib.decompress)}
+
+
+
+
+def content_type(name):
+    """
+    Return the content type of the format `name`, either a short name (see
+    FORMATS) or a content type. None is JSON. Raise ValueError for unknown
+    formats.
+    """
+    if(not name):
+        return(JSON)
+    name = FORMATS.get(name, name)
+    if(name not in _SERIALIZERS):
+        raise ValueError('Unknown format %s' % (name))
+    return(name)
+
+def encode(obj, content_type=None, compress=None):
+    """
+    Serialize `obj` in the format `content_type` (JSON by default) and, if
+    `compress` is not None and the result is larger than `compress` bytes,
+    compress it. Return (body, content_type, content_encoding), the latter
+    being None for uncompressed bodies.
+    """
+    content_type = content_type or JSON
+    body = _SERIALIZERS[content_type][0](obj)
+    content_encoding = None
+    if(compress is not None and len(body) > compress):
+        compressed = _ENCODINGS[ZLIB][0](body)
+        if(len(compressed) < len(body)):
+            (body, content_encoding) = (compressed, ZLIB)
+    return(body, content_type, content_encoding)
+
+def decode(body, content_type=None, content_encoding=None):
+    """
+    Deserialize the message `body` in the format `content_type` (JSON if
+    None), compressed with `content_encoding` if not None. Raise ValueError
+    for unknown formats and encodings.
+    """
+    if(content_encoding):
+        if(content_encoding not in _ENCODINGS):
+            raise ValueError('Unknown content encoding %s' \
+                % (content_encoding))
+        body = _ENCODINGS[content_encoding][1](body)
+    content_type = content_type or JSON
+    if(content_type not in _SERIALIZERS):
+        raise ValueError('Unknown content type %s' % (content_type))
+    return(_SERIALIZERS[content_type][1](body))
+
+def supported(content_type=None, content_encoding=None):
+    """
+    Return True if we can decode bodies in the format `content_type`
+    compressed with `content_encoding` (see decode()).
+    """
+    return((content_type or JSON) in _SERIALIZERS and
+           (not content_encoding or content_encoding in _ENCODINGS))
+
+def accepts(headers):
+    """
+    Return True if the client which sent a request with these `headers`
+    accepts compressed replies.
+    """
+    return(ZLIB in (headers or {}).get(ACCEPT_HEADER, '').split(','))
@@ -0,0 +1,194 @@
+"""
+File staging for workers which do not share a filesystem with the client.
+
+system() calls can declare `stage_in` files, which the client owns, and
+`stage_out` files, which the job writes in its working directory. Files are
+moved over the broker, in chunks of CHUNK_SIZE bytes:
+
+    1. The client hashes each input file and sends the [name, digest, size]
+       list instead of the files themselves (and the digests in the
+       'spread_stage' header).
+    2. When a worker picks the request up, it looks the digests up in its node
+       local FileStore. For every missing one it sends a fetch request (header
+       'spread_fetch', correlation_id = digest) to the client callback queue
+       and parks the request. The client answers with the file chunks, sent to
+       the private queue of the worker, and the request is executed once all
+       of its inputs are in the store.
+    3. system() links the inputs from the store into the job working directory
+       and, once the job has exited, moves its outputs to the store spool.
+       The worker streams them back to the client (header 'spread_file') right
+       before the reply, and the client writes them under its `stage_dir`.
+
+Files in the store are read only and shared by all the jobs (and all the
+workers using the same store directory) of a node: an input like a calibration
+frame is transferred at most once per node. Jobs must not modify their staged
+inputs in place.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import uuid
+
+
+
+
+# Constants
+CHUNK_SIZE = 1 << 20
+DEFAULT_ROOT = os.path.join(tempfile.gettempdir(),
+                            'spread-stage-%d' % (os.getuid()))
+TMP_DIR = '.tmp'
+SPOOL_DIR = '.spool'
+
+
+
+
+class FileStore(object):
+    """
+    Node local, content addressed store of staged files rooted at `root`.
+    """
+    def __init__(self, root=DEFAULT_ROOT):
+        self.root = os.path.abspath(root)
+        for name in (TMP_DIR, SPOOL_DIR):
+            if(not os.path.isdir(os.path.join(self.root, name))):
+                os.makedirs(os.path.join(self.root, name))
+        return
+
+    def path(self, digest):
+        return(os.path.join(self.root, digest[:2], digest))
+
+    def has(self, digest):
+        return(os.path.exists(self.path(digest)))
+
+    def writer(self, digest):
+        """
+        Return a Download which stores the file `digest` as its chunks come in.
+        """
+        return(Download(self, digest))
+
+    def link(self, digest, dst):
+        """
+        Make the stored file `digest` available as `dst`. Raise IOError if it
+        is not in the store.
+        """
+        src = self.path(digest)
+        if(not os.path.exists(src)):
+            raise IOError('Staged file %s not available' % (digest))
+        if(not os.path.isdir(os.path.dirname(dst))):
+            os.makedirs(os.path.dirname(dst))
+        if(os.path.lexists(dst)):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Different filesystem.
+            shutil.copy2(src, dst)
+        return
+
+    def spool(self, path):
+        """
+        Move (or copy, if it cannot be moved) the file `path` to the spool and
+        return its new path. The caller removes it once it has been sent.
+        """
+        dst = os.path.join(self.root, SPOOL_DIR, uuid.uuid4().hex)
+        try:
+            os.link(path, dst)
+        except OSError:
+            shutil.copy2(path, dst)
+        return(dst)
+
+
+
+
+class Download(object):
+    """
+    A file being received chunk by chunk. It only appears in the store, read
+    only, once all of its chunks have arrived and its digest has been checked.
+    """
+    def __init__(self, store, digest):
+        self.store = store
+        self.digest = digest
+        self.offset = 0
+        (fd, self._tmp_path) = tempfile.mkstemp(dir=os.path.join(store.root,
+                                                                 TMP_DIR))
+        self._file = os.fdopen(fd, 'wb')
+        self._sha = hashlib.sha1()
+        return
+
+    def write(self, offset, data):
+        if(offset != self.offset):
+            raise IOError('Chunk of %s at %d, expected %d' \
+                % (self.digest, offset, self.offset))
+        self._file.write(data)
+        self._sha.update(data)
+        self.offset += len(data)
+        return
+
+    def commit(self):
+        """
+        Move the file to the store. Raise IOError if its content does not match
+        its digest (e.g. it changed on the client since it was submitted).
+        """
+        self._file.close()
+        if(self._sha.hexdigest() != self.digest):
+            self.abort()
+            raise IOError('Staged file %s is corrupted' % (self.digest))
+        dst = self.store.path(self.digest)
+        if(not os.path.isdir(os.path.dirname(dst))):
+            try:
+                os.makedirs(os.path.dirname(dst))
+            except OSError:
+                # Another worker created it.
+                pass
+        os.chmod(self._tmp_path, 0444)
+        os.rename(self._tmp_path, dst)
+        return
+
+    def abort(self):
+        self._file.close()
+        if(os.path.exists(self._tmp_path)):
+            os.remove(self._tmp_path)
+        return
+
+
+
+
+def describe(path):
+    """
+    Return the (digest, size) of the file `path`.
+    """
+    sha = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as f:
+        while(True):
+            block = f.read(CHUNK_SIZE)
+            if(not block):
+                break
+            sha.update(block)
+            size += len(block)
+    return(sha.hexdigest(), size)
+
+def read_chunks(path):
+    """
+    Yield the (offset, data, last) chunks of the file `path`. Empty files are a
+    single empty chunk.
+    """
+    with open(path, 'rb') as f:
+        offset = 0
+        data = f.read(CHUNK_SIZE)
+        while(True):
+            following = f.read(CHUNK_SIZE)
+            yield (offset, data, not following)
+            if(not following):
+                break
+            offset += len(data)
+            data = following
+    return
+
+def chunk_headers(offset, last, **kwds):
+    """
+    AMQP headers of a file chunk (values are strings, see worker._reply()).
+    """
+    headers = {'spread_offset': str(offset), 'spread_last': last and '1' or '0'}
+    headers.update(kwds)
+    return(headers)
@@ -1,54 +1,430 @@
 #!/usr/bin/env python
-import logging
+"""
+Start and supervise the worker processes of a node.
+
+    shell> ./start_workers.py [options] <cmd> [N]
+
+starts N (the number of CPUs by default) instances of <cmd>, typically
+worker.py, and keeps them running:
+
+    * Workers are reaped as soon as they exit (we wake up on SIGCHLD) and
+      respawned. While they keep exiting within STABLE_TIME seconds of being
+      started, respawns are delayed with an exponential backoff, from
+      RESPAWN_DELAY up to RESPAWN_MAX_DELAY seconds.
+    * If --max is larger than N, the number of workers follows the load. Every
+      SCALE_INTERVAL seconds, workers are added for the requests waiting in
+      the queues they serve, as long as the 1 minute load average is below
+      --max-load. One worker is drained (see below) when no request has been
+      waiting for COOLDOWN seconds or when the load average is above
+      --max-load, at most once every COOLDOWN seconds and never below N.
+    * On SIGTERM (or ^C) all the workers are drained: they get SIGTERM, finish
+      their running jobs and exit (see worker.Worker.drain()). Those still
+      running --drain-timeout seconds later are killed.
+
+Workers run in their own process group, so that ^C only reaches us.
+
+Each worker writes its JSON lines log (see logs.py) to worker-<i>.log in
+--log-dir, where i is the lowest index not used by a running worker (a
+respawned worker takes over the index, and the log, of the one it replaces),
+and any other output to worker-<i>.out.
+"""
+import errno
+import fcntl
 import multiprocessing
+import optparse
 import os
+import select
+import signal
 import subprocess
 import sys
+import threading
 import time
 
+import pika.exceptions
 
+import local
+from client import queue_name
 
 
 
-try:
-    cmd = sys.argv[1]
-except:
-    print('Usage start_workers.pt <cmd> <options>')
 
-try:
-    N = int(sys.argv[2])
-except:
-    N = multiprocessing.cpu_count()
+# Constants
+SCALE_INTERVAL = 5.
+COOLDOWN = 60.
+STABLE_TIME = 30.
+RESPAWN_DELAY = 1.
+RESPAWN_MAX_DELAY = 300.
+DRAIN_TIMEOUT = 660.
 
 
-print('Starting %d instances of %s' % (N, cmd))
-print('STDOUT and STDERR in workers.log')
 
-procs = []
-with open('workers.log', 'w') as f:
-    for i in range(N):
-        procs.append(subprocess.Popen([cmd, ],
-                                      stdout=f,
-                                      stderr=subprocess.STDOUT))
 
-    failed = 0
-    completed = 0
-    try:
-        while(procs):
-            p = procs.pop(0)
-            err = p.returncode
-            if(err is None):
-                procs.append(p)
-            elif(err != 0):
-                failed += 1
+class Supervisor(object):
+    """
+    Keep between `min_workers` and `max_workers` processes executing `argv`
+    running (see the module documentation). `queues` are the request queues
+    the workers serve, `broker_host` the broker they connect to and `broker`
+    the LocalBroker serving it, if we run it. Worker logs go to `log_dir` (see
+    the module documentation), if not None, and are passed to worker.py with
+    -L.
+    """
+    def __init__(self, argv, min_workers, max_workers=None, queues=None,
+        broker_host='localhost', broker=None, max_load=None,
+        drain_timeout=DRAIN_TIMEOUT, log_dir=None):
+        self.argv = argv
+        self.min_workers = max(int(min_workers), 0)
+        self.max_workers = max(max_workers or 0, self.min_workers)
+        self.queues = queues or [queue_name(), ]
+        self.broker_host = broker_host
+        self.broker = broker
+        self.max_load = max_load or float(multiprocessing.cpu_count())
+        self.drain_timeout = drain_timeout
+        self.log_dir = log_dir
+        self.target = self.min_workers
+
+        # {pid: (Popen, start time, index)} of the running workers and {pid:
+        # kill time} of those being drained.
+        self.workers = {}
+        self.draining = {}
+        self._failures = 0
+        self._next_spawn = 0
+        self._idle_since = time.time()
+        self._last_scale_down = 0
+        self._stopping = False
+        # Broker connection used to poll the queue depths (see _queue_depth()).
+        self._connection = None
+        self._channel = None
+        # Signal handlers write to this pipe to wake up run().
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        flags = fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL)
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        return
+
+    def stop(self, signum=None, frame=None):
+        """
+        Drain all the workers and have run() return once they are gone. Also
+        the SIGTERM and SIGINT handler.
+        """
+        self._stopping = True
+        self._wakeup()
+        return
+
+    def run(self):
+        signal.signal(signal.SIGCHLD, self._wakeup)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        next_scale = time.time() + SCALE_INTERVAL
+        stopped = False
+        while(True):
+            now = time.time()
+            if(self._stopping and not stopped):
+                print('Draining %d workers' % (len(self.workers)))
+                for pid in self.workers.keys():
+                    self._drain(pid)
+                stopped = True
+            self._reap()
+            if(stopped and not self.workers):
+                break
+            self._kill_overdue(now)
+            if(not stopped):
+                if(now >= next_scale):
+                    self._autoscale(now)
+                    next_scale = now + SCALE_INTERVAL
+                self._respawn(now)
+
+            wakeups = self.draining.values()
+            if(not stopped):
+                wakeups.append(next_scale)
+                if(self._active() < self.target):
+                    wakeups.append(self._next_spawn)
+            timeout = None
+            if(wakeups):
+                timeout = max(min(wakeups) - time.time(), 0)
+            try:
+                ready, _, _ = select.select([self._wakeup_r, ], [], [],
+                                            timeout)
+            except select.error, e:
+                if(e.args[0] == errno.EINTR):
+                    continue
+                raise
+            if(ready):
+                os.read(self._wakeup_r, 4096)
+        self._disconnect()
+        return
+
+    def _wakeup(self, signum=None, frame=None):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError:
+            # The pipe is full: we will wake up anyway.
+            pass
+        return
+
+    def _active(self):
+        return(len(self.workers) - len(self.draining))
+
+    def _spawn(self):
+        used = set([w[2] for w in self.workers.values()])
+        index = min(set(range(len(used) + 1)) - used)
+        argv = self.argv
+        out = None
+        if(self.log_dir is not None):
+            path = os.path.join(self.log_dir, 'worker-%d' % (index))
+            argv = argv[:1] + ['-L', path + '.log'] + argv[1:]
+            out = open(path + '.out', 'a')
+        try:
+            proc = subprocess.Popen(argv,
+                                    stdout=out,
+                                    stderr=subprocess.STDOUT,
+                                    close_fds=True,
+                                    preexec_fn=os.setpgrp)
+        finally:
+            if(out is not None):
+                out.close()
+        self.workers[proc.pid] = (proc, time.time(), index)
+        print('Started worker %d (%d)' % (index, proc.pid))
+        return
+
+    def _drain(self, pid):
+        if(pid in self.draining):
+            return
+        self.draining[pid] = time.time() + self.drain_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        return
+
+    def _reap(self):
+        """
+        Collect the workers which exited and schedule the respawn of those
+        which were not asked to.
+        """
+        while(self.workers):
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if(e.errno == errno.EINTR):
+                    continue
+                if(e.errno == errno.ECHILD):
+                    return
+                raise
+            if(not pid):
+                return
+            if(pid not in self.workers):
+                continue
+            (proc, start_time, index) = self.workers.pop(pid)
+            if(os.WIFSIGNALED(status)):
+                proc.returncode = -os.WTERMSIG(status)
+            else:
+                proc.returncode = os.WEXITSTATUS(status)
+            if(self.draining.pop(pid, None) is not None):
+                print('Worker %d drained' % (pid))
+                continue
+
+            now = time.time()
+            if(now - start_time < STABLE_TIME):
+                self._failures += 1
+                delay = min(RESPAWN_DELAY * 2 ** (self._failures - 1),
+                            RESPAWN_MAX_DELAY)
+                self._next_spawn = now + delay
             else:
-                completed += 1
-            time.sleep(1.)
-            f.flush()
-    except KeyboardInterrupt:
-        print('Killing all running processes')
-        while(procs):
-            p = procs.pop(0)
-            p.kill()
-        print('Done. Quitting.')
+                self._failures = 0
+                delay = 0
+            print('Worker %d exited with status %d, respawning in %.0f s' \
+                % (pid, proc.returncode, delay))
+        return
+
+    def _respawn(self, now):
+        if(now < self._next_spawn):
+            return
+        while(self._active() < self.target):
+            self._spawn()
+        return
+
+    def _kill_overdue(self, now):
+        for (pid, deadline) in self.draining.items():
+            if(now >= deadline):
+                print('Worker %d still running after %d s, killing it' \
+                    % (pid, self.drain_timeout))
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                # Only kill it once.
+                self.draining[pid] = now + COOLDOWN
+        return
+
+    def _autoscale(self, now):
+        if(self.max_workers <= self.min_workers):
+            return
+        depth = self._queue_depth()
+        if(depth is None):
+            return
+        load = os.getloadavg()[0]
+        if(depth):
+            self._idle_since = None
+            if(load < self.max_load and self.target < self.max_workers):
+                # The load average lags: grow by its headroom at most.
+                step = min(depth, max(int(self.max_load - load), 1))
+                self.target = min(self.target + step, self.max_workers)
+                print('%d requests queued, load %.2f: scaling up to %d' \
+                    % (depth, load, self.target))
+        elif(self._idle_since is None):
+            self._idle_since = now
+
+        idle = self._idle_since is not None and \
+            now - self._idle_since >= COOLDOWN
+        if((idle or load > self.max_load) and
+           self.target > self.min_workers and
+           now - self._last_scale_down >= COOLDOWN):
+            self.target -= 1
+            self._last_scale_down = now
+            print('%d requests queued, load %.2f: scaling down to %d' \
+                % (depth, load, self.target))
+        # Drain the youngest workers first.
+        running = sorted([(w[1], pid) for (pid, w) in self.workers.items()
+                          if pid not in self.draining])
+        while(len(running) > self.target):
+            self._drain(running.pop()[1])
+        return
+
+    def _queue_depth(self):
+        """
+        Return the number of requests waiting in our queues, None if the broker
+        cannot tell. Queues which do not exist yet are empty.
+        """
+        if(self.broker is not None):
+            return(sum([self.broker.queue_stats(q)[0] for q in self.queues]))
+        depth = 0
+        for queue in self.queues:
+            try:
+                if(self._connection is None):
+                    self._connection = local.connect(self.broker_host)
+                if(self._channel is None):
+                    self._channel = self._connection.channel()
+                # Passive: do not declare it, with the wrong arguments.
+                depth += self._channel.queue_declare(queue=queue,
+                                                     passive=True) \
+                                      .method.message_count
+            except pika.exceptions.ChannelClosed:
+                # No such queue. RabbitMQ closes the channel, not the
+                # connection: open another channel next time.
+                self._channel = None
+            except Exception, e:
+                print('Cannot get the queue depth: %s' % (e))
+                self._disconnect()
+                return(None)
+        return(depth)
+
+    def _disconnect(self):
+        """
+        Close the connection to the broker, if any.
+        """
+        if(self._connection is not None):
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+        self._channel = None
+        return
+
+
+
+
+if(__name__ == '__main__'):
+    parser = optparse.OptionParser('start_workers.py [options] <cmd> [N]')
+    parser.add_option('-b', '--broker',
+                      dest='broker',
+                      type='str',
+                      default=None,
+                      help='broker host name or local:// URL passed to the ' + \
+                           'workers. The local router is started for ' + \
+                           'local:// URLs.')
+    parser.add_option('-M', '--max',
+                      dest='max_workers',
+                      type='int',
+                      default=None,
+                      help='scale up to this many workers when requests are ' + \
+                           'queued. Default: N, no autoscaling.')
+    parser.add_option('-l', '--max-load',
+                      dest='max_load',
+                      type='float',
+                      default=None,
+                      help='do not scale up above this 1 minute load ' + \
+                           'average. Default: the number of CPUs.')
+    parser.add_option('-P', '--pool',
+                      dest='pools',
+                      action='append',
+                      default=[],
+                      help='worker pool passed to the workers (-P) and ' + \
+                           'whose queue is watched. Can be repeated.')
+    parser.add_option('-n', '--slots',
+                      dest='slots',
+                      type='int',
+                      default=None,
+                      help='number of slots passed to the workers (-n).')
+    parser.add_option('-d', '--drain-timeout',
+                      dest='drain_timeout',
+                      type='float',
+                      default=DRAIN_TIMEOUT,
+                      help='kill the workers still running this many ' + \
+                           'seconds after being asked to exit.')
+    parser.add_option('-o', '--log-dir',
+                      dest='log_dir',
+                      type='str',
+                      default='.',
+                      help='directory of the worker logs.')
+    parser.add_option('--log-level',
+                      dest='log_level',
+                      type='choice',
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                      default=None,
+                      help='minimum level of the records logged by the ' + \
+                           'workers (passed on with --log-level).')
+    (options, args) = parser.parse_args()
+
+    try:
+        cmd = args[0]
+    except:
+        parser.error('Please specify the worker command.')
+
+    try:
+        N = int(args[1])
+    except:
+        N = multiprocessing.cpu_count()
+
+    argv = [cmd, ]
+    for pool in options.pools:
+        argv += ['-P', pool]
+    if(options.slots):
+        argv += ['-n', str(options.slots)]
+    if(options.log_level):
+        argv += ['--log-level', options.log_level]
+    if(options.broker):
+        argv.append(options.broker)
+    broker = None
+    if(options.broker and local.is_local(options.broker)):
+        broker = local.LocalBroker(options.broker)
+        broker_thread = threading.Thread(target=broker.serve_forever)
+        broker_thread.daemon = True
+        broker_thread.start()
+        print('Local router listening on %s' % (broker.path))
+    queues = [queue_name(pool != 'default' and pool or None)
+              for pool in options.pools or ['default', ]]
+
+    print('Starting %d instances of %s' % (N, cmd))
+    print('Logs in %s/worker-<i>.log' % (options.log_dir))
+    sys.stdout.flush()
 
+    if(not os.path.isdir(options.log_dir)):
+        os.makedirs(options.log_dir)
+    supervisor = Supervisor(argv, N, options.max_workers, queues,
+                            options.broker or 'localhost', broker,
+                            options.max_load, options.drain_timeout,
+                            options.log_dir)
+    supervisor.run()
+    print('Done. Quitting.')
+    if(broker is not None):
+        broker.stop()
@@ -0,0 +1,161 @@
+"""
+Job working directories.
+
+Removing the temporary working directory of a job (see worker.system and its
+`root_dir` argument) can take longer than the job itself, e.g. thousands of
+intermediate files on NFS scratch. A WorkdirManager lets the worker reply as
+soon as the job is done: released directories are emptied by a background
+reaper thread and either removed or, up to `pool_size` per root directory,
+kept around to be handed to the next jobs. Whenever the pool of a root
+directory runs dry, the reaper also creates new directories for it, so that
+both creating and removing directories are off the job path.
+
+Working directories can also be placed on a tmpfs (e.g. /dev/shm): as long as
+less than `tmpfs_quota` bytes of it are in use, new directories are created
+under `tmpfs_dir` instead of under the root directory requested by the job.
+"""
+import collections
+import logging
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+
+
+
+
+# Constants
+PREFIX = 'spread-'
+
+log = logging.getLogger('spread.workdirs')
+
+
+
+
+class WorkdirManager(object):
+    """
+    Hand out job working directories and clean them up in the background.
+    """
+    def __init__(self, pool_size=0, tmpfs_dir=None, tmpfs_quota=None):
+        self.pool_size = max(int(pool_size), 0)
+        self.tmpfs_dir = tmpfs_dir and os.path.abspath(tmpfs_dir)
+        self.tmpfs_quota = tmpfs_quota
+
+        # Empty directories ready to be used: {root: deque of paths}
+        self._pools = collections.defaultdict(collections.deque)
+        # Number of directories being emptied to go back to the pool: {root: n}
+        self._recycling = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        # Items are (root, path) of directories to empty, where root is None
+        # if the directory itself has to go as well, or (root, None) to fill
+        # the pool of root.
+        self._trash = Queue.Queue()
+        self._reaper = threading.Thread(target=self._reap)
+        self._reaper.daemon = True
+        self._reaper.start()
+        return
+
+    def acquire(self, root_dir):
+        """
+        Return the path of an empty working directory under `root_dir` (or
+        under the tmpfs, see the module documentation).
+        """
+        root = os.path.abspath(self._root(root_dir))
+        with self._lock:
+            pool = self._pools[root]
+            if(pool):
+                return(pool.popleft())
+        if(self.pool_size):
+            self._trash.put((root, None))
+        return(tempfile.mkdtemp(prefix=PREFIX, dir=root))
+
+    def release(self, path):
+        """
+        Hand the working directory `path` over to the reaper and return
+        immediately.
+        """
+        path = os.path.abspath(path)
+        root = os.path.dirname(path)
+        with self._lock:
+            if(self._pooled(root) >= self.pool_size):
+                root = None
+            else:
+                self._recycling[root] += 1
+        self._trash.put((root, path))
+        return
+
+    def drain(self):
+        """
+        Wait for all the released directories to be cleaned up.
+        """
+        self._trash.join()
+        return
+
+    def _pooled(self, root):
+        # Call with the lock held.
+        return(len(self._pools[root]) + self._recycling[root])
+
+    def _root(self, root_dir):
+        if(self.tmpfs_dir is None):
+            return(root_dir)
+        if(self.tmpfs_quota is not None):
+            st = os.statvfs(self.tmpfs_dir)
+            used = (st.f_blocks - st.f_bfree) * st.f_frsize
+            if(used >= self.tmpfs_quota):
+                return(root_dir)
+        return(self.tmpfs_dir)
+
+    def _reap(self):
+        while(True):
+            (root, path) = self._trash.get()
+            try:
+                if(path is None):
+                    self._fill(root)
+                elif(root is None):
+                    shutil.rmtree(path, onerror=_failed_del_warn)
+                else:
+                    recycled = _empty(path)
+                    with self._lock:
+                        self._recycling[root] -= 1
+                        if(recycled):
+                            self._pools[root].append(path)
+                    if(not recycled):
+                        shutil.rmtree(path, ignore_errors=True)
+            except Exception, e:
+                # Never let the reaper die.
+                log.exception('Error cleaning up %s: %s' % (path, e))
+            finally:
+                self._trash.task_done()
+
+    def _fill(self, root):
+        while(True):
+            with self._lock:
+                if(self._pooled(root) >= self.pool_size):
+                    return
+            path = tempfile.mkdtemp(prefix=PREFIX, dir=root)
+            with self._lock:
+                self._pools[root].append(path)
+
+
+
+
+def _empty(path):
+    """
+    Remove the content of the directory `path`. Return True if it is empty.
+    """
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        if(os.path.isdir(child) and not os.path.islink(child)):
+            shutil.rmtree(child, onerror=_failed_del_warn)
+        else:
+            try:
+                os.remove(child)
+            except OSError:
+                pass
+    return(not os.listdir(path))
+
+def _failed_del_warn(function, path, excinfo):
+    log.warning('Error in calling %s on %s: %s %s' \
+        % (function.__name__, path, excinfo[0], excinfo[1]))
+    return
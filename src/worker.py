@@ -1,39 +1,116 @@
 #!/usr/bin/env python
 import collections
-import datetime
+import errno
 import functools
 import json
 import logging
+import optparse
 import os
+import Queue
+import random
+import select
 import shutil
+import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import pika
 
+# Not `cache`: that is the name of an argument of system().
+import cache as result_cache
+import forkserver
+import local
+import logs
+import metrics
+import serialization
+import staging
+import workdirs
+
 
 
 
 # Constants
 HOSTNAME = socket.gethostname()
+QUEUE_NAME = 'rpc_queue'
+# Request queues are priority queues: see client.py.
+MAX_PRIORITY = 10
+QUEUE_ARGUMENTS = {'x-max-priority': MAX_PRIORITY}
+# Warm Python job runner (see forkserver.py), if any, and its entry points:
+# {executable path or basename: 'module:function'}
+FORK_SERVER = None
+ENTRY_POINTS = {}
+# Result cache (see cache.py), if any.
+RESULT_CACHE = None
+# Node local store of staged files (see staging.py), if any.
+STAGE_STORE = None
+# Seconds without any chunk after which a staged file download is given up.
+FETCH_TIMEOUT = 60
+# Pooled working directories with background cleanup (see workdirs.py), if any.
+WORKDIRS = None
+# KB of stdout and stderr captured by default when a call streams its output.
+CAPTURE_KB = 64
+# Bytes read from the output pipes at a time.
+READ_SIZE = 1 << 16
+# Failed system() calls are retried this many times by default, by requeuing
+# them with an exponential backoff: RETRY_DELAY seconds after the first
+# failure, twice as long after the second one and so on, up to RETRY_MAX_DELAY
+# and with random jitter. Each backoff level has its own delay queue.
+DEFAULT_RETRIES = 3
+RETRY_DELAY = 1.
+RETRY_MAX_DELAY = 300.
+RETRY_LEVELS = 9
+# A retry is passed on up to MAX_BOUNCES times by the workers of the hosts it
+# already failed on, in the hope that a worker on another host picks it up.
+MAX_BOUNCES = 3
+# The broker redelivers the requests held by workers which go away, whether
+# they had started them or merely prefetched them: these losses are not failed
+# attempts, but a request lost MAX_REDELIVERIES times (e.g. because it kills
+# its workers) is given up.
+MAX_REDELIVERIES = 5
+# Requests which failed all their attempts end up here, with their last result.
+DEAD_LETTER_QUEUE = 'spread_dead'
+# Fanout exchange the heartbeats of the running jobs are published to.
+STATUS_EXCHANGE = 'spread_status'
+# Fanout exchange of the control messages to all the workers (see
+# Worker.on_control()) and how often running jobs check for cancellation.
+CONTROL_EXCHANGE = 'spread_control'
+CANCEL_POLL = .2
+# Cancelled calls are remembered for this long (seconds), so that their
+# requests still in the queues are dropped.
+CANCEL_MEMORY = 3600
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+PAGE_KB = os.sysconf('SC_PAGE_SIZE') / 1024
+# system() keyword arguments expanded, together with argv, for each element of
+# an array request.
+ARRAY_KWDS = ('input', 'output', 'error')
 logging.basicConfig(level=logging.CRITICAL)
+log = logging.getLogger('spread.worker')
 UPDATED_CLASSAD = '''JobState=Running
 JobPid=%(pid)d
 NumPids=1
 JobStartDate=%(start_time)d
-RemoteSysCpu=0.00
-RemoteUserCpu=%(exec_time).02f
-ImageSize=0.00'''
+RemoteSysCpu=%(sys_time).02f
+RemoteUserCpu=%(user_time).02f
+ImageSize=%(max_rss)d
+ResidentSetSize=%(max_rss)d'''
 EXITED_CLASSAD = '''JobState=Exited
 JobPid=%(pid)d
 NumPids=1
 JobStartDate=%(start_time)d
-RemoteSysCpu=0.00
-RemoteUserCpu=%(exec_time).02f
-ImageSize=0.00
+RemoteSysCpu=%(sys_time).02f
+RemoteUserCpu=%(user_time).02f
+ImageSize=%(max_rss)d
+ResidentSetSize=%(max_rss)d
+MinorPageFaults=%(minor_faults)d
+MajorPageFaults=%(major_faults)d
+VoluntaryContextSwitches=%(voluntary_ctx_switches)d
+InvoluntaryContextSwitches=%(involuntary_ctx_switches)d
+BlockReads=%(block_reads)d
+BlockWrites=%(block_writes)d
 ExitReason=exited
 ExitBySignal=%(terminated)s
 ExitSignal=%(signal)s
@@ -42,17 +119,362 @@ JobDuration=%(exec_time).02f'''
 
 
 
+class _ChildWaiter(object):
+    """
+    Reap a child process in a helper thread and signal its exit through a pipe,
+    so that we can block on it with select() and a deadline instead of polling.
+
+    The child is reaped with wait4() so that its resource usage is available in
+    `rusage` (see _rusage_dict()) once it has exited. If wait4() fails (e.g.
+    somebody else reaped the child), the exit status is unknown: `status` is
+    None, `error` says why and proc.returncode is -1, never a success.
+
+    Signal the child with terminate() and kill() rather than through `proc`:
+    once reaped, its pid might belong to another process.
+    """
+    def __init__(self, proc):
+        self.proc = proc
+        self.status = None
+        self.error = None
+        self.rusage = None
+        # Held while setting proc.returncode and while signalling the child.
+        self._lock = threading.Lock()
+        self._rfd, self._wfd = os.pipe()
+        self._thread = threading.Thread(target=self._reap)
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    def _reap(self):
+        while(True):
+            try:
+                _, status, self.rusage = os.wait4(self.proc.pid, 0)
+            except OSError, e:
+                if(e.errno == errno.EINTR):
+                    continue
+                # ECHILD if somebody else reaped it.
+                with self._lock:
+                    self.error = 'Exit status unknown: %s' % (e)
+                    self.proc.returncode = -1
+                break
+            with self._lock:
+                self.status = status
+                if(os.WIFSIGNALED(status)):
+                    self.proc.returncode = -os.WTERMSIG(status)
+                else:
+                    self.proc.returncode = os.WEXITSTATUS(status)
+            break
+        os.write(self._wfd, 'x')
+        return
+
+    def wait(self, timeout=None):
+        """
+        Wait for the child to exit for at most `timeout` seconds (forever if
+        None). Return True if it did, False otherwise.
+        """
+        deadline = None
+        if(timeout is not None):
+            deadline = time.time() + timeout
+        while(True):
+            remaining = None
+            if(deadline is not None):
+                remaining = max(deadline - time.time(), 0)
+            try:
+                ready, _, _ = select.select([self._rfd, ], [], [], remaining)
+            except select.error, e:
+                if(e.args[0] == errno.EINTR):
+                    continue
+                raise
+            if(ready):
+                self._thread.join()
+                return(True)
+            if(deadline is not None):
+                return(False)
+
+    def terminate(self):
+        self._signal(signal.SIGTERM)
+        return
+
+    def kill(self):
+        self._signal(signal.SIGKILL)
+        return
+
+    def _signal(self, signum):
+        with self._lock:
+            if(self.proc.returncode is None):
+                try:
+                    os.kill(self.proc.pid, signum)
+                except OSError, e:
+                    # ESRCH: it exited but we did not reap it yet.
+                    if(e.errno != errno.ESRCH):
+                        raise
+        return
+
+    def close(self):
+        os.close(self._rfd)
+        os.close(self._wfd)
+        return
+
+class _OutputReader(object):
+    """
+    Read the output pipe `pipe` of a child process in a helper thread, keeping
+    only its last `size` bytes in memory and passing every chunk read to
+    on_output(name, data), if given, as soon as it is read.
+    """
+    def __init__(self, pipe, name, size, on_output=None):
+        self.pipe = pipe
+        self.name = name
+        self.size = size
+        self.on_output = on_output
+        self._chunks = collections.deque()
+        self._length = 0
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    def _read(self):
+        fd = self.pipe.fileno()
+        while(True):
+            try:
+                data = os.read(fd, READ_SIZE)
+            except OSError, e:
+                if(e.errno == errno.EINTR):
+                    continue
+                break
+            if(not data):
+                break
+            if(self.on_output is not None):
+                try:
+                    self.on_output(self.name, data)
+                except Exception:
+                    log.exception('Output callback failed')
+            self._chunks.append(data)
+            self._length += len(data)
+            while(self._length - len(self._chunks[0]) >= self.size):
+                self._length -= len(self._chunks.popleft())
+        return
+
+    def tail(self, timeout=None):
+        """
+        Wait at most `timeout` seconds for the end of the output (background
+        processes might keep the pipe open) and return its last `size` bytes,
+        decoded.
+        """
+        self._thread.join(timeout)
+        self.pipe.close()
+        return(_decode_output(''.join(self._chunks)[-self.size:]))
+
+class _Heartbeat(object):
+    """
+    Called every update_interval seconds while a command runs (see _wait()):
+    pass the status of the process (see _proc_status()) to on_status(status)
+    and feed it, as an UPDATED_CLASSAD, to the `update_proc` script. The script
+    runs in the background so that the monitoring of the command is never
+    delayed: if it is still running at the next beat, that beat is skipped.
+    """
+    def __init__(self, on_status, update_proc, classad, environment, cwd,
+        timeout, kill_after):
+        self.on_status = on_status
+        self.update_proc = update_proc
+        self.classad = classad
+        self.environment = environment
+        self.cwd = cwd
+        self.timeout = timeout
+        self.kill_after = kill_after
+        self._thread = None
+        return
+
+    def __call__(self, pid, start_time):
+        status = _proc_status(pid, start_time)
+        if(self.on_status is not None):
+            try:
+                self.on_status(status)
+            except Exception:
+                log.exception('Status callback failed')
+        if(self.update_proc and self.classad and
+           (self._thread is None or not self._thread.is_alive())):
+            classad = self.classad + UPDATED_CLASSAD \
+                % dict(status, max_rss=status['rss'])
+            self._thread = threading.Thread(target=_exec,
+                                            args=([self.update_proc, ],
+                                                  classad, None, None,
+                                                  self.environment, False,
+                                                  self.cwd, self.timeout,
+                                                  self.kill_after))
+            self._thread.daemon = True
+            self._thread.start()
+        return
+
+    def join(self):
+        """
+        Wait for the last update_proc, if any, to exit.
+        """
+        if(self._thread is not None):
+            self._thread.join()
+        return
+
+class _Batch(object):
+    """
+    The [fn, argv, kwds] `requests` of a batch request (see Worker) and the
+    [index, response] list of their `results`. The slot threads running the
+    batch take calls with next() until there are none left and report each
+    response, None if there is none to send, with done(), which returns True
+    once all of them are in.
+    """
+    def __init__(self, requests):
+        self.results = []
+        self._calls = collections.deque(enumerate(requests))
+        self._left = len(requests)
+        self._lock = threading.Lock()
+        return
+
+    def next(self):
+        with self._lock:
+            if(not self._calls):
+                return(None)
+            return(self._calls.popleft())
+
+    def done(self, index, response):
+        with self._lock:
+            if(response is not None):
+                self.results.append([index, response])
+            self._left -= 1
+            return(not self._left)
+
+def _proc_status(pid, start_time):
+    """
+    Return the heartbeat of the running process `pid`: its pid, hostname,
+    start_time and elapsed time, its CPU times so far (in seconds) and its
+    current resident set size (in KB). CPU and memory are only available on
+    Linux (they are 0 elsewhere) and do not include the children of `pid`.
+    """
+    status = {'pid': pid, 'hostname': HOSTNAME, 'start_time': start_time,
+              'elapsed': time.time() - start_time, 'user_time': 0.,
+              'sys_time': 0., 'rss': 0}
+    try:
+        with open('/proc/%d/stat' % (pid)) as f:
+            # The command name can contain spaces: skip it.
+            fields = f.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+        return(status)
+    status['user_time'] = int(fields[11]) / CLOCK_TICKS
+    status['sys_time'] = int(fields[12]) / CLOCK_TICKS
+    status['rss'] = int(fields[21]) * PAGE_KB
+    return(status)
+
+def _decode_output(data):
+    # Results are JSON encoded: never let a partial or binary output break them.
+    return(data.decode('utf-8', 'replace'))
+
+def _tail_file(path, size):
+    """
+    Return the last `size` bytes of the file `path`, decoded, and remove it.
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - size, 0))
+            return(_decode_output(f.read()))
+    finally:
+        os.remove(path)
+
+def _resident_kb(pid='self'):
+    """
+    Return the current resident set size (in KB) of the process `pid`, 0 if
+    unknown (e.g. not on Linux).
+    """
+    try:
+        with open('/proc/%s/statm' % (pid)) as f:
+            return(int(f.read().split()[1]) * PAGE_KB)
+    except (IOError, IndexError, ValueError):
+        return(0)
+
+def _rusage_dict(rusage):
+    """
+    Turn the resource usage returned by wait4() into the resource entries of
+    the result dictionary. Memory is in KB, times in seconds. A None `rusage`
+    (e.g. the process was reaped by someone else) yields all zeros. Forked
+    processes inherit the maximum resident set size of their parent (see
+    system() and its rss_baseline).
+    """
+    if(rusage is None):
+        return({'user_time': 0., 'sys_time': 0., 'max_rss': 0,
+                'minor_faults': 0, 'major_faults': 0,
+                'voluntary_ctx_switches': 0, 'involuntary_ctx_switches': 0,
+                'block_reads': 0, 'block_writes': 0})
+    max_rss = rusage.ru_maxrss
+    if(sys.platform == 'darwin'):
+        # Bytes on OS X, KB everywhere else.
+        max_rss /= 1024
+    return({'user_time': rusage.ru_utime,
+            'sys_time': rusage.ru_stime,
+            'max_rss': max_rss,
+            'minor_faults': rusage.ru_minflt,
+            'major_faults': rusage.ru_majflt,
+            'voluntary_ctx_switches': rusage.ru_nvcsw,
+            'involuntary_ctx_switches': rusage.ru_nivcsw,
+            'block_reads': rusage.ru_inblock,
+            'block_writes': rusage.ru_oublock})
+
 def _exec(argv, stdin_str, stdout_filename, stderr_filename, environment,
-    getenv, cwd, timeout, kill_after):
+    getenv, cwd, timeout, kill_after, capture=0, on_output=None,
+    on_update=None, update_interval=0, cancel=None):
     """
-    System call with timeout. Return the process info dictionary. We assume we
-    are already in the right directory and that argv is a list of strings.
+    System call with timeout. Return the process info dictionary. We assume
+    that argv is a list of strings.
+
+    If `capture` is not 0, the last `capture` KB of stdout and stderr (unless
+    redirected to files) go in the 'stdout' and 'stderr' entries of the
+    process info dictionary and, if `on_output` is not None, each chunk of
+    output is passed to on_output(name, data) as soon as it is read, name being
+    either 'stdout' or 'stderr'.
+
+    If `on_update` is not None, it is called as on_update(pid, start_time)
+    every `update_interval` seconds while the command runs.
+
+    If `cancel` is not None, it is a threading.Event: once set, the command is
+    terminated as if it had timed out and 'cancelled' is True in the process
+    info dictionary.
+
+    If a fork server is running and argv[0] (or its basename) is a registered
+    entry point (see FORK_SERVER and ENTRY_POINTS), the command is executed by
+    forking the warm fork server instead of starting a new process. Its output
+    is then captured through temporary files and never passed to `on_output`.
     """
     # pylint: disable=E1101
-    terminated_t = None
     res = {'exit_code': None, 'stdout': '', 'stderr': '', 'argv': argv,
            'hostname': HOSTNAME, 'start_time': None, 'exec_time': None,
-           'terminated': False, 'signal': None, 'cwd': cwd, 'pid': None}
+           'terminated': False, 'signal': None, 'cwd': cwd, 'pid': None,
+           'cancelled': False, 'rss_baseline': 0}
+    res.update(_rusage_dict(None))
+
+    entry_point = None
+    if(FORK_SERVER is not None):
+        entry_point = ENTRY_POINTS.get(argv[0],
+                                       ENTRY_POINTS.get(os.path.basename(argv[0])))
+    if(entry_point is not None):
+        # The fork server cannot hand us pipes: capture through files.
+        captured = {}
+        if(capture and not stdout_filename):
+            stdout_filename = captured['stdout'] = tempfile.mkstemp()[1]
+        if(capture and not stderr_filename):
+            stderr_filename = captured['stderr'] = tempfile.mkstemp()[1]
+        start_time = time.time()
+        res['start_time'] = start_time
+        res['rss_baseline'] = _resident_kb(FORK_SERVER.pid)
+        try:
+            proc = waiter = FORK_SERVER.spawn(entry_point, argv, stdin_str,
+                                              stdout_filename, stderr_filename,
+                                              _setup_environment(getenv,
+                                                                 environment),
+                                              cwd)
+            res = _wait(res, proc, waiter, start_time, timeout, kill_after,
+                        on_update, update_interval, cancel)
+        finally:
+            for (name, path) in captured.items():
+                res[name] = _tail_file(path, capture * 1024)
+        return(res)
 
     stdin = None
     if(stdin_str):
@@ -65,16 +487,21 @@ def _exec(argv, stdin_str, stdout_filename, stderr_filename, environment,
             stdout_file = open(stdout_filename, 'w')
         except:
             pass
+    elif(capture):
+        stdout_file = subprocess.PIPE
     stderr_file = None
     if(stderr_filename):
         try:
             stderr_file = open(stderr_filename, 'w')
         except:
             pass
+    elif(capture):
+        stderr_file = subprocess.PIPE
 
     start_time = time.time()
     cmd_env = _setup_environment(getenv, environment)
     res['start_time'] = start_time
+    res['rss_baseline'] = _resident_kb()
     proc = subprocess.Popen(argv,
                             stdout=stdout_file,
                             stderr=stderr_file,
@@ -83,37 +510,92 @@ def _exec(argv, stdin_str, stdout_filename, stderr_filename, environment,
                             cwd=cwd)
     if(stdin_str):
         stdin.close()
+    readers = []
+    for (name, pipe) in (('stdout', proc.stdout), ('stderr', proc.stderr)):
+        if(pipe is not None):
+            readers.append(_OutputReader(pipe, name, capture * 1024,
+                                         on_output))
+
+    res = _wait(res, proc, _ChildWaiter(proc), start_time, timeout, kill_after,
+                on_update, update_interval, cancel)
+    for reader in readers:
+        res[reader.name] = reader.tail(kill_after)
+    if(stdout_file and stdout_file != subprocess.PIPE):
+        stdout_file.close()
+    if(stderr_file and stderr_file != subprocess.PIPE):
+        stderr_file.close()
+    del(proc)
+    return(res)
 
-    while(proc.poll() is None):
-        if(timeout > 0 and time.time() - start_time >= timeout):
-            res['terminated'] = True
-            terminated_t = time.time()
-            msg = '%s still executing after timeout of %s s. Sending SIGTERM'
-            proc.terminate()
+def _wait(res, proc, waiter, start_time, timeout, kill_after, on_update=None,
+    update_interval=0, cancel=None):
+    """
+    Wait for the process `proc` started at `start_time` to exit, through its
+    `waiter`, enforcing `timeout` and `kill_after`, calling `on_update` every
+    `update_interval` seconds and checking `cancel` (see _exec()). Fill in and
+    return the result dictionary `res`.
+    """
+    # Block until the process exits, the timeout expires or the call is
+    # cancelled, then escalate from SIGTERM to SIGKILL as soon as kill_after
+    # has elapsed.
+    deadline = None
+    if(timeout > 0):
+        deadline = start_time + timeout
+    next_update = None
+    if(on_update is not None and update_interval > 0):
+        next_update = start_time + update_interval
+    while(True):
+        wait_time = None
+        for t in (deadline, next_update):
+            if(t is not None and (wait_time is None or
+                                  t - time.time() < wait_time)):
+                wait_time = max(t - time.time(), 0)
+        if(cancel is not None and (wait_time is None or
+                                   wait_time > CANCEL_POLL)):
+            wait_time = CANCEL_POLL
+        exited = waiter.wait(wait_time)
+        now = time.time()
+        if(exited or (deadline is not None and now >= deadline)):
+            break
+        if(cancel is not None and cancel.is_set()):
+            res['cancelled'] = True
             break
-        time.sleep(.1)
+        if(next_update is not None and now >= next_update):
+            on_update(proc.pid, start_time)
+            next_update = now + update_interval
     res['exec_time'] = time.time() - start_time
 
-    if(terminated_t is not None):
-        if(proc.poll() is None):
-            time.sleep(kill_after)
-        if(proc.poll() is None):
-            msg = '%s still executing after %s s since SIGTERM. Sending SIGKILL'
-            proc.kill()
+    if(not exited):
+        res['terminated'] = True
+        if(not res['cancelled']):
+            log.warning('%s still executing after timeout of %s s. ' + \
+                        'Sending SIGTERM', res['argv'], timeout,
+                        extra={'fields': {'pid': proc.pid}})
+        waiter.terminate()
+        if(not waiter.wait(kill_after)):
+            log.warning('%s still executing after %s s since SIGTERM. ' + \
+                        'Sending SIGKILL', res['argv'], kill_after,
+                        extra={'fields': {'pid': proc.pid}})
+            waiter.kill()
+            waiter.wait()
+    waiter.close()
 
     res['pid'] = proc.pid
     res['exit_code'] = proc.returncode
-    if(stdout_file):
-        stdout_file.close()
-    if(stderr_file):
-        stderr_file.close()
-    del(proc)
+    if(waiter.error is not None):
+        res['error'] = waiter.error
+    elif(os.WIFSIGNALED(waiter.status)):
+        res['signal'] = os.WTERMSIG(waiter.status)
+    res.update(_rusage_dict(waiter.rusage))
     return(res)
 
 def system(argv, environment=None, getenv=True, timeout=600, kill_after=10,
     root_dir=None, cleanup_after_errors=True, cwd=None,
     pre_proc=None, update_proc=None, post_proc=None, update_interval=1,
-    classad=None, output=None, error=None, input=None, retries=3):
+    classad=None, output=None, error=None, input=None,
+    retries=DEFAULT_RETRIES, inputs=None, outputs=None, cache=False,
+    cache_env=None, stage_in=None, stage_out=None, capture=0, on_output=None,
+    on_status=None, cancel=None):
     """
     Execute the command line command described by the `argv` list. It is assumed
     that `argv[0]` is the executable and `argv[1:]`, if non empty, is its
@@ -136,7 +618,9 @@ def system(argv, environment=None, getenv=True, timeout=600, kill_after=10,
     If `root_dir` is not None, it specify the root directory where a temporary
     directory will be created for the command to execute in. After the command
     has exited the temporary directory is removed (see also `cwd` and
-    `cleanup_after_errors`).
+    `cleanup_after_errors`). Workers started with a working directory pool
+    (see workdirs.py) remove it in the background, after we return, and may
+    create it on a tmpfs instead.
 
     If `cleanup_after_errors` == True and the command is either killed or exits
     with a non 0 status, then the temporary directory (if it was created) is
@@ -151,7 +635,9 @@ def system(argv, environment=None, getenv=True, timeout=600, kill_after=10,
     `pre_proc`, `post_proc` and `update_proc` if not None specify scripts to
     execute, just before, just after and every `update_interval` seconds while
     `argv` is running. Each of these three scripts, if defined, receives in
-    STDIN the job `classad`. The `update_proc` script receives as commend-line
+    STDIN the job `classad` (augmented with UPDATED_CLASSAD for `update_proc`,
+    which runs in the background and is skipped if the previous one is still
+    running). The `update_proc` script receives as commend-line
     argument a string describing how the commend exited. Valid values are
     (exit, remove, hold, evict). Right now we only support exit.
 
@@ -164,6 +650,51 @@ def system(argv, environment=None, getenv=True, timeout=600, kill_after=10,
     In the latter case, they are assumed to be relative to `cwd` or `work_dir`,
     whichever is defined.
 
+    The command is run once. `retries` is the number of times the Worker
+    runs a command which exits with a non 0 status again, each attempt as a
+    separate request: failed calls go back to the queue, with a backoff, so
+    that the next attempt can run on another host (see Worker). system()
+    itself ignores it.
+
+    If `capture` is not 0, the stdout and stderr of the command which are not
+    redirected to files are captured and their last `capture` KB returned in
+    the 'stdout' and 'stderr' entries of the result dictionary. `on_output`, if
+    not None, is then called as on_output(name, data) with every chunk of
+    output as soon as the command writes it (name is 'stdout' or 'stderr').
+    The worker uses it for calls submitted with stream=True, which also turns
+    capture on, to send the output to the client while the command runs.
+
+    `on_status`, if not None, is called as on_status(status) every
+    `update_interval` seconds while the command runs, with a heartbeat
+    dictionary describing it: pid, hostname, start_time, elapsed, user_time,
+    sys_time and (current) rss. The worker publishes them to STATUS_EXCHANGE.
+
+    `cancel`, if not None, is a threading.Event which the worker sets when the
+    call is cancelled (see Worker.on_control()): the command is then
+    terminated, as on timeout, not retried and 'cancelled' is True in the
+    result dictionary.
+
+    `inputs` and `outputs`, if defined, are the lists of the files (relative to
+    `cwd` or `work_dir`, or absolute) read and written by the command.
+
+    If `cache` is True (or a string tag, see cache.py) and the worker has a
+    result cache, the command is only executed if no previous successful run
+    with the same argv, executable, `inputs` (and `input`) content and values
+    of the `cache_env` environment variables is in the cache. Otherwise its
+    `outputs` are restored from the cache and its result dictionary returned,
+    with 'cached' set to True, 'hostname' and 'cwd' those of this call and
+    'pid' and 'start_time' None (its exec_time and resource usage are those
+    of the cached run). Either way, 'cache_key' is the cache key of the
+    command. The *_proc scripts are executed in both cases.
+
+    `stage_in` and `stage_out` are used when the worker does not share a
+    filesystem with the client (see staging.py). `stage_in` is the list of
+    [name, digest, size] of the files which the worker fetched from the client
+    before calling us: they are linked (read only) into the working directory
+    under their name. `stage_out` is the list of the files (relative to the
+    working directory) to be sent back to the client, whether the command
+    succeeded or not: the result 'staged_outputs' entry lists them.
+
     Typical use of the *_proc scripts is to create and update database entries
     relative to the job being executed, e.g. in a blackboard architecture. The
     output of these scripts is simply ignored, just like their exit code. One
@@ -179,124 +710,257 @@ def system(argv, environment=None, getenv=True, timeout=600, kill_after=10,
          'start_time':  <float>,
          'exec_time':   <float>,
          'terminated':  <bool>,
-         'cwd':         <str>}
+         'cancelled':   <bool>,
+         'signal':      <integer>,
+         'cwd':         <str>,
+         'pid':         <integer>,
+         'user_time':   <float>,
+         'sys_time':    <float>,
+         'max_rss':     <integer>,
+         'rss_baseline':    <integer>,
+         'minor_faults':    <integer>,
+         'major_faults':    <integer>,
+         'voluntary_ctx_switches':      <integer>,
+         'involuntary_ctx_switches':    <integer>,
+         'block_reads': <integer>,
+         'block_writes':    <integer>,
+         'timings':     <list>}
+
+    where user_time to block_writes describe the resources used by the command
+    (CPU times in seconds, maximum resident set size in KB, page faults,
+    context switches and block I/O operations). On Linux, max_rss includes the
+    memory the command inherited, before exec, from the process it was forked
+    from: the worker, or the fork server for entry points. rss_baseline is the
+    resident size (KB) of that process when the command started: a max_rss
+    not above it only says that the command used no more than that.
+
+    `signal` is the number of the signal which terminated the command, if any.
+    If the exit status of the command could not be collected, 'exit_code' is
+    -1 and 'error' says why.
+
+    The dictionary also has a 'timings' entry: the list of [phase, start, end]
+    timestamps of each phase of the execution (workdir, environment,
+    pre_proc, proc, post_proc and cleanup). The worker and
+    the client add their own phases to it (see Worker.on_request() and
+    Worker._run_call()).
     """
-    if(retries is None or retries < 0):
-        retries = 0
-    else:
-        try:
-            retries = int(retries)
-        except:
-            retries = 0
+    if((stage_in or stage_out) and STAGE_STORE is None):
+        raise ValueError('File staging is not enabled on this worker')
 
     # Stringify argv.
     argv = map(unicode, argv)
+    timings = []
+    t = time.time()
 
-    # Create a temp work dir and cd into it, assuming cwd is None.
-    here = os.getcwd()
+    # Create a temp work dir, assuming cwd is None. We never chdir into it
+    # (the current directory is process-wide and jobs may run concurrently):
+    # processes are started there and relative paths are resolved against it.
     created_word_dir = False
     if(cwd):
-        work_dir = cwd
+        work_dir = os.path.abspath(cwd)
     elif(root_dir):
         work_dir = _mkworkdir(root_dir)
         created_word_dir = True
+        t = _mark(timings, 'workdir', t)
     else:
-        work_dir = here
-    os.chdir(work_dir)
+        work_dir = os.getcwd()
 
+    cache_inputs = list(inputs or [])
     if(input):
-        input = os.path.abspath(input)
+        cache_inputs.append(input)
+        input = os.path.join(work_dir, input)
     else:
         input = None
     if(output):
-        output = os.path.abspath(output)
+        output = os.path.join(work_dir, output)
     else:
         output = None
     if(error):
-        error = os.path.abspath(error)
+        error = os.path.join(work_dir, error)
     else:
         error = None
 
+    # Staged inputs are linked from the node local file store.
+    if(stage_in):
+        for (name, digest, size) in stage_in:
+            STAGE_STORE.link(digest, os.path.join(work_dir, name))
+            cache_inputs.append(name)
+        t = _mark(timings, 'stage_in', t)
+
+    # The environment is the same for all the processes we start.
+    cmd_env = _setup_environment(getenv, environment)
+    t = _mark(timings, 'environment', t)
+
     # Pre
     pre_res = {}
     if(pre_proc and classad):
-        print(' [.] %s - running PRE job (%s)' \
-            % (str(datetime.datetime.utcnow()), pre_proc))
+        log.debug('Running PRE job %s', pre_proc)
         pre_res = _exec(argv=[pre_proc, ],
                         stdin_str=classad,
                         stdout_filename=None,
                         stderr_filename=None,
-                        environment=environment,
-                        getenv=getenv,
+                        environment=cmd_env,
+                        getenv=False,
                         cwd=work_dir,
                         timeout=timeout,
                         kill_after=kill_after)
-        print(' [.] %s - PRE DONE (exit code: %d)' \
-            % (str(datetime.datetime.utcnow()), pre_res['exit_code']))
-
-    # Proc
-    print(' [.] %s - running PROC job (%s)' \
-        %(str(datetime.datetime.utcnow()), ' '.join(argv)))
-    proc_error = True
-    while(retries >= 0 and proc_error):
+        t = _mark(timings, 'pre_proc', t)
+        log.info('PRE job done',
+                 extra={'fields': {'argv': [pre_proc, ],
+                                   'exit_code': pre_res['exit_code']}})
+
+    # The heartbeat also runs update_proc.
+    heartbeat = None
+    if(on_status is not None or (update_proc and classad)):
+        heartbeat = _Heartbeat(on_status, update_proc, classad, cmd_env,
+                               work_dir, timeout, kill_after)
+
+    # Proc, unless an identical run is in the result cache.
+    res = None
+    cache_key = None
+    if(cache and RESULT_CACHE is not None):
+        tag = None
+        if(isinstance(cache, basestring)):
+            tag = cache
+        cache_key = RESULT_CACHE.key(argv, cmd_env, cache_env, cache_inputs,
+                                     work_dir, tag)
+        res = RESULT_CACHE.get(cache_key, work_dir, outputs)
+        t = _mark(timings, 'cache', t)
+    if(res is not None):
+        log.info('Job cached',
+                 extra={'fields': {'argv': argv, 'cache_key': cache_key}})
+        res.update({'hostname': HOSTNAME, 'cwd': work_dir, 'pid': None,
+                    'start_time': None})
+    else:
+        log.debug('Running job', extra={'fields': {'argv': argv}})
+        t = time.time()
         res = _exec(argv=argv,
                     stdin_str=None,
                     stdout_filename=output,
                     stderr_filename=error,
-                    # stdout_filename=None,
-                    # stderr_filename=None,
-                    environment=environment,
-                    getenv=getenv,
+                    environment=cmd_env,
+                    getenv=False,
                     cwd=work_dir,
                     timeout=timeout,
-                    kill_after=kill_after)
+                    kill_after=kill_after,
+                    capture=capture,
+                    on_output=on_output,
+                    on_update=heartbeat,
+                    update_interval=update_interval,
+                    cancel=cancel)
+        t = _mark(timings, 'proc', t)
         proc_error = res['exit_code'] != 0
-        if(proc_error):
-            retries -= 1
-            time.sleep(.1)
-    print(' [.] %s - PROC DONE (exit code: %d)' \
-        % (str(datetime.datetime.utcnow()), res['exit_code']))
+        log.info('Job done',
+                 extra={'fields': {'argv': argv,
+                                   'exit_code': res['exit_code'],
+                                   'exec_time': res['exec_time'],
+                                   'cancelled': res['cancelled']}})
 
-    # Update
-    # TODO: Implement update_proc
+        if(cache_key is not None and not proc_error and not res['terminated']):
+            RESULT_CACHE.put(cache_key, res, work_dir, outputs)
+            t = _mark(timings, 'cache_store', t)
+            res['cached'] = False
+    if(cache_key is not None):
+        res['cache_key'] = cache_key
+        res.setdefault('cached', True)
+
+    # Update: make sure the last update_proc is done before post_proc.
+    if(heartbeat is not None):
+        heartbeat.join()
 
     # Post, only if pre_proc exited OK or was not defined. Also agument the
     # classad with process-related info.
     if(post_proc and pre_res.get('exit_code', 0) == 0 and classad):
-        print(' [.] %s - running POST job (%s)' \
-            %(str(datetime.datetime.utcnow()), post_proc))
+        log.debug('Running POST job %s', post_proc)
         classad += EXITED_CLASSAD % res
         post_res = _exec(argv=[post_proc, 'exit'],
                          stdin_str=classad,
                          stdout_filename=None,
                          stderr_filename=None,
-                         environment=environment,
-                         getenv=getenv,
+                         environment=cmd_env,
+                         getenv=False,
                          cwd=work_dir,
                          timeout=timeout,
                          kill_after=kill_after)
-        print(' [.] %s - POST DONE (exit code: %d)' \
-            % (str(datetime.datetime.utcnow()), post_res['exit_code']))
+        t = _mark(timings, 'post_proc', t)
+        log.info('POST job done',
+                 extra={'fields': {'argv': [post_proc, 'exit'],
+                                   'exit_code': post_res['exit_code']}})
+
+    # Move the staged outputs out of the way of the cleanup: the worker sends
+    # them to the client before replying (see Worker._send_files()).
+    if(stage_out):
+        t = time.time()
+        res['staged_outputs'] = []
+        for name in stage_out:
+            path = os.path.join(work_dir, name)
+            if(os.path.isfile(path)):
+                res['staged_outputs'].append([name, STAGE_STORE.spool(path)])
+        t = _mark(timings, 'stage_out', t)
 
     # Cleanup after yourselves!
-    os.chdir(here)
     failed = res['exit_code'] != 0 or res['terminated']
 
     if(not created_word_dir or not cleanup_after_errors):
         if(failed):
-            msg = 'Process exited with errors/was terminated. Work ' + \
-                  'directory %s not removed.' % (work_dir)
-            print(msg)
+            log.warning('Process exited with errors/was terminated. Work ' + \
+                        'directory %s not removed.', work_dir)
     else:
+        t = time.time()
         _rmworkdir(work_dir)
+        t = _mark(timings, 'cleanup', t)
+    res['timings'] = timings
     return(res)
 
+def retry_queue_name(queue, level):
+    """
+    Return the name of the delay queue of backoff `level` of `queue`.
+    """
+    return('%s.retry.%d' % (queue, level))
+
+def _backoff(attempt):
+    """
+    Return the (delay, backoff level) of the retry of a request whose attempt
+    number `attempt` failed.
+    """
+    level = min(attempt, RETRY_LEVELS)
+    delay = min(RETRY_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+    return(random.uniform(delay / 2., delay), level)
+
+def _max_attempts(retries):
+    try:
+        return(max(int(retries), 0) + 1)
+    except (TypeError, ValueError):
+        return(1)
+
+def queue_name(pool=None):
+    """
+    Return the name of the request queue of the worker pool `pool`. None is
+    the default pool.
+    """
+    if(pool is None):
+        return(QUEUE_NAME)
+    return('%s.%s' % (QUEUE_NAME, pool))
+
+def _mark(timings, phase, start):
+    """
+    Record in `timings` that `phase` ran from `start` to now. Return now.
+    """
+    now = time.time()
+    timings.append([phase, start, now])
+    return(now)
+
 def _mkworkdir(root_dir):
     """
     Create the temporary work directory under root_dir. Return the absolute path
     to the created temporary directory.
+
+    If the worker has a WorkdirManager, the directory comes from its pool
+    and might be placed on a tmpfs instead (see workdirs.py).
     """
     # FIXME: create as unprivileged user.
+    if(WORKDIRS is not None):
+        return(WORKDIRS.acquire(root_dir))
     tmpdir = tempfile.mkdtemp(dir=root_dir)
     return(tmpdir)
 
@@ -305,7 +969,13 @@ def _rmworkdir(path):
     Remove the temprary work directory and log any error which might occur. We
     otherwise do not act on these errors (apart form logging them), which means
     that the temporary directory might end up being partially left behind.
+
+    If the worker has a WorkdirManager, the directory is removed (or recycled)
+    in the background and we return immediately.
     """
+    if(WORKDIRS is not None):
+        WORKDIRS.release(path)
+        return
     shutil.rmtree(path, onerror=_failed_del_warn)
     return
 
@@ -321,7 +991,8 @@ def _setup_environment(getenv, extra_env):
         extra_env = {}
 
     if(getenv):
-        full_env = os.environ
+        # Copy: updating os.environ itself would leak into other jobs.
+        full_env = dict(os.environ)
     if(extra_env):
         full_env.update(extra_env)
     return(full_env)
@@ -331,46 +1002,948 @@ def _failed_del_warn(function, path, excinfo):
     Just log what happened (i.e. that we failed to remove a file or directory)
     and move on.
     """
-    msg = 'Error in removing %s. The parent directory will not be removed.'
-    print(msg % (path))
-
-    print('Error in calling %s on %s.' % (function.__name__, path))
-    print('Exception: %s %s' % (excinfo[0], excinfo[1]))
-    print('Traceback: %s' % (excinfo[-1]))
+    log.error('Error in removing %s (%s). The parent directory will not be ' + \
+              'removed.', path, function.__name__, exc_info=excinfo)
     return
 
-def on_request(ch, method, props, body):
-    [fn, argv, kwds] = json.loads(body)
+def _decode(body, received=None, content_type=None, content_encoding=None):
+    """
+    Decode the [fn, argv, kwds] request in `body`, in the format `content_type`
+    compressed with `content_encoding` (JSON by default, see
+    serialization.py). Return (fn, argv, kwds, timings), where timings
+    starts with the time spent waiting for an execution slot, since
+    `received`, if given.
+    """
+    timings = []
+    t = time.time()
+    if(received is not None):
+        timings.append(['slot_wait', received, t])
+    [fn, argv, kwds] = serialization.decode(body, content_type,
+                                            content_encoding)
+    t = _mark(timings, 'decode', t)
+    return(fn, argv, kwds, timings)
 
-    # print " [.] %s(%s)"  % (fn, ', '.join([unicode(arg) for arg in argv]))
+def _call(fn, argv, kwds, timings=None, exporter=None):
+    """
+    Execute fn(argv, **kwds) and return the response. `timings`, if not None,
+    are prepended to the response timings, which are then passed to the
+    export() method of `exporter`, if not None (see the metrics module). See
+    Worker._run_call().
+    """
     response = getattr(sys.modules[__name__], fn)(argv, **kwds)
+    if(isinstance(response, dict)):
+        response['timings'] = (timings or []) + response.get('timings', [])
+        if(exporter is not None):
+            exporter.export(response['timings'])
+    return(response)
 
+def _expand(argv, kwds, index, _id):
+    """
+    Return the (argv, kwds) of element `index` of an array request, whose id is
+    `_id`: %(index)d and %(id)s in argv and in the ARRAY_KWDS values of kwds
+    are replaced by the element index and id. Literal % have to be written %%.
+    """
+    values = {'index': index, 'id': _id}
+    argv = [arg % values if isinstance(arg, basestring) else arg
+            for arg in argv]
+    kwds = dict(kwds)
+    for key in ARRAY_KWDS:
+        if(isinstance(kwds.get(key), basestring)):
+            kwds[key] = kwds[key] % values
+    return(argv, kwds)
+
+def _reply(ch, reply_to, correlation_id, body, headers=None,
+    content_type=None, content_encoding=None):
+    # The time the reply was sent goes in a header since it cannot go in the
+    # body. Header values are strings to please every AMQP client library.
+    headers = dict(headers or {})
+    headers['spread_sent'] = '%.6f' % time.time()
     ch.basic_publish(exchange='',
-                     routing_key=props.reply_to,
+                     routing_key=reply_to,
                      properties=pika.BasicProperties(correlation_id = \
-                                                     props.correlation_id),
-                     body=json.dumps(response))
-    ch.basic_ack(delivery_tag = method.delivery_tag)
+                                                     correlation_id,
+                                                     headers=headers,
+                                                     content_type = \
+                                                     content_type,
+                                                     content_encoding = \
+                                                     content_encoding),
+                     body=body)
+    return
+
+def _error_response(e):
+    """
+    Return the response to a request which failed with the exception `e`.
+    """
+    return({'exit_code': -1,
+            'terminated': False,
+            'hostname': HOSTNAME,
+            'error': '%s: %s' % (e.__class__.__name__, e)})
+
+def _encode_reply(response, props, batch=False):
+    """
+    Encode `response`, the reply to the request with properties `props`, in
+    the format of the request, compressed if large and if the client accepts
+    it (see serialization.py). Return (body, content_type, content_encoding).
+    A response which cannot be encoded is replaced by an error, for each of
+    its [index, response] pairs if it is the reply to a `batch` request.
+    """
+    content_type = props.content_type
+    if(not serialization.supported(content_type)):
+        content_type = serialization.JSON
+    compress = None
+    if(serialization.accepts(props.headers)):
+        compress = serialization.COMPRESS_MIN
+    try:
+        return(serialization.encode(response, content_type, compress))
+    except Exception, e:
+        log.exception('Cannot encode the reply to %s', props.correlation_id)
+        if(batch):
+            response = [[index, _error_response(e)]
+                        for (index, _) in response]
+        else:
+            response = _error_response(e)
+        return(serialization.encode(response, content_type, compress))
+
+
+
+
+class Worker(object):
+    """
+    Execute up to `slots` requests at the same time over a single connection to
+    the broker (either the host name of the RabbitMQ broker or a local:// URL,
+    see local.py).
+
+    Requests are handed to a pool of `slots` threads, each of which runs one
+    job at a time. The broker delivers at most `slots` unacknowledged requests
+    to us (prefetch) and each request is acknowledged, from the connection
+    thread, as soon as its reply has been published.
+
+    Array requests (see client.system_array) describe a range of elements. We
+    claim the first `chunk` of them (our number of slots by default), hand the
+    rest of the range back to the queue, split in two halves for other workers
+    to pick up, and reply once per element. The request is acknowledged once
+    all the elements we claimed are done.
+
+    Batch requests (see client.Batcher) are lists of calls run by the same
+    worker, in at most as many slots as the spread_batch header says (0 for
+    all of them). We reply once, when all the calls are done, with the
+    [index, response] list of their results: element i replies as
+    <correlation_id>.<i>, as array elements do, when it has to reply on its
+    own (retries, streamed output and staged outputs).
+
+    While a system() call runs, its heartbeat (see system()) is published
+    every update_interval seconds, as JSON together with its correlation_id,
+    to the STATUS_EXCHANGE fanout exchange with our host name as routing key.
+
+    Requests with staged input files (see staging.py) are only handed to the
+    slots once all of their files are in the node local store: the missing
+    ones are fetched from the client, in the connection thread, meanwhile.
+
+    Failed system() calls are not retried on the spot: each attempt is a
+    separate request. After a failure, the request goes to the delay queue of
+    its backoff level (see RETRY_DELAY) and from there, once its delay has
+    expired, back to its queue, with its attempt number in the spread_attempt
+    header and the hosts it failed on in spread_failed_on. Once all the
+    attempts have failed, the last result goes to the client as usual and,
+    together with the request, to DEAD_LETTER_QUEUE. Requests redelivered by
+    the broker (their worker went away) are requeued the same way, but counted
+    in the spread_lost header rather than as attempts (see MAX_REDELIVERIES).
+
+    Calls can be cancelled by correlation_id through the CONTROL_EXCHANGE
+    fanout exchange, see on_control().
+
+    On SIGTERM (see drain()) we stop taking requests, finish the ones we hold
+    and run() returns.
+
+    We serve the requests of the worker `pools` listed (names, None being the
+    default pool), e.g. only workers with lots of memory serve the 'highmem'
+    pool. Within each pool, requests with a higher priority are served first.
+    """
+    def __init__(self, broker_host='localhost', slots=1, exporter=None,
+        pools=None):
+        self.slots = max(int(slots), 1)
+        self.exporter = exporter
+        self.queues = [queue_name(pool) for pool in pools or [None, ]]
+
+        self.connection = local.connect(broker_host)
+        self.channel = self.connection.channel()
+        for queue in self.queues:
+            self.channel.queue_declare(queue=queue, arguments=QUEUE_ARGUMENTS)
+            for level in range(1, RETRY_LEVELS + 1):
+                self.channel.queue_declare(queue=retry_queue_name(queue, level),
+                                           arguments={
+                                               'x-dead-letter-exchange': '',
+                                               'x-dead-letter-routing-key': \
+                                                   queue})
+        self.channel.queue_declare(queue=DEAD_LETTER_QUEUE)
+        self.channel.basic_qos(prefetch_count=self.slots)
+        # Staged files fetched from the clients come in on our private queue.
+        result = self.channel.queue_declare(exclusive=True)
+        self.file_queue = result.method.queue
+        self.channel.exchange_declare(exchange=STATUS_EXCHANGE,
+                                      exchange_type='fanout')
+        # Control messages are broadcast to every worker.
+        self.channel.exchange_declare(exchange=CONTROL_EXCHANGE,
+                                      exchange_type='fanout')
+        result = self.channel.queue_declare(exclusive=True)
+        self.control_queue = result.method.queue
+        self.channel.queue_bind(queue=self.control_queue,
+                                exchange=CONTROL_EXCHANGE)
+
+        # Items are (delivery_tag, queue, props, correlation_id, request,
+        # received) where request is either the message body or a decoded
+        # request.
+        self._requests = Queue.Queue()
+        # Messages to publish, see _publish().
+        self._replies = Queue.Queue()
+        # JSON heartbeats of the running jobs (see system()).
+        self._heartbeats = Queue.Queue()
+        # Files being fetched: {digest: [Download, last chunk time, parked]}
+        # where parked is the list of [request, missing digests] waiting for
+        # them and request is the on_request() (method, props, body, received).
+        self._downloads = {}
+        # {delivery_tag: number of replies still to publish}
+        self._unacked = {}
+        # Cancellation events of the running system() calls: {correlation_id:
+        # threading.Event}
+        self._cancels = {}
+        # Recently cancelled calls: {correlation_id: time}, oldest first.
+        self._cancelled = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Slot threads write to this pipe to wake up the connection thread.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._draining = False
+        self._consumer_tags = []
+        self._threads = []
+        for i in range(self.slots):
+            thread = threading.Thread(target=self._run_slot)
+            thread.daemon = True
+            self._threads.append(thread)
+        return
+
+    def on_request(self, ch, method, props, body):
+        received = time.time()
+        if(self._is_cancelled(props.correlation_id)):
+            # The client is not waiting for it anymore.
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        if(not serialization.supported(props.content_type,
+                                       props.content_encoding)):
+            log.error('Request %s in unknown format %s (%s)',
+                      props.correlation_id, props.content_type,
+                      props.content_encoding)
+            _reply(self.channel, props.reply_to, props.correlation_id,
+                   json.dumps(_error_response(ValueError('Unknown format'))))
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        headers = props.headers or {}
+        if(HOSTNAME in headers.get('spread_failed_on', '').split(',') and
+           int(headers.get('spread_bounces', 0)) < MAX_BOUNCES):
+            # Give workers on other hosts a chance to retry it.
+            self._requeue(method, props, body, method.routing_key,
+                          spread_bounces=str(int(headers.get('spread_bounces',
+                                                             0)) + 1))
+            return
+        if(method.redelivered):
+            self._on_redelivered(method, props, body)
+            return
+        if(props.headers and props.headers.get('spread_stage')):
+            digests = props.headers['spread_stage'].split(',')
+            self._stage_in((method, props, body, received), digests)
+            return
+        self._dispatch(method, props, body, received)
+        return
+
+    def _dispatch(self, method, props, body, received):
+        if(props.headers and props.headers.get('spread_array')):
+            self._on_array_request(method, props, body, received)
+            return
+        if(props.headers and props.headers.get('spread_batch')):
+            self._on_batch_request(method, props, body, received)
+            return
+
+        self._unacked[method.delivery_tag] = 1
+        self._requests.put((method.delivery_tag, method.routing_key, props,
+                            props.correlation_id, body, received))
+        return
+
+    def _requeue(self, method, props, body, routing_key, expiration=None,
+        **headers):
+        """
+        Publish the request again to `routing_key`, with the extra `headers`,
+        and acknowledge the original.
+        """
+        headers = dict(props.headers or {}, **headers)
+        headers.pop('spread_sent', None)
+        self.channel.basic_publish(exchange='',
+                                   routing_key=routing_key,
+                                   properties=pika.BasicProperties(
+                                       reply_to=props.reply_to,
+                                       correlation_id=props.correlation_id,
+                                       priority=props.priority,
+                                       expiration=expiration,
+                                       headers=headers,
+                                       content_type=props.content_type,
+                                       content_encoding=\
+                                           props.content_encoding),
+                                   body=body)
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    def _on_redelivered(self, method, props, body):
+        """
+        The worker which got the request before us went away. We cannot tell
+        whether it had started the request or only prefetched it: requeue it
+        without counting a failed attempt, unless it was lost MAX_REDELIVERIES
+        times already.
+        """
+        headers = props.headers or {}
+        lost = int(headers.get('spread_lost', 0)) + 1
+        if(lost < MAX_REDELIVERIES):
+            (delay, level) = _backoff(lost)
+            self._requeue(method, props, body,
+                          retry_queue_name(method.routing_key, level),
+                          expiration=str(int(delay * 1000)),
+                          spread_lost=str(lost))
+            return
+
+        log.warning('Call %s lost %d workers, giving up',
+                    props.correlation_id, lost)
+        response = {'exit_code': -1,
+                    'terminated': False,
+                    'hostname': HOSTNAME,
+                    'attempts': int(headers.get('spread_attempt', 1)),
+                    'error': 'Worker lost %d times' % (lost)}
+        correlation_ids = [props.correlation_id, ]
+        request = serialization.decode(body, props.content_type,
+                                       props.content_encoding)
+        if(headers.get('spread_array')):
+            array = request[3]
+            correlation_ids = ['%s.%d' % (props.correlation_id, index)
+                               for index in range(array['start'],
+                                                  array['stop'])]
+        elif(headers.get('spread_batch')):
+            correlation_ids = ['%s.%d' % (props.correlation_id, index)
+                               for index in range(len(request))]
+        self._dead_letter(props, request, response)
+        reply = _encode_reply(response, props)
+        for correlation_id in correlation_ids:
+            _reply(self.channel, props.reply_to, correlation_id, reply[0],
+                   content_type=reply[1], content_encoding=reply[2])
+        self.channel.basic_ack(delivery_tag=method.delivery_tag)
+        return
+
+    def _dead_letter(self, props, request, response):
+        """
+        Record the request whose workers were all lost in DEAD_LETTER_QUEUE.
+        Only call from the connection thread (see _publish() otherwise).
+        """
+        self.channel.basic_publish(exchange='',
+                                   routing_key=DEAD_LETTER_QUEUE,
+                                   properties=pika.BasicProperties(
+                                       correlation_id=props.correlation_id,
+                                       headers=props.headers),
+                                   body=json.dumps({'request': request,
+                                                    'result': response}))
+        return
+
+    def _stage_in(self, request, digests):
+        """
+        Dispatch `request` as soon as all the files in `digests` are in the
+        node local store, fetching the missing ones from the client.
+        """
+        missing = set()
+        if(STAGE_STORE is not None):
+            missing = set([d for d in digests if not STAGE_STORE.has(d)])
+        if(not missing):
+            self._dispatch(*request)
+            return
+
+        parked = [request, missing]
+        props = request[1]
+        for digest in missing:
+            if(digest not in self._downloads):
+                self._downloads[digest] = [STAGE_STORE.writer(digest),
+                                           time.time(), []]
+                self.channel.basic_publish(exchange='',
+                                           routing_key=props.reply_to,
+                                           properties=pika.BasicProperties(
+                                               reply_to=self.file_queue,
+                                               correlation_id=digest,
+                                               headers={'spread_fetch': '1'}),
+                                           body='')
+            self._downloads[digest][2].append(parked)
+        return
+
+    def on_control(self, ch, method, props, body):
+        """
+        Handle a control message: a JSON dictionary whose 'cancel' entry is the
+        list of the correlation_ids of the calls to cancel (that of an array
+        request cancels all of its elements). Those running here are
+        terminated and reply with 'cancelled' set. Those still queued are
+        dropped when they reach us, for CANCEL_MEMORY seconds.
+        """
+        try:
+            message = json.loads(body)
+        except ValueError:
+            log.warning('Invalid control message %r', body)
+            return
+        now = time.time()
+        with self._lock:
+            while(self._cancelled and
+                  self._cancelled.itervalues().next() < now - CANCEL_MEMORY):
+                self._cancelled.popitem(last=False)
+            for correlation_id in message.get('cancel', []):
+                self._cancelled[correlation_id] = now
+                for (c, cancel) in self._cancels.items():
+                    if(correlation_id in (c, c.rsplit('.', 1)[0])):
+                        log.info('Cancelling %s', c)
+                        cancel.set()
+        return
+
+    def _is_cancelled(self, correlation_id):
+        """
+        Return True if the call `correlation_id` (or, for an array element,
+        its whole array) has been cancelled. Thread safe.
+        """
+        if(correlation_id is None):
+            return(False)
+        with self._lock:
+            return(correlation_id in self._cancelled or
+                   correlation_id.rsplit('.', 1)[0] in self._cancelled)
+
+    def on_file_chunk(self, ch, method, props, body):
+        digest = props.correlation_id
+        if(digest not in self._downloads):
+            return
+        download = self._downloads[digest]
+        download[1] = time.time()
+        headers = props.headers or {}
+        try:
+            if(headers.get('spread_error')):
+                raise IOError(headers['spread_error'])
+            download[0].write(int(headers['spread_offset']), body)
+            if(headers['spread_last'] != '1'):
+                return
+            download[0].commit()
+        except (IOError, OSError), e:
+            # The jobs waiting for the file fail when they do not find it.
+            log.error('Could not fetch staged file %s: %s', digest, e)
+            download[0].abort()
+        self._release(digest)
+        return
+
+    def _release(self, digest):
+        """
+        Forget about the download of `digest` (done or failed) and dispatch the
+        requests which were only waiting for it.
+        """
+        (_, _, parked) = self._downloads.pop(digest)
+        for (request, missing) in parked:
+            missing.discard(digest)
+            if(not missing):
+                self._dispatch(*request)
+        return
+
+    def _expire_downloads(self):
+        now = time.time()
+        for (digest, download) in self._downloads.items():
+            if(now - download[1] > FETCH_TIMEOUT):
+                log.error('Fetching staged file %s timed out', digest)
+                download[0].abort()
+                self._release(digest)
+        return
+
+    def _on_array_request(self, method, props, body, received):
+        [fn, argv, kwds, array] = serialization.decode(body,
+                                                       props.content_type,
+                                                       props.content_encoding)
+        start = array['start']
+        stop = array['stop']
+        ids = array.get('ids')
+        chunk = array.get('chunk') or self.slots
+
+        claimed = min(start + chunk, stop)
+        if(claimed < stop):
+            mid = stop
+            if(stop - claimed > chunk):
+                mid = claimed + (stop - claimed + 1) // 2
+            for (lo, hi) in ((claimed, mid), (mid, stop)):
+                if(lo >= hi):
+                    continue
+                sub_array = dict(array, start=lo, stop=hi)
+                if(ids is not None):
+                    sub_array['ids'] = ids[lo - start:hi - start]
+                compress = None
+                if(props.content_encoding):
+                    compress = serialization.COMPRESS_MIN
+                (sub_body, content_type, content_encoding) = \
+                    serialization.encode([fn, argv, kwds, sub_array],
+                                         props.content_type, compress)
+                self.channel.basic_publish(exchange='',
+                                           routing_key=method.routing_key,
+                                           properties=pika.BasicProperties(
+                                               reply_to=props.reply_to,
+                                               correlation_id=\
+                                                   props.correlation_id,
+                                               priority=props.priority,
+                                               headers=props.headers,
+                                               content_type=content_type,
+                                               content_encoding=\
+                                                   content_encoding),
+                                           body=sub_body)
+
+        if(claimed == start):
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        self._unacked[method.delivery_tag] = claimed - start
+        for index in range(start, claimed):
+            _id = index
+            if(ids is not None):
+                _id = ids[index - start]
+            (elem_argv, elem_kwds) = _expand(argv, kwds, index, _id)
+            self._requests.put((method.delivery_tag, method.routing_key, props,
+                                '%s.%d' % (props.correlation_id, index),
+                                (fn, elem_argv, elem_kwds), received))
+        return
+
+    def _on_batch_request(self, method, props, body, received):
+        requests = serialization.decode(body, props.content_type,
+                                        props.content_encoding)
+        if(not requests):
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        batch = _Batch(requests)
+        slots = int(props.headers['spread_batch']) or self.slots
+        self._unacked[method.delivery_tag] = 1
+        for i in range(min(slots, self.slots, len(requests))):
+            self._requests.put((method.delivery_tag, method.routing_key, props,
+                                props.correlation_id, batch, received))
+        return
+
+    def _run_slot(self):
+        while(True):
+            (tag, queue, props, correlation_id, request, received) = \
+                self._requests.get()
+            if(isinstance(request, _Batch)):
+                self._run_batch(tag, queue, props, request, received)
+                continue
+            response = self._run_call(tag, queue, props, correlation_id,
+                                      request, received)
+            if(response is not None):
+                (body, content_type, content_encoding) = \
+                    _encode_reply(response, props)
+                self._publish(tag, props.reply_to,
+                              pika.BasicProperties(
+                                  correlation_id=correlation_id,
+                                  content_type=content_type,
+                                  content_encoding=content_encoding),
+                              body)
+
+    def _run_batch(self, tag, queue, props, batch, received):
+        """
+        Run calls of `batch` until there are none left and, if we ran the last
+        one, publish the batch reply.
+        """
+        while(True):
+            call = batch.next()
+            if(call is None):
+                return
+            (index, request) = call
+            # Retries are not replies to the batch: see _retry().
+            response = self._run_call(None, queue, props,
+                                      '%s.%d' % (props.correlation_id, index),
+                                      request, received)
+            if(batch.done(index, response)):
+                (body, content_type, content_encoding) = \
+                    _encode_reply(batch.results, props, batch=True)
+                self._publish(tag, props.reply_to,
+                              pika.BasicProperties(
+                                  correlation_id=props.correlation_id,
+                                  headers={'spread_batch': '1'},
+                                  content_type=content_type,
+                                  content_encoding=content_encoding),
+                              body)
+
+    def _run_call(self, tag, queue, props, correlation_id, request, received):
+        """
+        Run the call `correlation_id` of the request `tag` and return its
+        response, or None if it failed and was requeued to be retried (see
+        _retry()). Called from the slot threads.
+        """
+        reply_to = props.reply_to
+        if(self._is_cancelled(correlation_id)):
+            return({'exit_code': -1,
+                    'terminated': False,
+                    'cancelled': True,
+                    'hostname': HOSTNAME})
+        try:
+            # Keep the encoded request, to be published again by _retry().
+            if(isinstance(request, basestring)):
+                (fn, argv, kwds, timings) = _decode(request, received,
+                                                    props.content_type,
+                                                    props.content_encoding)
+                request = (request, props.content_type,
+                           props.content_encoding)
+            else:
+                (fn, argv, kwds) = request
+                timings = [['slot_wait', received, time.time()], ]
+                request = serialization.encode([fn, argv, kwds],
+                                               props.content_type)
+            max_attempts = 1
+            if(fn == 'system'):
+                # Attempts are separate requests (see _retry()).
+                max_attempts = _max_attempts(kwds.pop('retries',
+                                                      DEFAULT_RETRIES))
+                if(kwds.pop('stream', False)):
+                    kwds.setdefault('capture', CAPTURE_KB)
+                    kwds['on_output'] = functools.partial(
+                        self._send_output, reply_to, correlation_id)
+                kwds['on_status'] = functools.partial(self._send_status,
+                                                      correlation_id)
+                kwds['cancel'] = threading.Event()
+                with self._lock:
+                    self._cancels[correlation_id] = kwds['cancel']
+                if(self._is_cancelled(correlation_id)):
+                    # Cancelled since we checked.
+                    kwds['cancel'].set()
+            try:
+                response = _call(fn, argv, kwds, timings, self.exporter)
+            finally:
+                with self._lock:
+                    self._cancels.pop(correlation_id, None)
+            if(fn == 'system' and isinstance(response, dict)):
+                response['attempts'] = int((props.headers or {}).get(
+                    'spread_attempt', 1))
+                if((response.get('exit_code') != 0 or
+                    response.get('terminated')) and
+                   not response.get('cancelled') and
+                   self._retry(tag, queue, props, correlation_id, request,
+                               response, max_attempts)):
+                    return(None)
+            if(isinstance(response, dict) and
+               'staged_outputs' in response):
+                response['staged_outputs'] = self._send_files(
+                    reply_to, correlation_id, response['staged_outputs'])
+            return(response)
+        except Exception, e:
+            log.exception('Request %s failed', correlation_id)
+            return(_error_response(e))
+
+    def _retry(self, tag, queue, props, correlation_id, request, response,
+        max_attempts):
+        """
+        Handle the failed `response` to `request`, a (body, content_type,
+        content_encoding) encoded request: requeue the request with a backoff
+        and return True if it has attempts left. Otherwise record it in
+        DEAD_LETTER_QUEUE and return False. Called from the slot threads.
+        """
+        headers = dict(props.headers or {})
+        attempt = response['attempts']
+        if(attempt >= max_attempts):
+            log.warning('Call %s failed %d times, giving up',
+                        correlation_id, attempt)
+            dead_props = pika.BasicProperties(correlation_id=correlation_id,
+                                              headers=headers)
+            # Dead letters are JSON, whatever the format of the request.
+            self._publish(None, DEAD_LETTER_QUEUE, dead_props,
+                          json.dumps({'request':
+                                          serialization.decode(*request),
+                                      'result': response}))
+            return(False)
+
+        for (name, path) in response.get('staged_outputs', []):
+            os.remove(path)
+        failed_on = [h for h in headers.get('spread_failed_on', '').split(',')
+                     if h]
+        if(HOSTNAME not in failed_on):
+            failed_on.append(HOSTNAME)
+        # Array elements are retried one by one, as regular requests.
+        headers.pop('spread_array', None)
+        headers.pop('spread_batch', None)
+        headers.pop('spread_bounces', None)
+        headers.pop('spread_lost', None)
+        headers.update({'spread_attempt': str(attempt + 1),
+                        'spread_max_attempts': str(max_attempts),
+                        'spread_failed_on': ','.join(failed_on)})
+        (delay, level) = _backoff(attempt)
+        log.info('Attempt %d of %s failed, retrying in %.1f s',
+                 attempt, correlation_id, delay)
+        self._publish(tag, retry_queue_name(queue, level),
+                      pika.BasicProperties(reply_to=props.reply_to,
+                                           correlation_id=correlation_id,
+                                           priority=props.priority,
+                                           expiration=str(int(delay * 1000)),
+                                           headers=headers,
+                                           content_type=request[1],
+                                           content_encoding=request[2]),
+                      request[0])
+        return(True)
+
+    def _publish(self, tag, routing_key, properties, body):
+        """
+        Have the connection thread publish `body` to `routing_key`. If `tag`
+        is not None, the message is the reply to (one of the elements of) that
+        request, or its retry, and the request is acknowledged once all of its
+        replies have been published. Thread safe.
+        """
+        self._replies.put((tag, routing_key, properties, body))
+        os.write(self._wakeup_w, 'x')
+        return
+
+    def _send_output(self, reply_to, correlation_id, name, data):
+        """
+        Queue a chunk of the output of a running job for the client. Called
+        from the output reader threads.
+        """
+        self._publish(None, reply_to,
+                      pika.BasicProperties(correlation_id=correlation_id,
+                                           headers={'spread_output': name}),
+                      data)
+        return
+
+    def _send_status(self, correlation_id, status):
+        """
+        Queue the heartbeat of a running job for STATUS_EXCHANGE. Called from
+        the slot threads.
+        """
+        status['correlation_id'] = correlation_id
+        self._heartbeats.put(json.dumps(status))
+        os.write(self._wakeup_w, 'x')
+        return
+
+    def _send_files(self, reply_to, correlation_id, outputs):
+        """
+        Queue the chunks of the spooled `outputs` ([name, path] list) for the
+        client, ahead of the reply, and remove them. Return their names.
+        """
+        for (name, path) in outputs:
+            try:
+                for (offset, data, last) in staging.read_chunks(path):
+                    headers = staging.chunk_headers(offset, last,
+                                                    spread_file=name)
+                    self._publish(None, reply_to,
+                                  pika.BasicProperties(
+                                      correlation_id=correlation_id,
+                                      headers=headers),
+                                  data)
+            finally:
+                os.remove(path)
+        return([name for (name, path) in outputs])
+
+    def _flush_replies(self):
+        while(True):
+            try:
+                status = self._heartbeats.get_nowait()
+            except Queue.Empty:
+                break
+            self.channel.basic_publish(exchange=STATUS_EXCHANGE,
+                                       routing_key=HOSTNAME,
+                                       body=status)
+        while(True):
+            try:
+                (tag, routing_key, properties, body) = \
+                    self._replies.get_nowait()
+            except Queue.Empty:
+                return
+            # See _reply().
+            properties.headers = dict(properties.headers or {})
+            properties.headers['spread_sent'] = '%.6f' % time.time()
+            self.channel.basic_publish(exchange='',
+                                       routing_key=routing_key,
+                                       properties=properties,
+                                       body=body)
+            if(tag is None):
+                continue
+            self._unacked[tag] -= 1
+            if(not self._unacked[tag]):
+                del(self._unacked[tag])
+                self.channel.basic_ack(delivery_tag=tag)
+
+    def drain(self, signum=None, frame=None):
+        """
+        Stop taking new requests and have run() return as soon as the requests
+        we hold are done. Installed as SIGTERM handler by run().
+        """
+        self._draining = True
+        os.write(self._wakeup_w, 'x')
+        return
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.drain)
+        for thread in self._threads:
+            thread.start()
+        for queue in self.queues:
+            self._consumer_tags.append(
+                self.channel.basic_consume(self.on_request, queue=queue))
+        self.channel.basic_consume(self.on_file_chunk, no_ack=True,
+                                   queue=self.file_queue)
+        self.channel.basic_consume(self.on_control, no_ack=True,
+                                   queue=self.control_queue)
+
+        sock = self.connection.socket
+        while(True):
+            if(self._draining):
+                for tag in self._consumer_tags:
+                    self.channel.basic_cancel(tag)
+                self._consumer_tags = []
+                if(not self._unacked and not self._downloads):
+                    break
+            # Only wake up periodically while files are being fetched.
+            timeout = None
+            if(self._downloads):
+                timeout = 1
+            try:
+                ready, _, _ = select.select([sock, self._wakeup_r], [], [],
+                                            timeout)
+            except select.error, e:
+                if(e.args[0] == errno.EINTR):
+                    continue
+                raise
+            if(self._downloads):
+                self._expire_downloads()
+            if(self._wakeup_r in ready):
+                os.read(self._wakeup_r, 4096)
+                self._flush_replies()
+            if(sock in ready):
+                self.connection.process_data_events()
+        log.info('Drained, exiting')
+        self.connection.close()
+        return
 
 
 
 if(__name__ == '__main__'):
+    parser = optparse.OptionParser('worker.py [options] [broker host or URL]')
+    parser.add_option('-n', '--slots',
+                      dest='slots',
+                      type='int',
+                      default=1,
+                      help='number of jobs to execute concurrently.')
+    parser.add_option('-P', '--pool',
+                      dest='pools',
+                      action='append',
+                      default=[],
+                      help='serve the requests of this worker pool ' + \
+                           '("default" for the default one). Can be ' + \
+                           'repeated. Default: only the default pool.')
+    parser.add_option('-m', '--metrics',
+                      dest='metrics',
+                      type='str',
+                      default=None,
+                      help='export phase timings to statsd://host:port ' + \
+                           'or to a Prometheus text file://path.')
+    parser.add_option('-e', '--entry-point',
+                      dest='entry_points',
+                      action='append',
+                      default=[],
+                      help='run <executable> as the Python <module:function> ' + \
+                           'in a warm fork server: <executable>=<module:function>.')
+    parser.add_option('-p', '--preload',
+                      dest='preload',
+                      action='append',
+                      default=[],
+                      help='module to import in the fork server.')
+    parser.add_option('-c', '--cache-dir',
+                      dest='cache_dir',
+                      type='str',
+                      default=None,
+                      help='directory of the result cache (disabled if unset).')
+    parser.add_option('-s', '--cache-size',
+                      dest='cache_size',
+                      type='int',
+                      default=None,
+                      help='maximum size of the result cache in MB.')
+    parser.add_option('-d', '--stage-dir',
+                      dest='stage_dir',
+                      type='str',
+                      default=staging.DEFAULT_ROOT,
+                      help='node local directory of the staged files.')
+    parser.add_option('-w', '--workdir-pool',
+                      dest='workdir_pool',
+                      type='int',
+                      default=0,
+                      help='number of empty job directories kept for reuse ' + \
+                           'per root directory.')
+    parser.add_option('-t', '--tmpfs',
+                      dest='tmpfs',
+                      type='str',
+                      default=None,
+                      help='create job directories on this tmpfs ' + \
+                           '(e.g. /dev/shm) instead of their root directory.')
+    parser.add_option('-q', '--tmpfs-quota',
+                      dest='tmpfs_quota',
+                      type='int',
+                      default=None,
+                      help='only use the tmpfs while less than this many MB ' + \
+                           'of it are in use.')
+    parser.add_option('-L', '--log-file',
+                      dest='log_file',
+                      type='str',
+                      default=None,
+                      help='write the JSON lines log to this file instead ' + \
+                           'of stdout.')
+    parser.add_option('--log-level',
+                      dest='log_level',
+                      type='choice',
+                      choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                      default='INFO',
+                      help='minimum level of the logged records.')
+    parser.add_option('--log-size',
+                      dest='log_size',
+                      type='int',
+                      default=logs.MAX_BYTES / 1024 / 1024,
+                      help='rotate the log file when it reaches this many MB.')
+    (options, args) = parser.parse_args()
+
     try:
-        broker_host = sys.argv[1]
+        broker_host = args[0]
     except:
-        print(' [i] No broker hostname specified, using localhost.')
-        print(' [i] You can specify a hostname for the message broker as ' + \
-              'first argument to this')
-        print(' [i] script e.g. ./worker.py machine.example.com')
-        broker_host = 'localhost'
+        broker_host = None
+
+    exporter = None
+    if(options.metrics):
+        exporter = metrics.exporter(options.metrics)
 
-    connection = pika.BlockingConnection(pika.ConnectionParameters(
-        host=broker_host))
-    channel = connection.channel()
-    channel.queue_declare(queue='rpc_queue')
+    if(options.cache_dir):
+        max_bytes = None
+        if(options.cache_size):
+            max_bytes = options.cache_size * 1024 * 1024
+        RESULT_CACHE = result_cache.ResultCache(options.cache_dir, max_bytes)
+
+    STAGE_STORE = staging.FileStore(options.stage_dir)
+
+    # The fork server has to be started before any thread or connection.
+    for entry in options.entry_points:
+        (executable, entry_point) = entry.split('=', 1)
+        ENTRY_POINTS[executable] = entry_point
+    if(ENTRY_POINTS):
+        modules = [e.split(':')[0] for e in ENTRY_POINTS.values()]
+        FORK_SERVER = forkserver.ForkServer(preload=options.preload + modules)
+
+    # The reaper of the working directories is a thread.
+    tmpfs_quota = None
+    if(options.tmpfs_quota is not None):
+        tmpfs_quota = options.tmpfs_quota * 1024 * 1024
+    WORKDIRS = workdirs.WorkdirManager(options.workdir_pool, options.tmpfs,
+                                       tmpfs_quota)
+
+    # Logging runs in a thread as well.
+    log_handler = logs.setup(options.log_file, options.log_level,
+                             options.log_size * 1024 * 1024)
+    if(broker_host is None):
+        log.info('No broker hostname specified, using localhost. You can ' + \
+                 'specify a hostname for the message broker as first ' + \
+                 'argument to this script e.g. ./worker.py ' + \
+                 'machine.example.com or, for the brokerless single ' + \
+                 'machine mode, ./worker.py local://')
+        broker_host = 'localhost'
 
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(on_request, queue='rpc_queue')
+    pools = [pool != 'default' and pool or None for pool in options.pools]
+    worker = Worker(broker_host, slots=options.slots, exporter=exporter,
+                    pools=pools)
 
-    print " [x] Awaiting RPC requests"
-    channel.start_consuming()
+    log.info('Awaiting RPC requests (%d slots)', worker.slots)
+    worker.run()
+    WORKDIRS.drain()
+    log_handler.close()
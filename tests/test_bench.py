@@ -0,0 +1,58 @@
+"""
+Measurements of the benchmark runs (see spread.bench.runner).
+"""
+from spread import client
+from spread.bench import runner
+
+
+
+
+class _Future(object):
+    def __init__(self, submit_time, response=None, cancelled=False):
+        self.submit_time = submit_time
+        self.response = response
+        self._cancelled = cancelled
+        return
+
+    def result(self):
+        if(self._cancelled):
+            raise client.CancelledError('cancelled')
+        return(self.response)
+
+def _response(submit_time, exit_code=0):
+    return({'exit_code': exit_code,
+            'start_time': submit_time + 1.,
+            'exec_time': 2.,
+            'timings': [['proc', submit_time + 1., submit_time + 3.],
+                        ['reply', submit_time + 3., submit_time + 4.]]})
+
+
+
+
+def test_measure():
+    futures = [_Future(10., _response(10.)), _Future(11., _response(11., 1))]
+    record = runner.measure(futures)
+    assert record['jobs'] == 2
+    assert record['failed'] == 1
+    assert record['elapsed'] == 5.
+    assert record['submit_to_start']['count'] == 2
+    assert record['submit_to_start']['max'] == 1.
+    assert record['end_to_reply']['mean'] == 1.
+    assert record['overhead']['min'] == 2.
+    assert record['phases']['proc']['count'] == 2
+    return
+
+def test_measure_incomplete_results():
+    # Calls which never ran have no timings: they only count as failed.
+    futures = [_Future(10., _response(10.)),
+               _Future(10., {'exit_code': -1, 'error': 'Unknown format'}),
+               _Future(10., {'exit_code': -1, 'terminated': False,
+                             'cancelled': True, 'hostname': 'h'}),
+               _Future(10., cancelled=True),
+               _Future(10., None)]
+    record = runner.measure(futures)
+    assert record['jobs'] == 5
+    assert record['failed'] == 4
+    assert record['submit_to_start']['count'] == 1
+    assert record['overhead']['count'] == 1
+    return
@@ -0,0 +1,129 @@
+"""
+Content-addressed result cache (see spread.cache) and its use by system().
+"""
+import os
+
+import pytest
+
+from spread import cache
+from spread import worker
+
+
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        f.write(data)
+    return
+
+def _read(path):
+    with open(path) as f:
+        return(f.read())
+
+
+
+
+def test_key(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')))
+    cwd = str(tmpdir)
+    _write(os.path.join(cwd, 'in'), 'a')
+    key = c.key(['/bin/cat', 'in'], {'X': '1'}, ['X'], ['in'], cwd)
+    assert key == c.key(['/bin/cat', 'in'], {'X': '1', 'Y': '2'}, ['X'],
+                        ['in'], cwd)
+    assert key != c.key(['/bin/cat', 'in'], {'X': '2'}, ['X'], ['in'], cwd)
+    assert c.key(['/bin/cat', 'in'], {}, [], ['in'], cwd, 'step') \
+        .startswith('step.')
+    with pytest.raises(ValueError):
+        c.key(['/bin/cat'], {}, [], [], cwd, 'bad tag')
+    # Same stat signature, same digest: change the size.
+    _write(os.path.join(cwd, 'in'), 'bb')
+    assert key != c.key(['/bin/cat', 'in'], {'X': '1'}, ['X'], ['in'], cwd)
+    return
+
+def test_put_get(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')))
+    cwd = str(tmpdir.join('run'))
+    os.makedirs(os.path.join(cwd, 'sub'))
+    _write(os.path.join(cwd, 'sub', 'out'), 'result')
+    assert c.get('k', cwd, ['sub/out']) is None
+    c.put('k', {'exit_code': 0, 'pid': 1, 'hostname': 'h', 'start_time': 2.,
+                'cwd': cwd}, cwd, ['sub/out'])
+
+    restored = str(tmpdir.join('other'))
+    os.makedirs(restored)
+    assert c.get('k', restored, ['sub/out']) == {'exit_code': 0}
+    assert _read(os.path.join(restored, 'sub', 'out')) == 'result'
+    return
+
+def test_put_missing_output(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')))
+    c.put('k', {'exit_code': 0}, str(tmpdir), ['missing'])
+    assert c.get('k', str(tmpdir), ['missing']) is None
+    assert os.listdir(str(tmpdir.join('cache', cache.TMP_DIR))) == []
+    return
+
+def test_put_replaces(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')))
+    cwd = str(tmpdir)
+    _write(os.path.join(cwd, 'out'), 'v1')
+    c.put('k', {'exit_code': 0, 'version': 1}, cwd, ['out'])
+    # A broken entry (e.g. partly evicted) is repaired by the next put.
+    os.remove(str(tmpdir.join('cache', 'k', cache.RESULT_FILE)))
+    assert c.get('k', cwd, ['out']) is None
+    _write(os.path.join(cwd, 'out'), 'v2')
+    c.put('k', {'exit_code': 0, 'version': 2}, cwd, ['out'])
+    assert c.get('k', cwd, ['out']) == {'exit_code': 0, 'version': 2}
+    assert _read(os.path.join(cwd, 'out')) == 'v2'
+    assert os.listdir(str(tmpdir.join('cache', cache.TMP_DIR))) == []
+    return
+
+def test_invalidate(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')))
+    for key in ('step1.a', 'step1.b', 'step2.a'):
+        c.put(key, {'exit_code': 0}, str(tmpdir), [])
+    assert c.invalidate('step1.') == 2
+    assert c.get('step1.a', str(tmpdir), []) is None
+    assert c.get('step2.a', str(tmpdir), []) == {'exit_code': 0}
+    assert c.invalidate() == 1
+    return
+
+def test_evict(tmpdir):
+    c = cache.ResultCache(str(tmpdir.join('cache')), max_bytes=2500)
+    cwd = str(tmpdir)
+    _write(os.path.join(cwd, 'out'), 'x' * 1000)
+    for (i, key) in enumerate(('a', 'b')):
+        c.put(key, {'exit_code': 0}, cwd, ['out'])
+        # Least recently used first: make the order unambiguous.
+        os.utime(str(tmpdir.join('cache', key, cache.RESULT_FILE)),
+                 (1000 + i, 1000 + i))
+    # Using an entry makes it the most recently used.
+    assert c.get('a', cwd, ['out']) is not None
+    c.put('c', {'exit_code': 0}, cwd, ['out'])
+    assert c.get('b', cwd, ['out']) is None
+    assert c.get('a', cwd, ['out']) is not None
+    assert c.get('c', cwd, ['out']) is not None
+    return
+
+def test_system_hit(tmpdir, monkeypatch):
+    monkeypatch.setattr(worker, 'RESULT_CACHE',
+                        cache.ResultCache(str(tmpdir.join('cache'))))
+    cwd = str(tmpdir.join('run'))
+    os.makedirs(cwd)
+    argv = ['/bin/sh', '-c', 'echo $$ > out']
+    miss = worker.system(argv, cwd=cwd, cache=True, outputs=['out'],
+                         retries=0)
+    assert miss['cached'] is False
+    os.remove(os.path.join(cwd, 'out'))
+
+    hit = worker.system(argv, cwd=cwd, cache=True, outputs=['out'],
+                        retries=0)
+    assert hit['cached'] is True
+    assert hit['cache_key'] == miss['cache_key']
+    assert hit['exit_code'] == 0
+    assert _read(os.path.join(cwd, 'out')) == '%d\n' % (miss['pid'])
+    # Only this call's details, not those of the run which was cached.
+    assert hit['hostname'] == worker.HOSTNAME
+    assert hit['cwd'] == cwd
+    assert hit['pid'] is None
+    assert hit['start_time'] is None
+    return
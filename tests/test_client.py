@@ -0,0 +1,95 @@
+"""
+Futures and executor of the client (see spread.client), against a stand-in
+client which replies to one call each time it processes events.
+"""
+import pytest
+
+from spread import client
+
+
+
+
+class _Client(object):
+    def __init__(self):
+        self.submitted = []
+        self.queued = []
+        self.max_pending = 0
+        return
+
+    def submit(self, fn, argv, kwds, pool=None, priority=None):
+        future = client.RpcFuture(self, str(len(self.submitted)))
+        self.submitted.append((fn, argv, kwds, pool, priority))
+        self.queued.append(future)
+        self.max_pending = max(self.max_pending, self.pending())
+        return(future)
+
+    def pending(self):
+        return(len([f for f in self.queued if not f.done()]))
+
+    def process_events(self):
+        for future in self.queued:
+            if(not future.done()):
+                future._set_result({'exit_code': 0,
+                                    'argv': self.submitted[int(
+                                        future.correlation_id)][1]})
+                break
+        return
+
+    def _forget(self, future):
+        return
+
+    def cancel(self, correlation_ids):
+        return
+
+
+
+
+def test_back_pressure():
+    rpc = _Client()
+    executor = client.SpreadExecutor(max_in_flight=3, client=rpc,
+                                     pool='highmem', timeout=10)
+    futures = [executor.submit('/bin/echo', str(i)) for i in range(10)]
+    assert rpc.max_pending == 3
+    assert rpc.submitted[0] == ('system', ['/bin/echo', '0'], {'timeout': 10},
+                                'highmem', None)
+    executor.shutdown(wait=True)
+    assert all([f.done() for f in futures])
+    with pytest.raises(RuntimeError):
+        executor.submit('/bin/true')
+    return
+
+def test_map_is_lazy_and_ordered():
+    rpc = _Client()
+    executor = client.SpreadExecutor(max_in_flight=2, client=rpc)
+    results = executor.map('/bin/echo', iter(range(100)))
+    # Only the first window is submitted before iterating.
+    assert len(rpc.submitted) == 2
+    argvs = [r['argv'] for r in results]
+    assert argvs == [['/bin/echo', i] for i in range(100)]
+    assert rpc.max_pending == 2
+    return
+
+def test_shutdown_cancels():
+    rpc = _Client()
+    executor = client.SpreadExecutor(max_in_flight=5, client=rpc)
+    futures = [executor.submit('/bin/sleep', '10') for i in range(3)]
+    executor.shutdown(wait=True, cancel_futures=True)
+    assert all([f.cancelled() for f in futures])
+    with pytest.raises(client.CancelledError):
+        futures[0].result()
+    return
+
+def test_future_state():
+    rpc = _Client()
+    future = client.RpcFuture(rpc, 'call')
+    # Queued calls are not running.
+    assert not future.running()
+    future._started = True
+    assert future.running()
+    future._set_result({'exit_code': -1, 'error': 'Unknown format'})
+    assert not future.running()
+    assert isinstance(future.exception(), client.RemoteError)
+    ok = client.RpcFuture(rpc, 'ok')
+    ok._set_result({'exit_code': 1})
+    assert ok.exception() is None
+    return
@@ -0,0 +1,48 @@
+"""
+Cycle detection of DAGs (see spread.dag). No node is ever submitted: the
+DAGs are given a client which must not be used.
+"""
+import pytest
+
+from spread import dag
+
+
+
+
+def _dag(edges, nodes='abcd'):
+    d = dag.Dag(name='test', client=object())
+    for name in nodes:
+        d.add(name, ['/bin/true'])
+    for (parent, child) in edges:
+        d.add_dependency(parent, child)
+    return(d)
+
+
+
+
+@pytest.mark.parametrize('edges', [[],
+                                   [('a', 'b'), ('b', 'c'), ('c', 'd')],
+                                   [('a', 'b'), ('a', 'c'), ('b', 'd'),
+                                    ('c', 'd')]])
+def test_acyclic(edges):
+    _dag(edges)._check_acyclic()
+    return
+
+@pytest.mark.parametrize('edges', [[('a', 'a')],
+                                   [('a', 'b'), ('b', 'a')],
+                                   [('a', 'b'), ('b', 'c'), ('c', 'd'),
+                                    ('d', 'b')]])
+def test_cycles(edges):
+    d = _dag(edges)
+    with pytest.raises(ValueError):
+        d.start()
+    # Nothing was started.
+    assert not d._started
+    assert all([node.state == dag.WAITING for node in d.nodes.values()])
+    return
+
+def test_unknown_dependency():
+    d = _dag([])
+    with pytest.raises(ValueError):
+        d.add_dependency('a', 'z')
+    return
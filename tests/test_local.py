@@ -0,0 +1,170 @@
+"""
+The local:// transport (see spread.local): framing of the messages and the
+semantics of the router.
+"""
+import threading
+import time
+
+import pika
+import pika.exceptions
+import pytest
+
+from spread import local
+
+
+
+
+def test_round_trip():
+    frames = [({'op': 'publish', 'routing_key': 'q'}, 'body'),
+              ({'op': 'ack', 'delivery_tag': 1}, ''),
+              ({'op': 'publish', 'unicode': u'\xe9'}, '\x00\xff' * 1000)]
+    buf = bytearray(''.join([local._encode_frame(h, b) for (h, b) in frames]))
+    assert local._decode_frames(buf) == frames
+    assert buf == bytearray()
+    return
+
+def test_incomplete_frames_stay_in_buffer():
+    data = local._encode_frame({'n': 1}, 'x' * 100)
+    buf = bytearray()
+    # Feed the frame one byte at a time: nothing comes out until it is
+    # complete.
+    for byte in data[:-1]:
+        buf.extend(byte)
+        assert local._decode_frames(buf) == []
+    assert len(buf) == len(data) - 1
+    buf.extend(data[-1])
+    assert local._decode_frames(buf) == [({'n': 1}, 'x' * 100)]
+    assert buf == bytearray()
+    return
+
+def test_trailing_partial_frame():
+    first = local._encode_frame({'n': 1}, 'a')
+    second = local._encode_frame({'n': 2}, 'b')
+    buf = bytearray(first + second[:local.FRAME_HEADER.size + 2])
+    assert local._decode_frames(buf) == [({'n': 1}, 'a')]
+    assert buf == bytearray(second[:local.FRAME_HEADER.size + 2])
+    buf.extend(second[local.FRAME_HEADER.size + 2:])
+    assert local._decode_frames(buf) == [({'n': 2}, 'b')]
+    return
+
+def test_bodies_are_strings():
+    buf = bytearray(local._encode_frame({}, 'body'))
+    [(header, body)] = local._decode_frames(buf)
+    assert type(body) is str
+    return
+
+
+
+
+@pytest.fixture
+def url(tmpdir):
+    url = local.SCHEME + str(tmpdir.join('router.sock'))
+    broker = local.LocalBroker(url)
+    thread = threading.Thread(target=broker.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield url
+    broker.stop()
+    thread.join()
+    return
+
+def _consume(conn, queue, count, no_ack=True, timeout=5):
+    """
+    Consume `count` messages from `queue` and return the list of their
+    (method, properties, body).
+    """
+    messages = []
+    conn.basic_consume(lambda ch, method, props, body: messages.append(
+        (method, props, body)), queue=queue, no_ack=no_ack)
+    deadline = time.time() + timeout
+    while(len(messages) < count and time.time() < deadline):
+        conn.process_data_events()
+    assert len(messages) == count
+    return(messages)
+
+def test_priorities(url):
+    conn = local.connect(url).channel()
+    conn.queue_declare(queue='q', arguments={'x-max-priority': 10})
+    for (body, priority) in (('low', 1), ('high1', 5), ('none', None),
+                             ('high2', 5), ('top', 10), ('over', 20)):
+        conn.basic_publish(exchange='', routing_key='q', body=body,
+                           properties=pika.BasicProperties(priority=priority))
+    # Over the maximum is the maximum, FIFO within each priority.
+    bodies = [body for (_, _, body) in _consume(conn, 'q', 6)]
+    assert bodies == ['top', 'over', 'high1', 'high2', 'low', 'none']
+    conn.close()
+    return
+
+def test_expiration_dead_letters(url):
+    conn = local.connect(url).channel()
+    conn.queue_declare(queue='dead')
+    conn.queue_declare(queue='delay',
+                       arguments={'x-dead-letter-exchange': '',
+                                  'x-dead-letter-routing-key': 'dead'})
+    start = time.time()
+    conn.basic_publish(exchange='', routing_key='delay', body='later',
+                       properties=pika.BasicProperties(
+                           expiration='200', correlation_id='c'))
+    [(method, props, body)] = _consume(conn, 'dead', 1)
+    assert time.time() - start >= .2
+    assert (method.routing_key, props.correlation_id, body) == \
+        ('dead', 'c', 'later')
+    assert conn.queue_declare(queue='delay', passive=True) \
+        .method.message_count == 0
+    conn.close()
+    return
+
+def test_redelivery_on_disconnect(url):
+    first = local.connect(url).channel()
+    first.queue_declare(queue='q')
+    first.basic_publish(exchange='', routing_key='q', body='job')
+    [(method, _, _)] = _consume(first, 'q', 1, no_ack=False)
+    assert not method.redelivered
+    # Gone without acknowledging it: the next consumer gets it again.
+    first.close()
+    second = local.connect(url).channel()
+    second.basic_qos(prefetch_count=1)
+    [(method, _, body)] = _consume(second, 'q', 1, no_ack=False)
+    assert method.redelivered
+    assert body == 'job'
+    second.basic_ack(delivery_tag=method.delivery_tag)
+    assert second.queue_declare(queue='q', passive=True) \
+        .method.message_count == 0
+    second.close()
+    return
+
+def test_passive_declare(url):
+    conn = local.connect(url).channel()
+    with pytest.raises(pika.exceptions.ChannelClosed):
+        conn.queue_declare(queue='missing', passive=True)
+    # Passive declares do not create queues.
+    with pytest.raises(pika.exceptions.ChannelClosed):
+        conn.queue_declare(queue='missing', passive=True)
+
+    conn.queue_declare(queue='q')
+    for i in range(3):
+        conn.basic_publish(exchange='', routing_key='q', body=str(i))
+    method = conn.queue_declare(queue='q', passive=True).method
+    assert (method.message_count, method.consumer_count) == (3, 0)
+    conn.close()
+    return
+
+def test_exclusive_queue(url):
+    owner = local.connect(url).channel()
+    queue = owner.queue_declare(exclusive=True).method.queue
+    other = local.connect(url).channel()
+    assert other.queue_declare(queue=queue, passive=True) \
+        .method.message_count == 0
+    # Deleted together with the connection which declared it.
+    owner.close()
+    deadline = time.time() + 5
+    while(time.time() < deadline):
+        try:
+            other.queue_declare(queue=queue, passive=True)
+        except pika.exceptions.ChannelClosed:
+            break
+        time.sleep(.05)
+    else:
+        assert False, 'exclusive queue %s not deleted' % (queue)
+    other.close()
+    return
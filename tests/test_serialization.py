@@ -0,0 +1,89 @@
+"""
+Wire formats of the requests and results (see spread.serialization) and how
+workers pick the format of their replies.
+"""
+import pika
+import pytest
+
+from spread import serialization
+from spread import worker
+
+
+
+
+REQUEST = ['system', ['/bin/echo', 'hello'], {'timeout': 10, 'cache': True}]
+LARGE = {'stdout': 'x' * (serialization.COMPRESS_MIN * 2)}
+
+
+
+
+def test_content_type_names():
+    assert serialization.content_type(None) == serialization.JSON
+    assert serialization.content_type('json') == serialization.JSON
+    assert serialization.content_type('marshal') == serialization.MARSHAL
+    assert serialization.content_type(serialization.MARSHAL) == \
+        serialization.MARSHAL
+    with pytest.raises(ValueError):
+        serialization.content_type('pickle')
+    return
+
+@pytest.mark.parametrize('content_type', [None, serialization.JSON,
+                                          serialization.MARSHAL])
+def test_round_trip(content_type):
+    (body, ctype, encoding) = serialization.encode(REQUEST, content_type)
+    assert ctype == (content_type or serialization.JSON)
+    assert encoding is None
+    assert serialization.decode(body, ctype, encoding) == REQUEST
+    return
+
+def test_compression():
+    # Small bodies are never compressed, large ones only when asked for.
+    (_, _, encoding) = serialization.encode(REQUEST, None,
+                                            serialization.COMPRESS_MIN)
+    assert encoding is None
+    (_, _, encoding) = serialization.encode(LARGE)
+    assert encoding is None
+    (body, ctype, encoding) = serialization.encode(LARGE, None,
+                                                   serialization.COMPRESS_MIN)
+    assert encoding == serialization.ZLIB
+    assert len(body) < serialization.COMPRESS_MIN
+    assert serialization.decode(body, ctype, encoding) == LARGE
+    return
+
+def test_unknown_formats():
+    (body, _, _) = serialization.encode(REQUEST)
+    with pytest.raises(ValueError):
+        serialization.decode(body, 'application/x-unknown')
+    with pytest.raises(ValueError):
+        serialization.decode(body, serialization.JSON, 'gzip')
+    assert not serialization.supported('application/x-unknown')
+    assert not serialization.supported(serialization.JSON, 'gzip')
+    assert serialization.supported()
+    assert serialization.supported(serialization.MARSHAL, serialization.ZLIB)
+    return
+
+def test_accepts():
+    assert not serialization.accepts(None)
+    assert not serialization.accepts({})
+    assert serialization.accepts({serialization.ACCEPT_HEADER: 'zlib'})
+    assert serialization.accepts({serialization.ACCEPT_HEADER: 'gzip,zlib'})
+    assert not serialization.accepts({serialization.ACCEPT_HEADER: 'gzip'})
+    return
+
+def test_reply_format():
+    # Workers reply in the format of the request, compressed only for
+    # clients which accept it, and in JSON to requests in unknown formats.
+    accept = {serialization.ACCEPT_HEADER: serialization.ZLIB}
+    cases = [(None, None, serialization.JSON, None),
+             (serialization.MARSHAL, None, serialization.MARSHAL, None),
+             (serialization.MARSHAL, accept, serialization.MARSHAL,
+              serialization.ZLIB),
+             ('application/x-unknown', accept, serialization.JSON,
+              serialization.ZLIB)]
+    for (request_type, headers, reply_type, reply_encoding) in cases:
+        props = pika.BasicProperties(content_type=request_type,
+                                     headers=headers)
+        (body, ctype, encoding) = worker._encode_reply(LARGE, props)
+        assert (ctype, encoding) == (reply_type, reply_encoding)
+        assert serialization.decode(body, ctype, encoding) == LARGE
+    return
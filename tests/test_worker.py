@@ -0,0 +1,204 @@
+"""
+Execution of the commands by the workers (see spread.worker).
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pika
+
+from spread import serialization
+from spread import worker
+
+
+
+
+def _exec(argv, timeout=0, kill_after=1, stdin_str=None, **kwds):
+    return(worker._exec(argv, stdin_str, None, None, None, True, None,
+                        timeout, kill_after, **kwds))
+
+
+
+
+def test_exit_code():
+    res = _exec(['/bin/sh', '-c', 'exit 3'])
+    assert res['exit_code'] == 3
+    assert not res['terminated']
+    assert res['signal'] is None
+    assert 'error' not in res
+    return
+
+def test_timeout_terminates():
+    start = time.time()
+    res = _exec(['/bin/sleep', '30'], timeout=.2)
+    assert time.time() - start < 5
+    assert res['terminated']
+    assert res['exit_code'] == -signal.SIGTERM
+    assert res['signal'] == signal.SIGTERM
+    return
+
+def test_timeout_escalates_to_sigkill():
+    # The shell ignores SIGTERM: it gets SIGKILL kill_after seconds later.
+    res = _exec(['/bin/sh', '-c', 'trap "" TERM; sleep 30 & wait; sleep 30'],
+                timeout=.2, kill_after=.3)
+    assert res['terminated']
+    assert res['signal'] == signal.SIGKILL
+    assert res['exec_time'] < 5
+    return
+
+def test_unknown_exit_status():
+    # Somebody else reaps the child: its exit status is unknown, not 0.
+    proc = subprocess.Popen(['/bin/true'])
+    os.waitpid(proc.pid, 0)
+    waiter = worker._ChildWaiter(proc)
+    assert waiter.wait(5)
+    assert proc.returncode == -1
+    assert waiter.status is None
+    assert 'Exit status unknown' in waiter.error
+    # Never signal a reaped child: its pid might have been reused.
+    waiter.terminate()
+    waiter.kill()
+    waiter.close()
+    return
+
+def test_resource_usage():
+    res = _exec(['/bin/sh', '-c', 'i=0; while [ $i -lt 200000 ]; do ' + \
+                 'i=$((i+1)); done'])
+    assert res['exit_code'] == 0
+    assert res['user_time'] + res['sys_time'] > 0
+    assert res['max_rss'] > 0
+    assert res['minor_faults'] > 0
+    # The size of the worker the shell was forked from.
+    assert res['rss_baseline'] > 0
+    return
+
+def test_max_rss():
+    # 200 MB touched by the command itself: well above the baseline.
+    res = _exec([sys.executable, '-c',
+                 'import sys; x = sys.stdin.read(200000000)'],
+                stdin_str='\0' * 200000000)
+    assert res['exit_code'] == 0
+    assert res['max_rss'] >= 190000
+    return
+
+def test_no_rusage():
+    usage = worker._rusage_dict(None)
+    assert usage['max_rss'] == 0
+    assert usage['user_time'] == 0.
+    assert worker._resident_kb(-1) == 0
+    return
+
+
+
+
+class _Channel(object):
+    """
+    Stand-in for the channel of a Worker, recording what it publishes.
+    """
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        return
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((routing_key, properties, body))
+        return
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked.append(delivery_tag)
+        return
+
+class _Method(object):
+    def __init__(self, routing_key='rpc_queue', delivery_tag=1):
+        self.routing_key = routing_key
+        self.delivery_tag = delivery_tag
+        self.redelivered = True
+        return
+
+def _worker():
+    # Only the bookkeeping of retries is exercised: no connection needed.
+    w = worker.Worker.__new__(worker.Worker)
+    w.channel = _Channel()
+    w.published = []
+    w._publish = lambda tag, key, props, body: w.published.append(
+        (tag, key, props, body))
+    return(w)
+
+def _props(**headers):
+    return(pika.BasicProperties(reply_to='reply', correlation_id='call',
+                                headers=headers))
+
+def test_retry_headers():
+    w = _worker()
+    request = serialization.encode(['system', ['/bin/false'], {}])
+    response = {'exit_code': 1, 'attempts': 1}
+    props = _props(spread_failed_on='other', spread_bounces='2',
+                   spread_lost='1')
+    assert w._retry(7, 'rpc_queue', props, 'call', request, response, 3)
+    [(tag, key, retry, body)] = w.published
+    assert tag == 7
+    assert key == worker.retry_queue_name('rpc_queue', 1)
+    assert body == request[0]
+    assert retry.headers['spread_attempt'] == '2'
+    assert retry.headers['spread_max_attempts'] == '3'
+    assert retry.headers['spread_failed_on'] == 'other,' + worker.HOSTNAME
+    assert 'spread_bounces' not in retry.headers
+    assert 'spread_lost' not in retry.headers
+    assert float(retry.expiration) <= worker.RETRY_DELAY * 1000
+    return
+
+def test_retry_batch_element():
+    # Batch elements are retried one by one, as regular requests.
+    w = _worker()
+    request = serialization.encode(['system', ['/bin/false'],
+                                    {'retries': 4}])
+    response = {'exit_code': 1, 'attempts': 2}
+    props = _props(spread_batch='0', spread_attempt='2')
+    assert w._retry(None, 'rpc_queue', props, 'call.3', request, response, 5)
+    [(_, _, retry, _)] = w.published
+    assert retry.correlation_id == 'call.3'
+    assert 'spread_batch' not in retry.headers
+    assert retry.headers['spread_attempt'] == '3'
+    assert retry.headers['spread_max_attempts'] == '5'
+    return
+
+def test_retry_gives_up():
+    w = _worker()
+    request = serialization.encode(['system', ['/bin/false'], {}])
+    response = {'exit_code': 1, 'attempts': 3}
+    assert not w._retry(7, 'rpc_queue', _props(spread_attempt='3'), 'call',
+                        request, response, 3)
+    [(tag, key, _, body)] = w.published
+    assert (tag, key) == (None, worker.DEAD_LETTER_QUEUE)
+    assert json.loads(body)['result'] == response
+    return
+
+def test_redelivery_is_not_an_attempt():
+    w = _worker()
+    props = _props(spread_attempt='2', spread_max_attempts='2')
+    w._on_redelivered(_Method(), props, 'body')
+    [(key, requeued, body)] = w.channel.published
+    assert key == worker.retry_queue_name('rpc_queue', 1)
+    assert requeued.headers['spread_attempt'] == '2'
+    assert requeued.headers['spread_lost'] == '1'
+    assert body == 'body'
+    assert w.channel.acked == [1, ]
+    return
+
+def test_redelivery_gives_up():
+    w = _worker()
+    w._dead_letter = lambda props, request, response: w.published.append(
+        (None, worker.DEAD_LETTER_QUEUE, props, response))
+    lost = str(worker.MAX_REDELIVERIES - 1)
+    (body, _, _) = serialization.encode(['system', ['/bin/true'], {}])
+    w._on_redelivered(_Method(), _props(spread_lost=lost), body)
+    [(_, _, _, response)] = w.published
+    assert response['exit_code'] == -1
+    assert response['attempts'] == 1
+    [(key, reply, _)] = w.channel.published
+    assert (key, reply.correlation_id) == ('reply', 'call')
+    assert w.channel.acked == [1, ]
+    return